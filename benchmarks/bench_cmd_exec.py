@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for the per-invocation overhead of cmd_exec()
+
+Runs a few trivial programs many times and prints the mean wall time of
+cmd_exec_capture() next to a bare subprocess.run() of the same program,
+so the difference is the cost of our capture loop. Run it from the repo
+root with:
+
+    uv run python benchmarks/bench_cmd_exec.py [iterations]
+"""
+
+import subprocess
+import sys
+import time
+
+from autograder.actions.cmd import cmd_exec_capture
+
+WORKLOADS = [
+    ('true', ['true']),
+    ('echo', ['echo', 'hello']),
+    ('chatty (100 KB)', ['sh', '-c', 'seq 1 20000']),
+    ('background child holds stdout', ['sh', '-c', 'sleep 2 & echo hi']),
+]
+
+
+def mean_ms(fn, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print(f'{"workload":32} {"cmd_exec":>10} {"baseline":>10} {"overhead":>10}')
+    for name, cmd in WORKLOADS:
+        ours = mean_ms(lambda: cmd_exec_capture(cmd), iterations)
+        # The baseline doesn't wait for background children to close stdout
+        base = mean_ms(lambda: subprocess.run(cmd, stdout=subprocess.DEVNULL), iterations)
+        print(f'{name:32} {ours:8.2f}ms {base:8.2f}ms {ours - base:8.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""
+archive.py packs a class's graded repos into one bare repo, so they can be
+removed from the grading server and brought back one at a time for a
+regrade. Each snapshot's commit is kept under refs/snapshots/<student>/<suffix>,
+with the suffix "current" for repos graded without a date. Since students'
+repos share the starter code history, the bare repo stores it only once.
+The result JSON files are committed under refs/results
+"""
+
+from collections import Counter
+import glob
+import os
+import subprocess
+
+from .cmd import cmd_exec, cmd_exec_capture, cmd_exec_rc
+from .gitreader import READ_ERRORS, GitReader
+from .util import *
+
+# seconds to allow for fetching a snapshot or repacking the archive
+ARCHIVE_TIMEOUT = 600
+
+# suffix for repos graded without --by-date
+CURRENT = 'current'
+
+# Outcomes of add() and restore(), in the order of the summary
+ARCHIVED = 'archived'
+RESTORED = 'restored'
+EXISTS = 'already exists'
+MISSING = 'not found'
+FAILED = 'failed'
+
+RESULTS_REF = 'refs/results'
+
+
+class Archive:
+    def __init__(self, args):
+        self.args = args
+        self.path = os.path.abspath(f'{args.project}-archive.git')
+
+
+    @staticmethod
+    def make_ref(repo):
+        return f'refs/snapshots/{repo.student}/{repo.suffix or CURRENT}'
+
+
+    def get_head(self, path):
+        try:
+            return GitReader(path).head()
+        except READ_ERRORS:
+            return cmd_exec_capture(['git', 'rev-parse', 'HEAD'], wd=path, capture_stderr=False)
+
+
+    def create(self):
+        if not os.path.isdir(self.path):
+            cmd_exec_rc(['git', 'init', '--quiet', '--bare', self.path])
+
+
+    def add(self, repo):
+        # Fetch the repo's checked out commit into the archive
+        local = repo.root_path
+        if not os.path.isdir(local):
+            print_yellow('Not found')
+            print()
+            return MISSING
+        self.create()
+        sha = self.get_head(local)
+        ref = self.make_ref(repo)
+        # --update-shallow, since shallow clones would otherwise be rejected,
+        # while git fetch still exits with 0
+        cmd = ['git', 'fetch', '--quiet', '--no-tags', '--update-shallow',
+               os.path.abspath(local), f'+HEAD:{ref}']
+        presults = cmd_exec(cmd, wd=self.path, check=False, timeout=ARCHIVE_TIMEOUT)
+        stored = cmd_exec(['git', 'rev-parse', '--verify', '--quiet', ref], wd=self.path,
+                          check=False, capture_stderr=False).stdout.strip()
+        if presults.returncode != 0 or stored != sha:
+            print_red(presults.stdout.strip() or f'{ref} was not stored')
+            print()
+            return FAILED
+        status = cmd_exec_capture(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                  wd=local, capture_stderr=False)
+        if status:
+            # Only commits are archived
+            print_yellow('uncommitted changes not archived ')
+        print(f'{ref} {sha[:7]}')
+        return ARCHIVED
+
+
+    def add_results(self):
+        """
+        Commit the class's result JSON files under refs/results, on top of
+        the ones from earlier archive runs
+        """
+        names = sorted(set(glob.glob(f'{self.args.project}.json') +
+                           glob.glob(f'{self.args.project}-*.json')))
+        if not names:
+            return
+        self.create()
+        shas = cmd_exec_capture(['git', 'hash-object', '-w', '--'] + [os.path.abspath(n) for n in names],
+                                wd=self.path).split()
+        tree_lines = ''.join(f'100644 blob {sha}\t{name}\n' for sha, name in zip(shas, names))
+        tree = subprocess.run(['git', 'mktree'], cwd=self.path, input=tree_lines, capture_output=True,
+                              text=True, check=True).stdout.strip()
+        # The grading server may not have a git identity
+        cmd = ['git', '-c', 'user.name=grade', '-c', 'user.email=grade@localhost',
+               'commit-tree', tree, '-m', 'Results']
+        parent = cmd_exec_capture(['git', 'rev-parse', '--verify', '--quiet', RESULTS_REF],
+                                  wd=self.path, capture_stderr=False)
+        if parent:
+            cmd += ['-p', parent]
+        commit = cmd_exec_capture(cmd, wd=self.path)
+        cmd_exec_rc(['git', 'update-ref', RESULTS_REF, commit], wd=self.path)
+        print(f'{RESULTS_REF}: ' + ' '.join(names))
+
+
+    def pack(self):
+        # One pack, with the history shared between snapshots stored once
+        cmd_exec_rc(['git', 'repack', '-a', '-d', '-q'], wd=self.path, timeout=ARCHIVE_TIMEOUT)
+        cmd_exec_rc(['git', 'prune-packed'], wd=self.path, timeout=ARCHIVE_TIMEOUT)
+
+
+    def restore(self, repo):
+        """
+        Check out the repo's snapshot as a worktree of the archive, where it
+        was when it was archived. Repos which are already there are left alone
+        """
+        local = repo.root_path
+        if os.path.isdir(local):
+            print('Already exists: ' + local)
+            return EXISTS
+        ref = self.make_ref(repo)
+        cmd = ['git', 'rev-parse', '--verify', '--quiet', ref + '^{commit}']
+        sha = cmd_exec_capture(cmd, wd=self.path, capture_stderr=False) if os.path.isdir(self.path) else ''
+        if not sha:
+            print_yellow(f'{ref} not in archive')
+            print()
+            return MISSING
+        # Remove the records of worktrees which were deleted
+        cmd_exec_rc(['git', 'worktree', 'prune'], wd=self.path)
+        cmd = ['git', 'worktree', 'add', '--quiet', '--detach', os.path.abspath(local), sha]
+        if cmd_exec_rc(cmd, wd=self.path) != 0:
+            print_red('git worktree add failed')
+            return FAILED
+        print(f'{ref} {sha[:7]}')
+        return RESTORED
+
+
+    def restore_results(self):
+        # Bring back any result JSON files which aren't here
+        if not os.path.isdir(self.path):
+            return
+        cmd = ['git', 'ls-tree', '--name-only', RESULTS_REF]
+        presults = cmd_exec(cmd, wd=self.path, check=False, capture_stderr=False)
+        if presults.returncode != 0:
+            return
+        for name in presults.stdout.split():
+            if not os.path.exists(name):
+                # Straight to the file, since results can be larger than
+                # cmd_exec()'s output limit
+                with open(name, 'wb') as f:
+                    subprocess.run(['git', 'cat-file', 'blob', f'{RESULTS_REF}:{name}'], cwd=self.path,
+                                   stdout=f, check=True)
+                print(name)
+
+
+    @staticmethod
+    def format_summary(statuses):
+        # statuses from add() or restore(), with None for exceptions
+        counts = Counter(FAILED if s is None else s for s in statuses)
+        order = [ARCHIVED, RESTORED, EXISTS, MISSING, FAILED]
+        return ', '.join(f'{s}: {counts[s]}' for s in order if counts[s])
@@ -0,0 +1,315 @@
+"""
+cache.py remembers test case results on disk, keyed by everything which
+can change them: the git tree of the student's repo, the test case and
+[project] settings, and the files in the tests repo. Re-grading a class
+only re-runs the test cases whose inputs changed. It also remembers each
+repo's build, so we don't build a repo again when its source hasn't changed,
+and the responses from Canvas and GitHub, so we don't download them again
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+from .cmd import cmd_exec_capture
+from .util import cache_path
+
+
+def tree_hash(repo_path):
+    """
+    Return the git tree hash of repo_path (which may be a subdir of the
+    repo), or None if it's not a git repo or has uncommitted changes to
+    tracked files, since then the tree hash doesn't describe what we'd test
+    """
+    try:
+        tree = cmd_exec_capture(['git', 'rev-parse', 'HEAD:./'], wd=repo_path, capture_stderr=False)
+        status = cmd_exec_capture(['git', 'status', '--porcelain', '--untracked-files=no', '.'],
+                                  wd=repo_path, capture_stderr=False)
+    except (OSError, UnicodeDecodeError):
+        return None
+    if status or len(tree) != 40:
+        return None
+    return tree
+
+
+def dir_digest(path, exclude=()):
+    # Hash the names and contents of all the files under path
+    h = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted(d for d in dirnames if d != '.git')
+        for name in sorted(filenames):
+            file_path = os.path.join(dirpath, name)
+            rel_path = os.path.relpath(file_path, path)
+            if rel_path in exclude:
+                continue
+            h.update(rel_path.encode() + b'\0')
+            with open(file_path, 'rb') as f:
+                for block in iter(lambda: f.read(65536), b''):
+                    h.update(block)
+            h.update(b'\0')
+    return h.hexdigest()
+
+
+# [project] settings which can change a test case's result. The others,
+# like parallel_tests and kill_grace, only change how it's run
+RESULT_SETTINGS = [
+    'build', 'strip_output', 'subdir', 'timeout', 'capture_stderr', 'decode_errors',
+    'fail_fast', 'rlimit_as', 'rlimit_cpu', 'rlimit_fsize', 'rlimit_nproc',
+]
+
+
+class ResultCache:
+    def __init__(self, project_cfg, fixtures_digest):
+        self.project_cfg = project_cfg
+        self.fixtures_digest = fixtures_digest
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+
+    def make_key(self, tree, test_case):
+        d = {
+            'tree': tree,
+            'cmd_line': test_case.cmd_line,
+            'test_case': test_case.tc_cfg.__dict__,
+            'project': {name: getattr(self.project_cfg, name, None) for name in RESULT_SETTINGS},
+            'fixtures': self.fixtures_digest,
+        }
+        s = json.dumps(d, sort_keys=True, default=str)
+        return hashlib.sha256(s.encode()).hexdigest()
+
+
+    def get_path(self, key):
+        return cache_path('results', key[:2], key + '.json')
+
+
+    def get(self, tree, test_case):
+        path = self.get_path(self.make_key(tree, test_case))
+        try:
+            with open(path) as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            result = None
+        with self.lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+
+    def put(self, tree, test_case, result):
+        path = self.get_path(self.make_key(tree, test_case))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so that a concurrent or interrupted run never
+        # reads half a result
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}'
+        with open(tmp, 'w') as f:
+            json.dump(result, f)
+        os.replace(tmp, path)
+
+
+    def format_stats(self):
+        return f'Result cache: {self.hits} hits, {self.misses} misses'
+
+
+def git_files(repo_path, *flags):
+    # List files under repo_path, relative to it, using git ls-files
+    try:
+        output = cmd_exec_capture(['git', 'ls-files', '-z', *flags], wd=repo_path,
+                                  capture_stderr=False)
+    except (OSError, UnicodeDecodeError):
+        return None
+    return [name for name in output.split('\0') if name]
+
+
+def source_hash(repo_path):
+    """
+    Hash the contents of the files git tracks in repo_path, including
+    uncommitted changes, or return None if it's not a git repo
+    """
+    names = git_files(repo_path)
+    if not names:
+        return None
+    h = hashlib.sha256()
+    for name in sorted(names):
+        h.update(name.encode() + b'\0')
+        try:
+            with open(os.path.join(repo_path, name), 'rb') as f:
+                for block in iter(lambda: f.read(65536), b''):
+                    h.update(block)
+        except OSError:
+            # Deleted, or a directory like a submodule
+            h.update(b'\1')
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def untracked_files(repo_path, exclude=()):
+    # Map each untracked file, including ignored ones, to its size and mtime
+    files = {}
+    for name in git_files(repo_path, '--others') or []:
+        if os.path.normpath(name) in exclude:
+            continue
+        try:
+            st = os.stat(os.path.join(repo_path, name))
+        except OSError:
+            continue
+        files[name] = [st.st_size, st.st_mtime_ns]
+    return files
+
+
+class BuildCache:
+    """
+    Remembers the outcome of building each repo, along with a hash of its
+    source and the untracked files (build products) present afterward.
+    If the source hasn't changed and the untracked files are just as the
+    build left them, we can skip the build and reuse its outcome
+    """
+    def __init__(self, project_cfg, exclude=()):
+        self.project_cfg = project_cfg
+        # Files written by test cases, which would look like changed
+        # build products
+        self.exclude = set(os.path.normpath(p) for p in exclude)
+        self.skipped = 0
+        self.saved = 0.0
+        self.lock = threading.Lock()
+
+
+    def get_path(self, repo_path):
+        key = hashlib.sha256(os.path.abspath(repo_path).encode()).hexdigest()
+        return cache_path('builds', key + '.json')
+
+
+    def make_plan(self):
+        return {'build': self.project_cfg.build, 'timeout': self.project_cfg.build_timeout}
+
+
+    def lookup(self, repo_path):
+        """
+        Return the source hash of repo_path, and the recorded build outcome
+        if the build can be skipped, otherwise None
+        """
+        src_hash = source_hash(repo_path)
+        if src_hash is None:
+            return None, None
+        try:
+            with open(self.get_path(repo_path)) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return src_hash, None
+        if record.get('source') != src_hash or record.get('plan') != self.make_plan():
+            return src_hash, None
+        # Any change to the untracked files, including new ones like an
+        # untracked source file the build would pick up, means building again
+        if untracked_files(repo_path, self.exclude) != record['artifacts']:
+            return src_hash, None
+        with self.lock:
+            self.skipped += 1
+            self.saved += record['seconds']
+        return src_hash, record
+
+
+    def record(self, repo_path, src_hash, build_err, seconds):
+        record = {
+            'source': src_hash,
+            'plan': self.make_plan(),
+            'build_err': build_err,
+            'artifacts': untracked_files(repo_path, self.exclude),
+            'seconds': round(seconds, 3),
+        }
+        path = self.get_path(repo_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}'
+        with open(tmp, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp, path)
+
+
+    def format_stats(self):
+        return f'Build cache: skipped {self.skipped} builds, saved {self.saved:.1f}s'
+
+
+class HttpCache:
+    """
+    Remembers JSON responses to GET requests with their ETag and
+    Last-Modified headers, so a request can ask the server whether the
+    response changed (If-None-Match, If-Modified-Since). A "304 Not
+    Modified" has no body, and doesn't count against GitHub's rate limit.
+    Responses younger than ttl seconds are used without asking at all
+    """
+    def __init__(self, ttl=0):
+        self.ttl = ttl
+        self.fresh = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+
+    def make_key(self, url, headers):
+        # The token is part of the key, since it decides what we may see
+        d = {'url': url, 'accept': headers.get('Accept'), 'auth': headers.get('Authorization')}
+        s = json.dumps(d, sort_keys=True)
+        return hashlib.sha256(s.encode()).hexdigest()
+
+
+    def get_path(self, key):
+        return cache_path('http', key[:2], key + '.json')
+
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+    def get(self, url, headers, ttl=None):
+        """
+        Return (entry, fresh), where entry is the cached response for url,
+        or None, and fresh is True if it can be used without revalidating
+        """
+        key = self.make_key(url, headers)
+        try:
+            with open(self.get_path(key)) as f:
+                entry = json.load(f)
+            age = time.time() - entry['time']
+        except (OSError, ValueError, KeyError):
+            return None, False
+        ttl = self.ttl if ttl is None else ttl
+        fresh = age < ttl
+        if fresh:
+            self.count('fresh')
+        return entry, fresh
+
+
+    def add_conditions(self, entry, headers):
+        # Ask the server to send the body only if it has changed
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+
+    def not_modified(self, url, headers, entry):
+        # The server says entry is still good, so start its ttl again
+        self.count('revalidated')
+        self.put(url, headers, entry['etag'], entry['last_modified'], entry['body'])
+
+
+    def put(self, url, headers, etag, last_modified, body):
+        if not etag and not last_modified and not self.ttl:
+            # Nothing to revalidate with
+            return
+        entry = {'url': url, 'etag': etag, 'last_modified': last_modified,
+                 'time': time.time(), 'body': body}
+        path = self.get_path(self.make_key(url, headers))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}'
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, path)
+
+
+    def format_stats(self):
+        return f'HTTP cache: {self.fresh} fresh, {self.revalidated} not modified, {self.misses} misses'
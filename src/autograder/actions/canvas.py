@@ -2,7 +2,7 @@ import csv
 from pathlib import Path
 
 from .util import *
-from .server import Server
+from .server import Server, ServerConfig
 
 class CanvasMapperConfig(SafeConfig):
     def __init__(self, cfg):
@@ -48,12 +48,12 @@ class CanvasMapper:
         return github_list
 
 
-class CanvasConfig(SafeConfig):
+class CanvasConfig(ServerConfig):
     def __init__(self, cfg):
         self.host_name = 'usfca.test.instructure.com or canvas.instructure.com'
         self.access_token = 'your access token here'
         self.course_name = 'e.g. Computer Architecture - 01 (Spring 2022)'
-        self.safe_update(cfg)
+        super().__init__(cfg)
 
 
 # Handles GET and PUT of scores to Canvas
@@ -61,7 +61,8 @@ class Canvas(Server):
 
     def __init__(self, canvas_cfg, args):
         self.canvas_cfg = CanvasConfig(canvas_cfg)
-        super().__init__(self.canvas_cfg.host_name, self.canvas_cfg.access_token, args.verbose)
+        super().__init__(self.canvas_cfg.host_name, self.canvas_cfg.access_token, args.verbose,
+                         self.canvas_cfg, cache=not args.no_cache)
         self.scores = []
         self.args = args
 
@@ -79,7 +80,8 @@ class Canvas(Server):
     # Download the grade for the specified course/assignment/student
     def get_submission(self, course_id, assignment_id, student_id):
         url = self.make_submission_url(course_id, assignment_id, student_id)
-        obj = self.get_url(url)  # Let any exception propagate
+        # Always ask Canvas, since we compare it with the score to upload
+        obj = self.get_url(url, ttl=0)  # Let any exception propagate
         return obj['score']
 
 
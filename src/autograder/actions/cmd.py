@@ -1,21 +1,46 @@
 import atexit
-import io
+import codecs
+import errno
+import itertools
 import os
+import resource
 import select
+import selectors
+import shlex
 import shutil
 import signal
 import subprocess
 import sys
+import threading
 import time
 
-from .util import OutputLimitExceeded
+from .util import OutputDiverged, OutputLimitExceeded
 
 # default command timeout in seconds
 TIMEOUT = 60
 # default output limit in bytes
 OUTPUT_LIMIT = 220000
 # read buffer size
-READ_BUFFER_SIZE = 1024
+READ_BUFFER_SIZE = 65536
+# how often to check for process exit when pidfd_open() is not available
+POLL_INTERVAL = 0.05
+# default seconds to wait after SIGTERM before escalating to SIGKILL
+KILL_GRACE = 1.0
+# resource limits which can be applied to a test program, by config name
+RLIMITS = {
+    'rlimit_as': resource.RLIMIT_AS,
+    'rlimit_cpu': resource.RLIMIT_CPU,
+    'rlimit_fsize': resource.RLIMIT_FSIZE,
+    'rlimit_nproc': resource.RLIMIT_NPROC,
+}
+# ulimit's options for each resource, and the bytes in the unit it takes.
+# bash calls the process limit -u and dash calls it -p
+ULIMIT_OPTIONS = {
+    resource.RLIMIT_AS: (['v'], 1024),
+    resource.RLIMIT_CPU: (['t'], 1),
+    resource.RLIMIT_FSIZE: (['f'], 512),
+    resource.RLIMIT_NPROC: (['u', 'p'], 1),
+}
 
 
 # Wrapper to return values from cmd_exec
@@ -26,36 +51,400 @@ class ProcResults(object):
         self.stderr = stderr
 
 global_cleanup_registered = False
-global_cleanup_gpid = None
+
+# Registry of the process groups we've started which may still have live
+# processes, mapped to the cgroup for each one, if any. Tests may run
+# concurrently, so access is guarded by a lock
+live_groups = {}
+live_groups_lock = threading.Lock()
+
+# Parent of the per-command cgroups, created on first use
+cgroup_parent = None
+cgroup_parent_lock = threading.Lock()
+cgroup_counter = itertools.count()
 
 
 # Handler to be called on process exit (e.g., CTRL-C)
 def cmd_cleanup():
-    global global_cleanup_registered
-    global global_cleanup_gpid
-
     # Only kill process group on POSIX systems
     if os.name != 'posix':
         return
 
-    if global_cleanup_gpid:
+    with live_groups_lock:
+        groups = list(live_groups.items())
+    for pgid, cgroup in groups:
         try:
-            os.killpg(global_cleanup_gpid, signal.SIGTERM)
+            os.killpg(pgid, signal.SIGTERM)
         except ProcessLookupError:
             pass
+    for pgid, cgroup in groups:
+        release_group(pgid, cgroup)
+    if cgroup_parent:
+        try:
+            os.rmdir(cgroup_parent)
+        except OSError:
+            pass
 
 
-def cmd_exec(args, wd=None, shell=False, check=True, timeout=TIMEOUT,
-             output_limit=OUTPUT_LIMIT, capture_stderr=True):
-    presults = ProcResults(0, None, None)
+def find_cgroup_parent():
+    """
+    Find our own cgroup v2 directory and make a child of it to hold the
+    per-command cgroups. Returns None if cgroup v2 isn't mounted or we
+    don't have permission to create cgroups
+    """
+    try:
+        with open('/proc/self/mounts') as f:
+            mounts = [line.split() for line in f]
+        with open('/proc/self/cgroup') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    root = next((m[1] for m in mounts if m[2] == 'cgroup2'), None)
+    own = next((l[3:] for l in lines if l.startswith('0::')), None)
+    if root is None or own is None:
+        return None
+    path = os.path.join(root, own.lstrip('/'), f'autograder-{os.getpid()}')
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError:
+        return None
+    if not os.access(os.path.join(path, 'cgroup.procs'), os.W_OK):
+        return None
+    return path
+
+
+def make_cgroup():
+    # Make a new cgroup for one command, or None if cgroups are unavailable
+    global cgroup_parent
+    with cgroup_parent_lock:
+        if cgroup_parent is None:
+            cgroup_parent = find_cgroup_parent() or ''
+    if not cgroup_parent:
+        return None
+    path = os.path.join(cgroup_parent, f'cmd-{next(cgroup_counter)}')
+    try:
+        os.mkdir(path)
+    except OSError:
+        return None
+    return path
+
+
+def cgroup_pids(cgroup):
+    try:
+        with open(os.path.join(cgroup, 'cgroup.procs')) as f:
+            return [int(pid) for pid in f.read().split()]
+    except OSError:
+        return []
+
+
+def kill_cgroup(cgroup):
+    # cgroup.kill (Linux 5.14+) kills everything atomically, even processes
+    # which are forking, otherwise fall back to killing pids one at a time
+    try:
+        with open(os.path.join(cgroup, 'cgroup.kill'), 'w') as f:
+            f.write('1')
+    except OSError:
+        for pid in cgroup_pids(cgroup):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
 
+def register_group(pgid, cgroup):
     global global_cleanup_registered
-    global global_cleanup_gpid
+    with live_groups_lock:
+        # Only register cmd_cleanup() once
+        if not global_cleanup_registered:
+            global_cleanup_registered = True
+            atexit.register(cmd_cleanup)
+        live_groups[pgid] = cgroup
 
-    # Only register cmd_cleanup() once 
-    if not global_cleanup_registered:
-        global_cleanup_registered = True    
-        atexit.register(cmd_cleanup)
+
+def release_group(pgid, cgroup):
+    """
+    Kill any processes left in the process group, or in its cgroup, after
+    the command has finished and been reaped. These are background or
+    daemonized processes that would otherwise keep running for the rest of
+    the run. Returns how many of them there were
+    """
+    with live_groups_lock:
+        live_groups.pop(pgid, None)
+    # Usually nothing is left, so don't scan /proc unless the group exists
+    leaked = set(group_members(pgid) or []) if group_exists(pgid) else set()
+    if cgroup:
+        leaked.update(cgroup_pids(cgroup))
+    if leaked:
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    if cgroup:
+        kill_cgroup(cgroup)
+        # The cgroup can only be removed once the killed processes are gone
+        deadline = time.monotonic() + KILL_GRACE
+        while cgroup_pids(cgroup) and time.monotonic() < deadline:
+            time.sleep(0.001)
+        try:
+            os.rmdir(cgroup)
+        except OSError:
+            pass
+    return len(leaked)
+
+
+def open_pidfd(pid):
+    # A pidfd becomes readable when the process exits (Linux 5.3+), which
+    # lets us wait for output and process exit in the same select()
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
+def group_members(pgid):
+    """
+    Return the pids of the live (non-zombie) processes in the process
+    group, or None if /proc isn't available to tell us
+    """
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return None
+    pids = []
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'rb') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # comm is in parens and may contain spaces, so split after it
+        fields = stat[stat.rindex(b')') + 2:].split()
+        if fields[0] != b'Z' and int(fields[2]) == pgid:
+            pids.append(int(entry))
+    return pids
+
+
+def group_exists(pgid):
+    # Even if only zombies are left in it
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def group_alive(pgid):
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    # killpg() also succeeds when only zombies are left in the group
+    members = group_members(pgid)
+    return members is None or len(members) > 0
+
+
+def reap(proc, usage=None, block=False):
+    """
+    Replacement for proc.poll() which uses wait4() so we can record the
+    program's resource usage in the usage dict, if given
+    """
+    if proc.returncode is None:
+        try:
+            pid, status, ru = os.wait4(proc.pid, 0 if block else os.WNOHANG)
+        except ChildProcessError:
+            return proc.returncode
+        if pid == proc.pid:
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            if usage is not None:
+                usage.update({
+                    'utime'     : round(ru.ru_utime, 3),
+                    'stime'     : round(ru.ru_stime, 3),
+                    'maxrss_kb' : ru.ru_maxrss,
+                })
+    return proc.returncode
+
+
+def wait_reap(proc, timeout, usage=None):
+    # Like proc.wait(timeout), but via reap()
+    deadline = time.monotonic() + timeout
+    delay = 0.001
+    while reap(proc, usage) is None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, POLL_INTERVAL)
+    return proc.returncode
+
+
+def wait_for_group(proc, pidfd, timeout, usage=None):
+    """
+    Wait up to timeout seconds for every process in proc's group to exit,
+    reaping proc as soon as it exits. Returns True if the group is gone
+    """
+    deadline = time.monotonic() + timeout
+    if pidfd is not None and reap(proc, usage) is None:
+        # Sleep until the leader exits, which is usually the whole group
+        select.select([pidfd], [], [], timeout)
+    delay = 0.001
+    while True:
+        reap(proc, usage)
+        if not group_alive(proc.pid):
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, POLL_INTERVAL)
+
+
+def kill_process_group(proc, pidfd=None, grace=KILL_GRACE, usage=None):
+    """
+    Send SIGTERM to proc's process group, escalating to SIGKILL for any
+    processes still running after grace seconds, and reap proc. Returns
+    the number of seconds teardown took
+    """
+    start = time.monotonic()
+    # start_new_session=True makes proc the group leader, so its pid is
+    # the pgid, even after proc has been reaped
+    pgid = proc.pid
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        try:
+            os.killpg(pgid, sig)
+        except ProcessLookupError:
+            break
+        if wait_for_group(proc, pidfd, grace, usage):
+            break
+    # Other processes in the group were reparented, so proc is the only
+    # one we need to reap
+    wait_reap(proc, grace, usage)
+    return time.monotonic() - start
+
+
+def make_limits(rlimits):
+    # Turn rlimits (a dict of config name to limit) into (resource, limit)
+    limits = []
+    for name, value in (rlimits or {}).items():
+        if value is None:
+            continue
+        res = RLIMITS[name]
+        soft, hard = resource.getrlimit(res)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        if res == resource.RLIMIT_CPU and value != hard:
+            # Leave room for SIGXCPU at the soft limit before SIGKILL
+            limits.append((res, (value, value + 1)))
+        else:
+            limits.append((res, (value, value)))
+    return limits
+
+
+def set_limits(limits):
+    """
+    Return a shell command which applies limits with ulimit, the soft limit
+    first so that it's never above the hard limit. ulimit takes some limits
+    in KB or 512-byte blocks, so those are rounded down
+    """
+    steps = []
+    for res, (soft, hard) in limits:
+        options, unit = ULIMIT_OPTIONS[res]
+        for kind, value in [('S', soft), ('H', hard)]:
+            steps.append(' || '.join(f'ulimit -{kind} -{o} {value // unit}' for o in options))
+    return f'{{ {"; ".join(steps)}; }} 2>/dev/null'
+
+
+def join_cgroup(cgroup):
+    """
+    Return a shell command which moves the shell into cgroup. Writing 0 to
+    cgroup.procs moves the writing process. If that fails, e.g. with EBUSY
+    when the parent cgroup is threaded, the command runs outside the cgroup
+    """
+    procs_path = shlex.quote(os.path.join(cgroup, 'cgroup.procs'))
+    return f'{{ echo 0 > {procs_path}; }} 2>/dev/null'
+
+
+def check_program(program, wd):
+    """
+    Raise FileNotFoundError or PermissionError if program can't be run, as
+    Popen() would. Otherwise the exec wrapper's shell reports it, and its
+    message looks like the program's output
+    """
+    if os.sep in program:
+        path = os.path.join(wd or '.', program)
+        if not os.path.exists(path):
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), program)
+        if os.path.isdir(path) or not os.access(path, os.X_OK):
+            raise PermissionError(errno.EACCES, os.strerror(errno.EACCES), program)
+    elif shutil.which(program) is None:
+        raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), program)
+
+
+def wrap_command(args, shell, wd, setup):
+    """
+    Return Popen args and shell for running the shell commands in setup,
+    then exec'ing args in the same process. This prepares the program
+    before it can fork, without a preexec_fn, which isn't safe when we're
+    running threads
+    """
+    if shell:
+        args = ['/bin/sh', '-c', args]
+    else:
+        check_program(args[0], wd)
+    script = '; '.join(setup + ['exec "$@"'])
+    return ['/bin/sh', '-c', script, 'sh'] + list(args), False
+
+
+def read_available(fd, buf, n):
+    """
+    Read from the non-blocking fd into the bytearray buf, starting at n,
+    until the pipe is empty or buf is full. Returns the new length of the
+    data in buf and whether we reached EOF
+    """
+    view = memoryview(buf)
+    try:
+        while n < len(buf):
+            try:
+                cur_len = os.readv(fd, [view[n:n + READ_BUFFER_SIZE]])
+            except BlockingIOError:
+                return n, False
+            if cur_len == 0:
+                return n, True
+            n += cur_len
+        return n, False
+    finally:
+        view.release()
+
+
+def decode_output(data, errors='strict'):
+    # Decode the captured bytes once, at the end, so that multibyte
+    # characters which straddle two reads are decoded correctly
+    decoder = codecs.getincrementaldecoder('utf-8')(errors=errors)
+    return decoder.decode(data, final=True)
+
+
+def cmd_exec(args, wd=None, shell=False, check=True, timeout=TIMEOUT,
+             output_limit=OUTPUT_LIMIT, capture_stderr=True, decode_errors='strict',
+             kill_grace=KILL_GRACE, rlimits=None, usage=None, use_cgroup=False,
+             on_output=None):
+    """
+    Run args, capturing stdout (and stderr unless capture_stderr is False)
+    until the program exits. If usage is a dict, the program's wall time,
+    CPU time and max RSS are recorded in it, even if it times out, along
+    with the number of leaked processes we killed after it exited. With
+    use_cgroup, the program runs in its own cgroup if cgroup v2 is
+    available, so we can find processes which escape the process group.
+    on_output is called with each chunk of bytes as it's read, and may
+    raise OutputDiverged to stop the program early
+    """
+    presults = ProcResults(0, None, None)
+    if usage is None:
+        usage = {}
 
     # stderr
     if capture_stderr:
@@ -63,62 +452,114 @@ def cmd_exec(args, wd=None, shell=False, check=True, timeout=TIMEOUT,
     else:
         stderr=subprocess.DEVNULL
     
+    cgroup = make_cgroup() if use_cgroup and os.name == 'posix' else None
+    setup = [join_cgroup(cgroup)] if cgroup else []
+    limits = make_limits(rlimits)
+    if limits:
+        # In the child, before the program runs, so it can't fork or
+        # allocate its way past them
+        setup.append(set_limits(limits))
+    # The kernel counts the RSS we had when the child was forked, up to the
+    # time it ran the program, as the program's own
+    inherited_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.monotonic()
     try:
-        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=stderr, 
-                             start_new_session=True, cwd=wd, shell=shell)
+        popen_args, popen_shell = wrap_command(args, shell, wd, setup) if setup else (args, shell)
+        proc = subprocess.Popen(popen_args, stdout=subprocess.PIPE, stderr=stderr, 
+                             start_new_session=True, cwd=wd, shell=popen_shell)
+    except Exception:
+        if cgroup:
+            os.rmdir(cgroup)
+        raise
+    # start_new_session=True makes the pid the pgid
+    register_group(proc.pid, cgroup)
+    deadline = start + timeout
 
-        #os.set_blocking(proc.stdout.fileno(), False)
-        #os.set_blocking(proc.stderr.fileno(), False)
-        global_cleanup_gpid = os.getpgid(proc.pid)
-        timer = time.time() + timeout
-        
-        buf = io.StringIO()
-        total_bytes = 0;
+    # One extra byte so we can tell when output_limit has been exceeded
+    buf = bytearray(output_limit + 1)
+    total_bytes = 0
 
-        fd = proc.stdout.fileno()
+    fd = proc.stdout.fileno()
+    os.set_blocking(fd, False)
+    pidfd = open_pidfd(proc.pid)
+    sel = selectors.DefaultSelector()
+    sel.register(fd, selectors.EVENT_READ)
+    if pidfd is not None:
+        sel.register(pidfd, selectors.EVENT_READ)
 
-        while True:
-            if proc.poll() is not None:
-                break
-            if time.time() > timer:
+    def read_more():
+        nonlocal total_bytes
+        prev = total_bytes
+        total_bytes, eof = read_available(fd, buf, total_bytes)
+        if on_output and total_bytes > prev:
+            on_output(bytes(buf[prev:total_bytes]))
+        return eof
+
+    try:
+        eof = False
+        exited = False
+        # Sleep in select() until there's output, the process exits, or
+        # the timeout expires. Without a pidfd, EOF on stdout is the usual
+        # sign of exit, so we only need to poll if a child holds the pipe
+        while total_bytes <= output_limit:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
                 raise subprocess.TimeoutExpired(args, timeout)
-            if total_bytes > output_limit:
+            if eof and exited:
+                break
+            if eof and pidfd is None:
+                # The pipe is closed, so just wait for the process
+                if wait_reap(proc, remaining, usage) is None:
+                    raise subprocess.TimeoutExpired(args, timeout)
                 break
+            if exited:
+                # Grab remaining bytes off stdout, if any, without waiting
+                # on background processes which still hold the pipe open
+                eof = read_more()
+                break
+
+            wait = remaining if pidfd is not None else min(remaining, POLL_INTERVAL)
+            for key, _ in sel.select(wait):
+                if key.fd == fd:
+                    eof = read_more()
+                    if eof:
+                        sel.unregister(fd)
+                else:
+                    exited = True
+            if pidfd is None and reap(proc, usage) is not None:
+                exited = True
 
-            selres = select.select([fd], [], [], 1.0)
-            if selres[0] and selres[0][0] == fd:
-                cur_len = len(proc.stdout.peek(READ_BUFFER_SIZE))
-                cur_bytes = proc.stdout.read(cur_len)
-                cur_data = cur_bytes.decode('utf-8')
-            else:
-                cur_data = ''
-            
-            if cur_data != '':
-                total_bytes += len(cur_data)
-                buf.write(cur_data)
-
-        # Grab remaing bytes off stdout, if any
-        selres = select.select([fd], [], [], 1.0)
-        if selres[0] and selres[0][0] == fd:
-            cur_len = len(proc.stdout.peek(READ_BUFFER_SIZE))
-            cur_bytes = proc.stdout.read(cur_len)
-            cur_data = cur_bytes.decode('utf-8')
-            total_bytes += len(cur_data)
-            buf.write(cur_data)
-
-        presults.stdout = buf
+        if total_bytes <= output_limit:
+            presults.stdout = decode_output(memoryview(buf)[:total_bytes], decode_errors)
+        elif os.name == 'posix' and reap(proc, usage) is None:
+            # Don't leave a runaway program spinning after we stop reading
+            kill_process_group(proc, pidfd, kill_grace, usage)
         presults.stderr = None
-        presults.returncode = proc.returncode
+        presults.returncode = reap(proc, usage, block=(total_bytes <= output_limit))
 
-    except subprocess.TimeoutExpired:
+    except subprocess.TimeoutExpired as e:
         if os.name == 'posix':
-            pgid = os.getpgid(proc.pid)
-            os.killpg(pgid, signal.SIGTERM)
-            # Delay to allow processes to exit
-            time.sleep(3)
-            # This can only wait for the parent of the process group
-            os.waitpid(-pgid, os.WNOHANG)
+            # Let callers report how long it took to kill the program
+            e.teardown_time = kill_process_group(proc, pidfd, kill_grace, usage)
+        raise
+    except OutputDiverged as e:
+        # The output can't match any more, so don't wait for the program
+        if os.name == 'posix':
+            kill_process_group(proc, pidfd, kill_grace, usage)
+        e.output = decode_output(memoryview(buf)[:total_bytes], 'replace')
         raise
+    finally:
+        usage['wall'] = round(time.monotonic() - start, 3)
+        if usage.get('maxrss_kb') is not None and usage['maxrss_kb'] <= inherited_rss:
+            # The program's own peak was no more than ours, but how much
+            # less, we can't tell
+            usage['maxrss_kb'] = None
+        if os.name == 'posix':
+            usage['leaked'] = release_group(proc.pid, cgroup)
+        sel.close()
+        if pidfd is not None:
+            os.close(pidfd)
+        proc.stdout.close()
 
     # Raise exception if output_limit exceeded        
     if total_bytes > output_limit:
@@ -134,17 +575,21 @@ def cmd_exec_rc(args, wd=None, timeout=TIMEOUT, capture_stderr=True):
 
 
 def cmd_exec_capture(args, wd=None, path=None, shell=False, timeout=TIMEOUT,
-                     capture_stderr=True):
+                     capture_stderr=True, decode_errors='strict', kill_grace=KILL_GRACE,
+                     rlimits=None, usage=None, use_cgroup=False, on_output=None,
+                     output_limit=OUTPUT_LIMIT):
     presults = cmd_exec(args, wd=wd, shell=shell, check=True, timeout=timeout,
-                        capture_stderr=capture_stderr)
+                        output_limit=output_limit,
+                        capture_stderr=capture_stderr, decode_errors=decode_errors,
+                        kill_grace=kill_grace, rlimits=rlimits, usage=usage,
+                        use_cgroup=use_cgroup, on_output=on_output)
     if (path):
         # capture output written to path
         with open(path, 'r') as f:
             return f.read()
     else:
         # capture output written to stdout or stderr
-        output = presults.stdout if presults.stdout else presults.stderr
+        output = presults.stdout if presults.stdout is not None else presults.stderr
 
         if output is not None:
-            #return output.decode('utf-8').rstrip('\n')
-            return output.getvalue().rstrip('\n')
+            return output.rstrip('\n')
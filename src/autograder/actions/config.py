@@ -19,20 +19,32 @@ class Args:
     def from_cmdline():
         p = argparse.ArgumentParser()
         p.add_argument('action', type=str, choices=[
-            'class', 'clone', 'exec', 'pull', 'rollup', 'test', 'upload'
+            'archive', 'class', 'clone', 'exec', 'mirror', 'pull', 'restore', 'rollup', 'test', 'upload'
         ])
+        p.add_argument('--all-dates', action='store_true', help='With class, grade every date in dates.toml in one pass. With archive or restore, every date',
+            default=False)
         p.add_argument('-d', '--by-date', action='store_true', help='Select date from dates.toml',
             default=False)
         p.add_argument('-e', '--exec_cmd', help='Command to execute in each repo',
             default=None)
         p.add_argument('-g', '--github-action', action='store_true', help='test by downloading Github Action result',
             default=False)
+        p.add_argument('--git-jobs', type=int, help='Number of concurrent git operations',
+            default=4)
+        p.add_argument('-j', '--jobs', type=int, help='Number of repos to grade concurrently',
+            default=1)
+        p.add_argument('--no-cache', action='store_true', help='Build every repo and run every test case, ignoring results cached by earlier runs',
+            default=False)
         p.add_argument('-n', '--test-name', help='Run test case with this name',
             default=None)
         p.add_argument('-p', '--project', help='Project name',
             default=project_from_cwd(Path.cwd()))
+        p.add_argument('--pipeline', action='store_true', help='With class, clone or pull each repo and grade it as soon as it\'s ready',
+            default=False)
         p.add_argument('-s', '--students', help='List of GitHub usernames', nargs='+',
             default=None)
+        p.add_argument('-t', '--parallel-tests', type=int, help='Number of test cases to run concurrently in each repo',
+            default=None)
         p.add_argument('-v', '--verbose', action='store_true', help='Print actual and expected output when they don\'t match',
             default=False)
         p.add_argument('-vv', '--very-verbose', action='store_true', help='Print actual and expected output whether they match or not',
@@ -101,12 +113,14 @@ class Config:
         for k,v in d.items():
             if type(v) == str:
                 line = f'{k} = "{v}"'
-            elif type(v) == int:
+            elif type(v) == bool:
+                # python True vs TOML true
+                line = f'{k} = {str(v).lower()}'
+            elif type(v) in [int, float]:
                 line = f'{k} = {v}'
             elif type(v) == list and not v:
                 line = f'{k} = []'
             else:
-                # If we need booleans, handle python True vs TOML true
                 raise TypeError(f'Not handled: {type(v)} for key: {k}')
             tbl.add(tomlkit.comment(line))
 
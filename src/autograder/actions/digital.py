@@ -0,0 +1,292 @@
+"""
+digital.py runs Digital's command line tests in a long-lived JVM, so that
+JVM startup and class loading are paid once per concurrent test case rather
+than once per test case
+"""
+
+import hashlib
+import os
+import select
+import subprocess
+import threading
+import time
+
+from .cmd import (OUTPUT_LIMIT, decode_output, kill_process_group,
+                  register_group, release_group)
+from .util import OutputLimitExceeded, cache_path
+
+# seconds to wait for the JVM to load Digital and say it's ready
+STARTUP_TIMEOUT = 60
+
+# The server reads requests on stdin and runs each one through Digital's CLI
+# in-process, capturing System.out and System.err. Protocol:
+#   server -> "READY\n" once Digital's CLI class is loaded, or "UNSUPPORTED ..."
+#   client -> "RUN <nargs> <capture_stderr>\n" followed by one arg per line
+#   server -> "OUT <nbytes> <exit code>\n" followed by nbytes of output
+SERVER_SOURCE = r'''
+import java.io.*;
+import java.lang.reflect.*;
+import java.nio.charset.StandardCharsets;
+
+public class DigitalServer {
+    public static void main(String[] args) throws Exception {
+        PrintStream out = System.out;
+        PrintStream err = System.err;
+        BufferedReader in = new BufferedReader(
+            new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        Class<?> mainClass;
+        Method execute;
+        try {
+            mainClass = Class.forName("de.neemann.digital.cli.Main");
+            execute = mainClass.getMethod("execute", String[].class);
+        } catch (Exception e) {
+            out.print("UNSUPPORTED " + e + "\n");
+            out.flush();
+            return;
+        }
+        out.print("READY\n");
+        out.flush();
+
+        String line;
+        while ((line = in.readLine()) != null && line.startsWith("RUN ")) {
+            String[] fields = line.split(" ");
+            String[] cmdArgs = new String[Integer.parseInt(fields[1])];
+            for (int i = 0; i < cmdArgs.length; i++) {
+                cmdArgs[i] = in.readLine();
+            }
+            ByteArrayOutputStream buf = new ByteArrayOutputStream();
+            PrintStream capture = new PrintStream(buf, true, "UTF-8");
+            System.setOut(capture);
+            System.setErr(fields[2].equals("1")
+                ? capture : new PrintStream(OutputStream.nullOutputStream()));
+            int rc = 0;
+            try {
+                execute.invoke(mainClass.getDeclaredConstructor().newInstance(),
+                               (Object) cmdArgs);
+            } catch (InvocationTargetException e) {
+                rc = report(e.getCause(), capture);
+            } catch (Throwable e) {
+                rc = report(e, capture);
+            } finally {
+                capture.flush();
+                System.setOut(out);
+                System.setErr(err);
+            }
+            byte[] bytes = buf.toByteArray();
+            out.print("OUT " + bytes.length + " " + rc + "\n");
+            out.write(bytes, 0, bytes.length);
+            out.flush();
+        }
+    }
+
+    // Do what CLI.main() does with a CLIException: print it and exit with
+    // its exit code
+    private static int report(Throwable t, PrintStream capture) {
+        try {
+            t.getClass().getMethod("printMessage", PrintStream.class).invoke(t, capture);
+            return (Integer) t.getClass().getMethod("getExitCode").invoke(t);
+        } catch (Exception e) {
+            t.printStackTrace(capture);
+            return 1;
+        }
+    }
+}
+'''
+
+
+class DigitalServerError(Exception):
+    pass
+
+
+def get_server_source_path():
+    # Java 11+ can run a single source file directly, so we don't need javac
+    digest = hashlib.sha256(SERVER_SOURCE.encode()).hexdigest()[:12]
+    path = cache_path('digital', f'DigitalServer-{digest}.java')
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}'
+        with open(tmp, 'w') as f:
+            f.write(SERVER_SOURCE)
+        os.replace(tmp, path)
+    return path
+
+
+class DigitalServer:
+    def __init__(self, command):
+        self.command = command
+        self.proc = None
+        self.buf = bytearray()
+
+
+    def start(self):
+        self.proc = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                     start_new_session=True)
+        # Killed at exit by cmd_cleanup(), along with everything else
+        register_group(self.proc.pid, None)
+        os.set_blocking(self.proc.stdout.fileno(), False)
+        try:
+            line = self.read_line(time.monotonic() + STARTUP_TIMEOUT)
+            if line != b'READY':
+                raise DigitalServerError(line.decode('utf-8', 'replace'))
+        except Exception:
+            self.stop()
+            raise
+
+
+    def stop(self):
+        if self.proc:
+            kill_process_group(self.proc, grace=0.1)
+            release_group(self.proc.pid, None)
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            self.proc.stdout.close()
+            self.proc = None
+        self.buf = bytearray()
+
+
+    def fill(self, deadline):
+        # Read whatever the server has written, waiting until deadline
+        fd = self.proc.stdout.fileno()
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+            raise subprocess.TimeoutExpired(self.command, remaining)
+        data = os.read(fd, 65536)
+        if not data:
+            raise DigitalServerError('Digital server exited')
+        self.buf += data
+
+
+    def read_line(self, deadline):
+        while b'\n' not in self.buf:
+            self.fill(deadline)
+        line, _, rest = self.buf.partition(b'\n')
+        self.buf = bytearray(rest)
+        return bytes(line)
+
+
+    def read_exact(self, n, deadline):
+        while len(self.buf) < n:
+            self.fill(deadline)
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+
+    def run(self, args, timeout, capture_stderr=True):
+        """
+        Run one Digital CLI command, returning its exit code and output.
+        On timeout the JVM is killed, since we can't interrupt it, and the
+        next command will start a new one
+        """
+        if self.proc is None:
+            self.start()
+        deadline = time.monotonic() + timeout
+        request = f'RUN {len(args)} {int(capture_stderr)}\n' + ''.join(a + '\n' for a in args)
+        try:
+            self.proc.stdin.write(request.encode('utf-8'))
+            self.proc.stdin.flush()
+            header = self.read_line(deadline).decode('ascii').split()
+            if len(header) != 3 or header[0] != 'OUT':
+                raise DigitalServerError(f'Unexpected response: {header}')
+            output = self.read_exact(int(header[1]), deadline)
+            return int(header[2]), output
+        except subprocess.TimeoutExpired:
+            self.stop()
+            raise subprocess.TimeoutExpired(args, timeout)
+        except (BrokenPipeError, DigitalServerError):
+            self.stop()
+            raise
+
+
+# Idle servers, per Digital JAR, shared by all worker threads. A test case
+# takes one, or starts one if there are none, and puts it back when it's
+# done, so there are never more servers than test cases run at once
+idle = {}
+idle_lock = threading.Lock()
+unsupported = set()
+
+
+def take_server(key):
+    with idle_lock:
+        if idle.get(key):
+            return idle[key].pop()
+    return None
+
+
+def put_server(key, server):
+    with idle_lock:
+        idle.setdefault(key, []).append(server)
+
+
+def parse_cmd_line(cmd_line):
+    """
+    Split a test case command line like ['java', '-cp', '<jar>', 'CLI', ...]
+    into the JAR and the CLI arguments, or return None if it has any other
+    shape, which we'll run as a separate process
+    """
+    if len(cmd_line) < 4 or os.path.basename(cmd_line[0]) != 'java':
+        return None
+    if cmd_line[1] not in ['-cp', '-classpath'] or cmd_line[3] != 'CLI':
+        return None
+    return cmd_line[2], cmd_line[4:]
+
+
+def absolute_args(args, wd):
+    # The JVM's working directory is fixed, so make paths relative to the
+    # repo absolute
+    result = []
+    for arg in args:
+        path = os.path.join(wd, arg)
+        if not arg.startswith('-') and not os.path.isabs(arg) and os.path.exists(path):
+            arg = os.path.abspath(path)
+        result.append(arg)
+    return result
+
+
+def run_digital(cmd_line, wd, timeout, capture_stderr=True, decode_errors='strict',
+                output_limit=OUTPUT_LIMIT, usage=None):
+    """
+    Run a Digital test case command line in an idle warm JVM, and
+    return its output like cmd_exec_capture(). Returns None if the command
+    line isn't a Digital CLI command, or the JVM can't run Digital's CLI
+    in-process, so the caller should run it as a separate process
+    """
+    parsed = parse_cmd_line(cmd_line)
+    if parsed is None:
+        return None
+    jar, args = parsed
+    key = (cmd_line[0], jar)
+    if key in unsupported:
+        return None
+
+    server = take_server(key)
+    if server is None:
+        command = [key[0], '-Djava.awt.headless=true', '-cp', jar, get_server_source_path()]
+        server = DigitalServer(command)
+        try:
+            server.start()
+        except (OSError, subprocess.TimeoutExpired, DigitalServerError):
+            unsupported.add(key)
+            return None
+
+    start = time.monotonic()
+    try:
+        # Like cmd_exec_capture(), the exit code doesn't matter, only output
+        _, output = server.run(absolute_args(args, wd), timeout, capture_stderr)
+    except (BrokenPipeError, DigitalServerError):
+        # The JVM died under us. Run this one as a separate process, and
+        # start a new JVM for the next one
+        return None
+    finally:
+        if usage is not None:
+            usage['wall'] = round(time.monotonic() - start, 3)
+        # A server whose JVM was killed or died starts a new one when it's
+        # next used
+        put_server(key, server)
+
+    if len(output) > output_limit:
+        raise OutputLimitExceeded
+    return decode_output(output, decode_errors).rstrip('\n')
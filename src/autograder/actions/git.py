@@ -1,10 +1,49 @@
-from datetime import datetime
+from collections import Counter
+from datetime import datetime, timedelta
 import os
 import subprocess
+import threading
+import time
 
-from .cmd import cmd_exec_capture, cmd_exec_rc
+from .cmd import cmd_exec, cmd_exec_capture, cmd_exec_rc
+from .gitreader import READ_ERRORS, GitReader, format_time
 from .util import *
 
+# seconds to wait before the first retry of a git command, doubling each time
+RETRY_BACKOFF = 2
+
+# seconds to allow for repacking the starter repo mirror
+MIRROR_TIMEOUT = 600
+
+# git errors which are worth retrying, since they come from the network
+# rather than the repo. Lowercase, since git's capitalization varies by
+# version and transport
+TRANSIENT_ERRORS = [
+    'could not resolve host',
+    'connection timed out',
+    'connection reset',
+    'connection refused',
+    'operation timed out',
+    'temporary failure in name resolution',
+    'the remote end hung up unexpectedly',
+    'early eof',
+    'rpc failed',
+    'internal server error',
+    'service unavailable',
+    'bad gateway',
+    'ssh: connect to host',
+    'kex_exchange_identification',
+]
+
+# Outcomes of clone() and pull(), in the order of the summary
+CLONED = 'cloned'
+PULLED = 'pulled'
+EXISTS = 'already exists'
+NO_REMOTE = 'no remote repo'
+NO_COMMITS = 'no commits in date range'
+NO_BRANCHES = 'no branches'
+FAILED = 'failed'
+
 class GitNoCommits(Exception):
     pass
 class GitNoBranches(Exception):
@@ -16,6 +55,21 @@ class GitConfig(SafeConfig):
     def __init__(self, cfg):
         self.org = 'your GitHub Classroom org here'
         self.credentials = 'ssh'
+        self.retries = 3  # times to retry git commands after network errors
+        # Fetch less when cloning: e.g. filter = "blob:none" fetches file
+        # contents only when they're checked out, and depth = 1 fetches only
+        # the newest commit. With --by-date, shallow_days = 14 fetches only
+        # the commits from two weeks before the date onward
+        self.filter = ''
+        self.depth = 0
+        self.shallow_days = 0
+        # Starter code repo, e.g. "$project-starter" in the org, or a URL.
+        # Its history is kept in a bare mirror in mirror_path (default
+        # ~/.cache/grade/mirrors), which student clones borrow objects from.
+        # dissociate = true copies the borrowed objects into each clone
+        self.starter_repo = ''
+        self.mirror_path = ''
+        self.dissociate = False
         self.safe_update(cfg)
 
 
@@ -24,10 +78,15 @@ class Git:
         self.cfg = GitConfig(git_cfg)
         self.args = args
         self.date = date
+        self.mirror_lock = threading.Lock()
+        self.mirror_ready = False
 
 
     def make_remote_path(self, repo):
-        repo_path = repo.remote_path
+        return self.make_remote_url(repo.remote_path)
+
+
+    def make_remote_url(self, repo_path):
         cred = self.cfg.credentials
         org = self.cfg.org
         if cred == 'ssh':
@@ -39,6 +98,11 @@ class Git:
 
 
     def get_default_branch(self, local):
+        try:
+            return GitReader(local).default_branch()
+        except READ_ERRORS:
+            # No origin/HEAD, or a repo we can't read: ask the remote
+            pass
         branches = subprocess.Popen(
             ['git', 'remote', 'show', 'origin'],
             # ['git', 'branch', '--remotes', '--list', '*/HEAD'],
@@ -58,10 +122,26 @@ class Git:
 
 
 
-    def get_commit_hash(self, local, branch):
+    @staticmethod
+    def make_before(date):
         # append time if not provided in dates.toml
-        time = '' if ' ' in self.date.date else ' 00:00:00'
-        before = self.date.date + time
+        time = '' if ' ' in date.date else ' 00:00:00'
+        return date.date + time
+
+
+    def get_commit_hash(self, local, branch):
+        before = self.make_before(self.date)
+        try:
+            found = GitReader(local).last_commit_before(branch, datetime.fromisoformat(before))
+            if found is None:
+                raise GitNoCommits
+            sha, commit = found
+            committed = datetime.fromtimestamp(commit['committer'][0])
+            date_line = f'{committed:%a %b} {committed.day} {committed:%H:%M:%S %Y}'
+            print(f'branch: {branch}, hash: {sha[:7]}, date: {date_line}', end='')
+            return sha[:7]
+        except READ_ERRORS:
+            pass
         cmd = ['git', 'rev-list', '-n', '1', '--first-parent', 
             "--pretty='%cd'", 'HEAD', '--date=local','--before', before, branch]
         lines =  cmd_exec_capture(cmd, wd=local)
@@ -76,43 +156,269 @@ class Git:
         return h
 
 
-    def clone(self, repo):
+    def exec_retry(self, args, wd=None):
+        """
+        Run a git command which talks to the remote, retrying with
+        exponential backoff if it fails with a network error.
+        Returns the exit code of the last attempt
+        """
+        delay = RETRY_BACKOFF
+        for attempt in range(self.cfg.retries + 1):
+            presults = cmd_exec(args, wd=wd, check=False, decode_errors='replace')
+            output = (presults.stdout or '').lower()
+            if presults.returncode == 0 or attempt == self.cfg.retries:
+                break
+            if not any(err in output for err in TRANSIENT_ERRORS):
+                break
+            print_yellow(f'retrying in {delay}s ')
+            time.sleep(delay)
+            delay *= 2
+        return presults.returncode
+
+
+    def make_clone_options(self, date=None):
+        # date is the earliest date we'll look for commits before, if not
+        # the --by-date date
+        options = []
+        if self.cfg.filter:
+            options.append(f'--filter={self.cfg.filter}')
+        if date is None and self.args.by_date:
+            date = self.date
+        if date and self.cfg.shallow_days:
+            # get_commit_hash() needs the last commit before the date, so
+            # start the window some days earlier
+            date = datetime.fromisoformat(self.make_before(date))
+            since = date - timedelta(days=self.cfg.shallow_days)
+            options.append(f'--shallow-since={since:%Y-%m-%d %H:%M:%S}')
+        elif self.cfg.depth:
+            options.append(f'--depth={self.cfg.depth}')
+        return options
+
+
+    def get_mirror(self):
+        # Path of the bare mirror of the starter repo for this project
+        mirror_path = os.path.expanduser(self.cfg.mirror_path) or cache_path('mirrors')
+        return os.path.join(mirror_path, f'{self.args.project}.git')
+
+
+    def update_mirror(self):
+        """
+        Create or update the mirror of the starter repo. Returns False if
+        the mirror isn't available, so clones won't use it
+        """
+        starter = self.cfg.starter_repo.replace('$project', self.args.project)
+        if ':' not in starter and '/' not in starter:
+            starter = self.make_remote_url(starter)
+        mirror = self.get_mirror()
+        # Student clones borrow objects from the mirror, so never let git
+        # delete any: don't prune refs, and turn off automatic gc
+        no_gc = ['-c', 'gc.auto=0', '-c', 'maintenance.auto=false']
+        if os.path.isdir(mirror):
+            rc = self.exec_retry(['git'] + no_gc + ['fetch', '--no-prune'], wd=mirror)
+        else:
+            os.makedirs(os.path.dirname(mirror), exist_ok=True)
+            rc = self.exec_retry(['git'] + no_gc + ['clone', '--mirror', starter, mirror])
+        if os.path.isdir(mirror):
+            # For git commands run in the mirror other than ours
+            cmd_exec_rc(['git', 'config', 'gc.auto', '0'], wd=mirror)
+            cmd_exec_rc(['git', 'config', 'maintenance.auto', 'false'], wd=mirror)
+            cmd_exec_rc(['git', 'config', 'gc.pruneExpire', 'never'], wd=mirror)
+        if rc != 0:
+            print_yellow(f'Could not update starter repo mirror from {starter} ')
+        return os.path.isdir(mirror)
+
+
+    def make_reference_options(self):
+        # Borrow the starter repo's objects from the mirror, updating it
+        # once per run, before the first clone
+        if not self.cfg.starter_repo:
+            return []
+        with self.mirror_lock:
+            if not self.mirror_ready:
+                self.mirror_ready = self.update_mirror()
+        if not self.mirror_ready:
+            return []
+        options = ['--reference-if-able', self.get_mirror()]
+        if self.cfg.dissociate:
+            options.append('--dissociate')
+        return options
+
+
+    def maintain_mirror(self):
+        """
+        Update the mirror and repack it into one pack. Student clones which
+        don't dissociate use objects from the mirror, so never prune
+        unreachable objects: keep them in the pack, and only delete loose
+        objects which are now in the pack
+        """
+        if not self.cfg.starter_repo:
+            fatal('Set starter_repo in the [Git] section of config.toml')
+        if not self.update_mirror():
+            return
+        mirror = self.get_mirror()
+        cmd_exec_rc(['git', 'repack', '-a', '-d', '--keep-unreachable'], wd=mirror, timeout=MIRROR_TIMEOUT)
+        cmd_exec_rc(['git', 'prune-packed'], wd=mirror, timeout=MIRROR_TIMEOUT)
+        print(mirror)
+
+
+    def get_commit_hash_deepen(self, local, branch):
+        # If a shallow clone doesn't reach back to the date, fetch the
+        # rest of the history and look again
+        try:
+            return self.get_commit_hash(local, branch)
+        except GitNoCommits:
+            if not self.is_shallow(local):
+                raise
+        print_yellow('Fetching full history ')
+        self.exec_retry(['git', 'fetch', '--unshallow'], wd=local)
+        return self.get_commit_hash(local, branch)
+
+
+    def is_shallow(self, local):
+        try:
+            return GitReader(local).is_shallow()
+        except READ_ERRORS:
+            cmd = ['git', 'rev-parse', '--is-shallow-repository']
+            return cmd_exec_capture(cmd, wd=local) == 'true'
+
+
+    def find_commits_before(self, local, name, befores):
+        # The last commit before each date, with one walk of the history
+        try:
+            dts = [datetime.fromisoformat(before) for before in befores]
+            return GitReader(local).last_commits_before(name, dts)
+        except READ_ERRORS:
+            pass
+        commits = []
+        for before in befores:
+            cmd = ['git', 'rev-list', '-n', '1', '--first-parent', '--before', before, name]
+            commits.append(cmd_exec_capture(cmd, wd=local, capture_stderr=False) or None)
+        return commits
+
+
+    def checkout_milestones(self, base, milestones):
+        """
+        Clone the student's repo once (or fetch, if it's already cloned),
+        find the commit for each of the (Repo, Date) milestones, and check
+        each one out in a worktree at the milestone repo's root_path.
+        Milestones with no commits before their date are removed, like
+        clone() does with --by-date
+        """
+        local = base.local_path
+        if os.path.isdir(local):
+            self.exec_retry(['git', 'fetch', '--quiet', 'origin'], wd=local)
+        else:
+            earliest = min((date for _, date in milestones), key=self.make_before)
+            if self.clone(base, earliest) != CLONED:
+                return
+        try:
+            name = 'origin/' + self.get_default_branch(local)
+        except GitNoBranches:
+            print_red('No branches in repo\n')
+            return
+        befores = [self.make_before(date) for _, date in milestones]
+        commits = self.find_commits_before(local, name, befores)
+        if None in commits and self.is_shallow(local):
+            print_yellow('Fetching full history ')
+            self.exec_retry(['git', 'fetch', '--unshallow'], wd=local)
+            commits = self.find_commits_before(local, name, befores)
+
+        for (repo, date), sha in zip(milestones, commits):
+            path = os.path.abspath(repo.root_path)
+            if sha is None:
+                print_yellow(f'{date.suffix}: no commits ')
+                self.remove_worktree(local, path)
+                continue
+            if os.path.isdir(path):
+                rc = cmd_exec_rc(['git', 'checkout', '--quiet', '--detach', sha], wd=path)
+            else:
+                rc = cmd_exec_rc(['git', 'worktree', 'add', '--quiet', '--detach', path, sha], wd=local)
+            if rc != 0:
+                # Rather than grade whatever was checked out before
+                print_red(f'{date.suffix}: checkout of {sha[:7]} failed ')
+                self.remove_worktree(local, path)
+                continue
+            print(f'{date.suffix}: {sha[:7]} ', end='')
+        print()
+
+
+    @staticmethod
+    def remove_worktree(local, path):
+        if os.path.isdir(path):
+            cmd_exec_rc(['rm', '-rf', path])
+        cmd_exec_rc(['git', 'worktree', 'prune'], wd=local)
+
+
+    def clone(self, repo, date=None):
+        # Returns one of the outcomes above, for the summary
         remote = self.make_remote_path(repo)
         local = repo.local_path
         if os.path.isdir(local):
             print('Already exists: ' + local)
-            return 0
+            return EXISTS
+        status = CLONED
         try:
-            rc = cmd_exec_rc(['git', 'clone', remote, local])
+            options = self.make_clone_options(date)
+            reference = self.make_reference_options()
+            rc = self.exec_retry(['git', 'clone'] + options + reference + [remote, local])
+            if rc != 0 and any(o.startswith('--shallow-since') for o in options):
+                # With no commits in the window, git clone fails with "no
+                # commits selected for shallow requests". Clone the newest
+                # commit, and let get_commit_hash_deepen() fetch the rest
+                options = [o for o in options if not o.startswith('--shallow-since')]
+                options.append('--depth=1')
+                rc = self.exec_retry(['git', 'clone'] + options + reference + [remote, local])
             if rc != 0:
                 raise GitNoRepo
             if self.args.by_date:
                 branch = self.get_default_branch(local)
-                commit_hash = self.get_commit_hash(local, branch)
+                commit_hash = self.get_commit_hash_deepen(local, branch)
                 cmd_exec_rc(['git', 'checkout', commit_hash], wd=local)
         except GitNoRepo:
             print_red('No remote repo')
+            status = NO_REMOTE
         except GitNoCommits:
             print_yellow('No commits in date range. Removing local repo')
             cmd_exec_rc(['rm', '-rf', local])
+            status = NO_COMMITS
         except GitNoBranches:
             print_red('No branches in repo')
+            status = NO_BRANCHES
         print()
+        return status
 
 
     def pull(self, repo):
         local = repo.local_path
-        branch = self.get_default_branch(local)
+        try:
+            branch = self.get_default_branch(local)
+        except GitNoBranches:
+            print_red('No branches in repo')
+            return NO_BRANCHES
         cmd_exec_rc(['git', 'checkout', branch], wd=local)
-        cmd_exec_rc(['git', 'pull'], wd=local)
+        if self.exec_retry(['git', 'pull'], wd=local) != 0:
+            print_red('git pull failed')
+            return FAILED
+        return PULLED
+
+
+    @staticmethod
+    def format_summary(statuses):
+        # statuses from clone() or pull(), with None for exceptions
+        counts = Counter(FAILED if s is None else s for s in statuses)
+        order = [CLONED, PULLED, EXISTS, NO_REMOTE, NO_COMMITS, NO_BRANCHES, FAILED]
+        return ', '.join(f'{s}: {counts[s]}' for s in order if counts[s])
 
 
     def get_url_for_hash(self, comment, repo):
         local = repo.local_path
         remote = repo.remote_path
         try:
-            cmd = ['git', 'rev-parse', '--short', 'HEAD']
-            commit_hash = cmd_exec_capture(cmd, wd=local)
+            try:
+                commit_hash = GitReader(local).head()[:7]
+            except READ_ERRORS:
+                cmd = ['git', 'rev-parse', '--short', 'HEAD']
+                commit_hash = cmd_exec_capture(cmd, wd=local)
             url = f'https://github.com/{self.cfg.org}/{remote}/tree/{commit_hash}'
             return f'Test results for repo as of this commit: {url}\n\n' + comment
         except Exception as err:
@@ -126,6 +432,12 @@ class Git:
         try:
             local = repo.local_path
             branch = self.get_default_branch(local)
+            try:
+                reader = GitReader(local)
+                commit = reader.read_commit(reader.resolve_name(branch))
+                return format_time(commit['author'], '%Y-%m-%d %H:%M:%S %z')
+            except READ_ERRORS:
+                pass
             cmd = ['git', 'rev-list', '--first-parent', '--date=iso', '-n', '1', 
             '--pretty="%ai"', '--no-commit-header', branch, ]
             date_text = cmd_exec_capture(cmd, wd=local, capture_stderr=False)
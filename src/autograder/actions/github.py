@@ -3,28 +3,36 @@ github.py uses the GitHub REST API to get the result of a GitHub action workflow
 """
 
 import json
-from io import BytesIO
+from urllib.parse import urlencode
 from zipfile import ZipFile
 
 from .git import *
-from .server import Server
+from .server import Server, ServerConfig
 
 from .util import *
 
-class GithubConfig(SafeConfig):
+class GithubConfig(ServerConfig):
     def __init__(self, cfg):
         self.host_name = 'api.github.com'
         self.access_token = 'your access token here'
-        self.safe_update(cfg)
+        self.concurrency = 8  # students whose results are fetched at once
+        self.artifact_name = ''  # name of the artifact with the results, if not the newest one
+        self.artifact_limit_mb = 100  # bigger artifacts aren't downloaded
+        super().__init__(cfg)
 
  
 class Github(Server):
     def __init__(self, cfg, args, org):
         self.github_cfg = GithubConfig(cfg)
+        # A connection for each student fetched at once, so none of them
+        # waits for a connection or throws one away
+        self.github_cfg.pool_size = max(self.github_cfg.pool_size, self.github_cfg.concurrency)
         super().__init__(
             self.github_cfg.host_name, 
             self.github_cfg.access_token, 
-            args.verbose)
+            args.verbose,
+            self.github_cfg,
+            cache=not args.no_cache)
         self.project = args.project
         self.org = org
 
@@ -42,13 +50,17 @@ class Github(Server):
         return url
 
     def make_repo_artifacts_url(self, student):
-        url = 'https://{}/repos/{}/{}-{}/actions/artifacts'.format(
-                self.github_cfg.host_name, self.org, self.project, student)
+        # Only the newest artifact, with the given name if there is one
+        params = {'per_page': 1}
+        if self.github_cfg.artifact_name:
+            params['name'] = self.github_cfg.artifact_name
+        url = 'https://{}/repos/{}/{}-{}/actions/artifacts?{}'.format(
+                self.github_cfg.host_name, self.org, self.project, student, urlencode(params))
         return url
 
 
     def get_first_artifact_for_repo(self, student):
-        # Get all artifacts for the workflow run
+        # Get the newest artifact in the repo
         url = self.make_repo_artifacts_url(student)
 
         artifact = {}
@@ -87,13 +99,16 @@ class Github(Server):
         # Download the artifact
         url = artifact['archive_download_url']
 
-        # The logs for the workflow run are in zip format
+        # The logs for the workflow run are in zip format. Stream it to a
+        # temp file, and read only the results from it, since students may
+        # upload big build outputs in the same artifact
         try:
-            artifact_zip = self.get_url(url, self.github_headers())
-            with ZipFile(BytesIO(artifact_zip)) as log_file:
-                results = log_file.read('grade-results.json')
-                results = json.loads(results.decode('utf-8'))
-                results['grade'] = float(results['grade'])
+            limit = self.github_cfg.artifact_limit_mb * 1024 * 1024
+            with self.download(url, self.github_headers(), limit) as artifact_zip:
+                with ZipFile(artifact_zip) as log_file:
+                    results = log_file.read('grade-results.json')
+            results = json.loads(results.decode('utf-8'))
+            results['grade'] = float(results['grade'])
         except Exception as e:
             warn('Analyzing artifact: ' + str(e))
 
@@ -109,7 +124,8 @@ class Github(Server):
         if artifact:
             # Download the artifact and extract the grade
             results = self.get_artifact_results(artifact)
-            repo_result['score'] = results['grade']
+            if results:
+                repo_result['score'] = results['grade']
             # Calculate the web browser (not "api) URL for the first job ID in the action run
             repo_result['comment'] = self.get_action_run_summary_url(student, artifact)
         else:
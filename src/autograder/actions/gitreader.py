@@ -0,0 +1,410 @@
+"""
+gitreader.py reads refs and commits directly from a repo's .git directory,
+so that looking up the default branch, HEAD, and commit dates doesn't
+start a git process or talk to the remote. It understands loose refs,
+packed-refs, loose objects, version 2 pack indexes, delta objects, and
+alternates. Anything else raises GitReaderError, and the caller should
+ask git instead
+"""
+
+from datetime import datetime, timedelta, timezone
+import os
+import struct
+import zlib
+
+
+class GitReaderError(Exception):
+    pass
+
+
+# Errors from reading a repo we don't understand, or which is corrupt
+READ_ERRORS = (GitReaderError, OSError, ValueError, IndexError, KeyError,
+               struct.error, zlib.error)
+
+# Pack object types
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+TYPE_NAMES = {OBJ_COMMIT: 'commit', OBJ_TREE: 'tree', OBJ_BLOB: 'blob', OBJ_TAG: 'tag'}
+
+
+def find_git_dir(path):
+    # Like git, look for .git in path and then its parents
+    path = os.path.abspath(path)
+    while True:
+        dot_git = os.path.join(path, '.git')
+        if os.path.isdir(dot_git):
+            return dot_git
+        if os.path.isfile(dot_git):
+            # A worktree or submodule: ".git" names the real git dir
+            with open(dot_git) as f:
+                line = f.read().strip()
+            if not line.startswith('gitdir: '):
+                raise GitReaderError(f'Unexpected .git file: {dot_git}')
+            return os.path.normpath(os.path.join(path, line[len('gitdir: '):]))
+        parent = os.path.dirname(path)
+        if parent == path:
+            raise GitReaderError(f'Not a git repo: {path}')
+        path = parent
+
+
+def apply_delta(base, delta):
+    # Rebuild an object from its base and a delta of copy/insert commands
+    def read_size(i):
+        size = shift = 0
+        while True:
+            b = delta[i]
+            i += 1
+            size |= (b & 0x7f) << shift
+            shift += 7
+            if not b & 0x80:
+                return size, i
+
+    base_size, i = read_size(0)
+    result_size, i = read_size(i)
+    if base_size != len(base):
+        raise GitReaderError('Delta base size mismatch')
+    out = bytearray()
+    while i < len(delta):
+        op = delta[i]
+        i += 1
+        if op & 0x80:
+            # Copy from base: offset and size are little-endian, with a
+            # bit in op for each byte which is present
+            offset = size = 0
+            for n in range(4):
+                if op & (1 << n):
+                    offset |= delta[i] << (8 * n)
+                    i += 1
+            for n in range(3):
+                if op & (0x10 << n):
+                    size |= delta[i] << (8 * n)
+                    i += 1
+            out += base[offset:offset + (size or 0x10000)]
+        elif op:
+            # Insert the next op bytes
+            out += delta[i:i + op]
+            i += op
+        else:
+            raise GitReaderError('Invalid delta opcode')
+    if len(out) != result_size:
+        raise GitReaderError('Delta result size mismatch')
+    return bytes(out)
+
+
+class PackIndex:
+    """
+    A version 2 pack index, which maps object names to offsets in the pack
+    """
+    def __init__(self, idx_path):
+        with open(idx_path, 'rb') as f:
+            self.data = f.read()
+        if self.data[:4] != b'\xfftOc' or struct.unpack('>I', self.data[4:8])[0] != 2:
+            raise GitReaderError(f'Unsupported pack index: {idx_path}')
+        self.fanout = struct.unpack('>256I', self.data[8:8 + 1024])
+        self.count = self.fanout[255]
+        self.names_start = 8 + 1024
+        self.offsets_start = self.names_start + 24 * self.count  # names, then CRCs
+        self.large_start = self.offsets_start + 4 * self.count
+        self.pack_path = idx_path[:-len('.idx')] + '.pack'
+
+
+    def find(self, sha):
+        # Binary search the sorted names in sha's fanout bucket
+        name = bytes.fromhex(sha)
+        lo = self.fanout[name[0] - 1] if name[0] else 0
+        hi = self.fanout[name[0]]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.names_start + 20 * mid
+            candidate = self.data[start:start + 20]
+            if candidate < name:
+                lo = mid + 1
+            elif candidate > name:
+                hi = mid
+            else:
+                return self.get_offset(mid)
+        return None
+
+
+    def get_offset(self, i):
+        start = self.offsets_start + 4 * i
+        offset = struct.unpack('>I', self.data[start:start + 4])[0]
+        if offset & 0x80000000:
+            # Offsets over 2GB are in the large offset table
+            start = self.large_start + 8 * (offset & 0x7fffffff)
+            offset = struct.unpack('>Q', self.data[start:start + 8])[0]
+        return offset
+
+
+class GitReader:
+    def __init__(self, path):
+        self.git_dir = find_git_dir(path)
+        # Worktrees keep HEAD in their own git dir, and everything else in
+        # the common dir of the main repo
+        self.common_dir = self.git_dir
+        commondir_path = os.path.join(self.git_dir, 'commondir')
+        if os.path.isfile(commondir_path):
+            with open(commondir_path) as f:
+                self.common_dir = os.path.normpath(os.path.join(self.git_dir, f.read().strip()))
+        self.object_dirs = self.find_object_dirs(os.path.join(self.common_dir, 'objects'))
+        self.packs = None
+        self.packed_refs = None
+        self.cache = {}
+
+
+    def find_object_dirs(self, objects_dir, depth=0):
+        # This repo's objects, followed by those it borrows from alternates
+        dirs = [objects_dir]
+        alternates_path = os.path.join(objects_dir, 'info', 'alternates')
+        if depth < 5 and os.path.isfile(alternates_path):
+            with open(alternates_path) as f:
+                for line in f.read().splitlines():
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        path = os.path.normpath(os.path.join(objects_dir, line))
+                        dirs += self.find_object_dirs(path, depth + 1)
+        return dirs
+
+
+    # Refs
+
+    def read_packed_refs(self):
+        if self.packed_refs is None:
+            self.packed_refs = {}
+            path = os.path.join(self.common_dir, 'packed-refs')
+            if os.path.isfile(path):
+                with open(path) as f:
+                    for line in f:
+                        # Skip the header and peeled tags ("^<sha>")
+                        if line.startswith('#') or line.startswith('^'):
+                            continue
+                        sha, _, name = line.strip().partition(' ')
+                        self.packed_refs[name] = sha
+        return self.packed_refs
+
+
+    def read_ref_file(self, name):
+        # Returns the contents of a ref: a sha or "ref: <name>", or None
+        git_dir = self.git_dir if name == 'HEAD' else self.common_dir
+        path = os.path.join(git_dir, name)
+        if os.path.isfile(path):
+            with open(path) as f:
+                return f.read().strip()
+        return self.read_packed_refs().get(name)
+
+
+    def resolve_ref(self, name):
+        # Follow symbolic refs to a sha, or return None if the ref is missing
+        for _ in range(10):
+            value = self.read_ref_file(name)
+            if value is None:
+                return None
+            if not value.startswith('ref: '):
+                return value
+            name = value[len('ref: '):]
+        raise GitReaderError(f'Symbolic ref loop: {name}')
+
+
+    def resolve_name(self, name):
+        # The sha for a short name like "main", in the order git tries them
+        for full in [name, f'refs/{name}', f'refs/tags/{name}', f'refs/heads/{name}',
+                     f'refs/remotes/{name}', f'refs/remotes/{name}/HEAD']:
+            sha = self.resolve_ref(full)
+            if sha:
+                return sha
+        raise GitReaderError(f'Unknown ref: {name}')
+
+
+    def head(self):
+        sha = self.resolve_ref('HEAD')
+        if not sha:
+            raise GitReaderError('HEAD does not point to a commit')
+        return sha
+
+
+    def default_branch(self):
+        # git clone records the remote's default branch in origin/HEAD
+        value = self.read_ref_file('refs/remotes/origin/HEAD')
+        prefix = 'ref: refs/remotes/origin/'
+        if not value or not value.startswith(prefix):
+            raise GitReaderError('No refs/remotes/origin/HEAD')
+        return value[len(prefix):]
+
+
+    def is_shallow(self):
+        return os.path.isfile(os.path.join(self.common_dir, 'shallow'))
+
+
+    # Objects
+
+    def get_packs(self):
+        if self.packs is None:
+            self.packs = []
+            for objects_dir in self.object_dirs:
+                pack_dir = os.path.join(objects_dir, 'pack')
+                if not os.path.isdir(pack_dir):
+                    continue
+                for name in sorted(os.listdir(pack_dir)):
+                    if name.endswith('.idx'):
+                        self.packs.append(PackIndex(os.path.join(pack_dir, name)))
+        return self.packs
+
+
+    def read_object(self, sha):
+        # Returns (type name, content), or raises KeyError if it's missing
+        if sha in self.cache:
+            return self.cache[sha]
+        obj = self.read_loose(sha)
+        if obj is None:
+            for pack in self.get_packs():
+                offset = pack.find(sha)
+                if offset is not None:
+                    with open(pack.pack_path, 'rb') as f:
+                        obj = self.read_packed(pack, f, offset)
+                    break
+        if obj is None:
+            raise KeyError(sha)
+        self.cache[sha] = obj
+        return obj
+
+
+    def read_loose(self, sha):
+        for objects_dir in self.object_dirs:
+            path = os.path.join(objects_dir, sha[:2], sha[2:])
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    data = zlib.decompress(f.read())
+                header, _, content = data.partition(b'\0')
+                type_name = header.split(b' ')[0].decode()
+                return type_name, content
+        return None
+
+
+    def read_packed(self, pack, f, offset):
+        f.seek(offset)
+        # Type and size are packed into a varint
+        b = f.read(1)[0]
+        obj_type = (b >> 4) & 7
+        size = b & 0x0f
+        shift = 4
+        while b & 0x80:
+            b = f.read(1)[0]
+            size |= (b & 0x7f) << shift
+            shift += 7
+
+        if obj_type == OBJ_OFS_DELTA:
+            # Base is at a negative offset, in git's offset encoding
+            b = f.read(1)[0]
+            base_offset = b & 0x7f
+            while b & 0x80:
+                b = f.read(1)[0]
+                base_offset = ((base_offset + 1) << 7) | (b & 0x7f)
+            delta = self.inflate(f, size)
+            base_type, base = self.read_packed(pack, f, offset - base_offset)
+            return base_type, apply_delta(base, delta)
+        if obj_type == OBJ_REF_DELTA:
+            base_sha = f.read(20).hex()
+            delta = self.inflate(f, size)
+            base_type, base = self.read_object(base_sha)
+            return base_type, apply_delta(base, delta)
+        if obj_type not in TYPE_NAMES:
+            raise GitReaderError(f'Unknown pack object type {obj_type}')
+        return TYPE_NAMES[obj_type], self.inflate(f, size)
+
+
+    def inflate(self, f, size):
+        # Decompress one object from the pack, reading only as much as needed
+        d = zlib.decompressobj()
+        out = bytearray()
+        while not d.eof:
+            chunk = f.read(8192)
+            if not chunk:
+                raise GitReaderError('Truncated pack')
+            out += d.decompress(chunk)
+        if len(out) != size:
+            raise GitReaderError('Pack object size mismatch')
+        return bytes(out)
+
+
+    # Commits
+
+    def read_commit(self, sha):
+        """
+        Returns a dict with the commit's tree, parents, and author and
+        committer times as (seconds since the epoch, UTC offset in minutes)
+        """
+        type_name, content = self.read_object(sha)
+        if type_name != 'commit':
+            raise GitReaderError(f'{sha} is a {type_name}, not a commit')
+        commit = {'parents': []}
+        headers = content.split(b'\n\n', 1)[0].decode('utf-8', 'replace')
+        for line in headers.split('\n'):
+            key, _, value = line.partition(' ')
+            if key == 'tree':
+                commit['tree'] = value
+            elif key == 'parent':
+                commit['parents'].append(value)
+            elif key in ['author', 'committer']:
+                # "Name <email> 1700000000 -0800"
+                ts, tz = value.rsplit('>', 1)[1].split()
+                sign = -1 if tz[0] == '-' else 1
+                minutes = sign * (int(tz[1:3]) * 60 + int(tz[3:5]))
+                commit[key] = (int(ts), minutes)
+        return commit
+
+
+    def first_parents(self, sha):
+        """
+        Yield (sha, commit) along the first-parent chain from sha, stopping
+        at the root commit or the edge of a shallow clone
+        """
+        while sha:
+            try:
+                commit = self.read_commit(sha)
+            except KeyError:
+                if self.is_shallow():
+                    return
+                raise
+            yield sha, commit
+            sha = commit['parents'][0] if commit['parents'] else None
+
+
+    def last_commit_before(self, name, before):
+        """
+        Like "git rev-list -n 1 --first-parent --before <before> <name>":
+        the first commit on the first-parent chain of name whose committer
+        date is at or before the datetime before (local time if naive).
+        Returns (sha, commit), or None if there isn't one
+        """
+        limit = before.timestamp()
+        for sha, commit in self.first_parents(self.resolve_name(name)):
+            if commit['committer'][0] <= limit:
+                return sha, commit
+        return None
+
+
+    def last_commits_before(self, name, befores):
+        """
+        last_commit_before() for several datetimes with one walk of the
+        history, returning a sha (or None) for each of them
+        """
+        limits = [before.timestamp() for before in befores]
+        found = [None] * len(limits)
+        for sha, commit in self.first_parents(self.resolve_name(name)):
+            for i, limit in enumerate(limits):
+                if found[i] is None and commit['committer'][0] <= limit:
+                    found[i] = sha
+            if None not in found:
+                break
+        return found
+
+
+def format_time(when, fmt):
+    # Format a (timestamp, offset) from read_commit() in its own time zone
+    ts, minutes = when
+    tz = timezone(timedelta(minutes=minutes))
+    return datetime.fromtimestamp(ts, tz).strftime(fmt)
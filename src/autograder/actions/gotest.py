@@ -0,0 +1,157 @@
+"""
+gotest.py runs the test cases of a Go project with one "go test -json"
+per repo, rather than one per test case, so the test binary is compiled
+and linked once. The JSON events are routed back to each test case by
+test name, and each test case is still scored on its own
+"""
+
+import json
+import re
+
+from .cmd import OUTPUT_LIMIT, cmd_exec_capture
+
+NO_TESTS = 'testing: warning: no tests to run\n'
+
+
+def split_run_flag(cmd_line):
+    """
+    Find the -run pattern in a "go test -json" command line. Returns the
+    command line with the pattern replaced by None, and the pattern, or None
+    if this test case can't share a "go test" with others
+    """
+    if cmd_line[:2] != ['go', 'test'] or '-json' not in cmd_line:
+        return None
+    for i, arg in enumerate(cmd_line):
+        if arg == '-run' and i + 1 < len(cmd_line):
+            pattern = cmd_line[i + 1]
+            rest = cmd_line[:i + 1] + [None] + cmd_line[i + 2:]
+            break
+        if arg.startswith('-run='):
+            pattern = arg[len('-run='):]
+            rest = cmd_line[:i] + ['-run', None] + cmd_line[i + 1:]
+            break
+    else:
+        return None
+    # Subtest patterns like "TestA/sub" can't be combined with |, and we
+    # need Python to agree with Go about which tests the pattern matches
+    if '/' in pattern:
+        return None
+    try:
+        re.compile(pattern)
+    except re.error:
+        return None
+    return tuple(rest), pattern
+
+
+def make_batches(test_cases):
+    # Group test cases whose command lines differ only in their -run pattern
+    batches = {}
+    for tc in test_cases:
+        split = split_run_flag(tc.cmd_line)
+        if split is None:
+            continue
+        key, pattern = split
+        batches.setdefault(key, []).append((tc, pattern))
+    return batches
+
+
+def demux_events(jlines, patterns, verbose=False):
+    """
+    Split the output of "go test -json" into the actual output for each
+    -run pattern: "pass" if the tests it matches passed, otherwise their
+    output, like TestCase.get_actual_go() for a single test case
+    """
+    regexes = [re.compile(p) for p in patterns]
+    outputs = [''] * len(patterns)
+    ran = [False] * len(patterns)
+    failed = [False] * len(patterns)
+    package_output = ''
+    package_passed = False
+    tests_seen = False
+    crashed = False
+    running = set()
+    for jline in jlines.split('\n'):
+        if verbose:
+            print(jline)
+        try:
+            d = json.loads(jline)
+        except Exception:
+            # for build failures, include the compiler output as actual
+            package_output += jline + '\n'
+            continue
+        if not isinstance(d, dict):
+            package_output += jline + '\n'
+            continue
+        action = d.get('Action')
+        output = d.get('Output') or ''
+        test = d.get('Test')
+        if output.startswith('panic: '):
+            crashed = True
+        if not test:
+            package_output += output
+            if action == 'pass':
+                package_passed = True
+            continue
+        tests_seen = True
+        if action == 'run':
+            running.add(test)
+        elif action in ['pass', 'fail', 'skip']:
+            running.discard(test)
+        # Subtests belong to the test case matching their top-level test
+        top = test.split('/')[0]
+        for i, regex in enumerate(regexes):
+            if not regex.search(top):
+                continue
+            outputs[i] += output
+            if action in ['pass', 'fail', 'skip'] and top == test:
+                ran[i] = True
+                failed[i] = failed[i] or action == 'fail'
+
+    # If other tests failed, the test binary still ran every test it was
+    # asked to, unless one of them crashed it
+    finished = package_passed or (tests_seen and not crashed and not running)
+    results = []
+    for i in range(len(patterns)):
+        if ran[i] and not failed[i]:
+            results.append('pass')
+        elif ran[i]:
+            results.append(outputs[i])
+        elif finished:
+            # The test binary ran every test it was asked to, and none of
+            # them matches this pattern
+            results.append(NO_TESTS)
+        else:
+            # Build failure, or an earlier test crashed the test binary
+            results.append(outputs[i] + package_output)
+    return results
+
+
+def run_go_tests(test_cases, repo_path, project_cfg, verbose=False):
+    """
+    Run each batch of test cases with one "go test", returning a dict from
+    id(test_case) to its (actual output or exception, usage). The usage of
+    each "go test" is recorded with the first test case in its batch
+    """
+    results = {}
+    for key, batch in make_batches(test_cases).items():
+        patterns = [pattern for _, pattern in batch]
+        combined = '|'.join(f'({p})' for p in patterns)
+        cmd_line = [combined if arg is None else arg for arg in key]
+        usage = {}
+        try:
+            act = cmd_exec_capture(cmd_line, repo_path,
+                                   timeout=project_cfg.timeout * len(batch),
+                                   capture_stderr=project_cfg.capture_stderr,
+                                   decode_errors=project_cfg.decode_errors,
+                                   kill_grace=project_cfg.kill_grace,
+                                   usage=usage, use_cgroup=project_cfg.cgroup,
+                                   output_limit=OUTPUT_LIMIT * len(batch))
+            if project_cfg.strip_output:
+                act = act.replace(project_cfg.strip_output, '')
+            outcomes = demux_events(act, patterns, verbose)
+        except Exception as e:
+            # Every test case in the batch fails the same way
+            outcomes = [e] * len(batch)
+        for i, ((tc, _), outcome) in enumerate(zip(batch, outcomes)):
+            results[id(tc)] = (outcome, usage if i == 0 else {})
+    return results
@@ -2,19 +2,168 @@
 server.py is a base class for REST servers like Canvas and Github
 """
 
-import json
+from email.utils import parsedate_to_datetime
 from pprint import PrettyPrinter
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
 import requests
-import urllib.error
-from urllib.error import HTTPError, URLError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from .cache import HttpCache
 from .util import *
 
+# Responses which are worth retrying, since the server may succeed later.
+# Not 429, which RateLimiter handles, so that all requests wait for it
+RETRY_STATUSES = [500, 502, 503, 504]
+
+# bytes of a download to keep in memory before spilling to a temp file
+SPOOL_SIZE = 1 << 20
+
+# seconds to wait past X-RateLimit-Reset, for clock differences
+RESET_MARGIN = 1.0
+
+# seconds to wait after a 429 or secondary rate limit without Retry-After,
+# as GitHub recommends
+SECONDARY_WAIT = 60.0
+
+
+class ServerRetry(Retry):
+    # urllib3 retries a 429 with Retry-After whatever status_forcelist says
+    RETRY_AFTER_STATUS_CODES = frozenset([503])
+
+
+def parse_retry_after(value):
+    # Retry-After is either seconds or an HTTP-date. None if it's neither
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """
+    Tracks the request budget from GitHub's X-RateLimit-Remaining and
+    X-RateLimit-Reset headers. Each request takes one from the budget
+    before it's sent, so concurrent requests can't overspend it, and when
+    it runs out, requests wait until it resets. Servers which don't send
+    the headers are never throttled
+    """
+    def __init__(self):
+        self.remaining = None
+        self.reset = 0.0
+        self.blocked_until = 0.0
+        self.waits = 0
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+        # Wait, if need be, until a request may be sent
+        with self.lock:
+            now = time.time()
+            if self.remaining is not None and self.remaining <= 0 and self.reset > now:
+                self.blocked_until = max(self.blocked_until, self.reset + RESET_MARGIN)
+            if self.remaining is not None:
+                self.remaining -= 1
+            wait = self.blocked_until - now
+            if wait > 0:
+                self.waits += 1
+                self.waited += wait
+        if wait > 0:
+            time.sleep(wait)
+
+
+    def update(self, response):
+        remaining = response.headers.get('X-RateLimit-Remaining')
+        reset = response.headers.get('X-RateLimit-Reset')
+        if remaining is None or reset is None:
+            return
+        with self.lock:
+            self.remaining = int(remaining)
+            self.reset = float(reset)
+
+
+    def block(self, response):
+        """
+        If response says we've hit a primary or secondary rate limit, hold
+        back all requests until the limit lifts and return True, so the
+        request can be sent again
+        """
+        if response.status_code not in [403, 429]:
+            return False
+        retry_after = parse_retry_after(response.headers.get('Retry-After', ''))
+        if retry_after is not None:
+            until = time.time() + retry_after
+        elif response.headers.get('X-RateLimit-Remaining') == '0':
+            until = float(response.headers.get('X-RateLimit-Reset', 0)) + RESET_MARGIN
+        elif response.status_code == 429 or 'secondary rate limit' in response.text.lower():
+            until = time.time() + SECONDARY_WAIT
+        else:
+            # Forbidden for some other reason
+            return False
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, until)
+        return True
+
+
+    def format_stats(self):
+        return f'rate limited {self.waits} times, waited {self.waited:.1f}s'
+
+
+class ServerConfig(SafeConfig):
+    """
+    Connection settings shared by the [Canvas] and [Github] sections.
+    Subclasses set their own fields before calling this
+    """
+    def __init__(self, cfg):
+        self.timeout = 30.0         # seconds to wait for a response
+        self.connect_timeout = 10.0
+        self.retries = 3            # for connection errors, 429 and 5xx
+        self.backoff = 1.0          # seconds before the second retry, doubling after that
+        self.pool_size = 10         # connections kept open to each host
+        self.cache_ttl = 0.0        # seconds to use cached responses without asking the server
+        self.safe_update(cfg)
+
+
 class Server:
-    def __init__(self, host_name, token, verbose):
+    def __init__(self, host_name, token, verbose, server_cfg=None, cache=True):
         self.host_name = host_name
         self.access_token = token
         self._verbose = verbose  # can't name it the same as the function
+        self.server_cfg = server_cfg or ServerConfig({})
+        self.session = self.make_session()
+        # Requests and seconds waiting for responses, by host
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        self.rate_limiter = RateLimiter()
+        self.http_cache = HttpCache(self.server_cfg.cache_ttl) if cache else None
+
+
+    def make_session(self):
+        # One session, so connections are kept open between requests
+        cfg = self.server_cfg
+        retry = ServerRetry(
+            total=cfg.retries,
+            backoff_factor=cfg.backoff,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=['GET', 'PUT'],
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=cfg.pool_size, pool_maxsize=cfg.pool_size,
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
 
 
     def verbose(self, s):
@@ -35,31 +184,126 @@ class Server:
         return headers
 
 
-    # Use requests to GET the URL
-    def get_url(self, url, headers={}):
+    def request(self, method, url, **kwargs):
+        # Send a request through the session, recording how long it took,
+        # and sending it again if it hit a rate limit
+        timeout = (self.server_cfg.connect_timeout, self.server_cfg.timeout)
+        for attempt in range(self.server_cfg.retries + 1):
+            self.rate_limiter.acquire()
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            finally:
+                self.record(url, time.monotonic() - start)
+            self.rate_limiter.update(response)
+            if not self.rate_limiter.block(response):
+                break
+            self.verbose(f'{url} is rate limited')
+        return response
+
+
+    def record(self, url, seconds):
+        host = urlsplit(url).netloc
+        with self.stats_lock:
+            stats = self.stats.setdefault(host, {'requests': 0, 'seconds': 0.0})
+            stats['requests'] += 1
+            stats['seconds'] += seconds
+
+
+    def format_stats(self):
+        lines = []
+        for host, stats in self.stats.items():
+            average = stats['seconds'] / stats['requests']
+            lines.append(f"{host}: {stats['requests']} requests, {average:.2f}s average")
+        if self.rate_limiter.waits:
+            lines.append(self.rate_limiter.format_stats())
+        if self.http_cache:
+            lines.append(self.http_cache.format_stats())
+        return '\n'.join(lines)
+
+
+    @staticmethod
+    def parse_json(response):
+        # Error bodies aren't always JSON
+        try:
+            return response.json()
+        except ValueError:
+            return response.text
+
+
+    # Use requests to GET the URL. With ttl, use a cached response younger
+    # than that many seconds, rather than [Server] cache_ttl
+    def get_url(self, url, headers={}, ttl=None):
         # TODO: replace hard-coded access token with dynamic OAuth token
-        headers = self.add_auth_header(headers)
+        headers = self.add_auth_header(dict(headers))
+        entry = None
+        if self.http_cache:
+            entry, fresh = self.http_cache.get(url, headers, ttl)
+            if fresh:
+                self.verbose(f'{url} is cached')
+                return entry['body']
+        request_headers = dict(headers)
+        if entry:
+            self.http_cache.add_conditions(entry, request_headers)
         try:
-            response = requests.get(url, headers=headers)
+            response = self.request('GET', url, headers=request_headers)
             self.verbose(f'{url} returns {response.status_code}')
-            self.verbose(json.loads(response.text))
+            if response.status_code == requests.codes.not_modified and entry:
+                self.http_cache.not_modified(url, headers, entry)
+                return entry['body']
             response.raise_for_status()
         except Exception as e:
+            if self._verbose and isinstance(e, requests.HTTPError):
+                self.verbose(self.parse_json(e.response))
             # Callers don't have to re-warn() unless they have more info to add
             warn('get_url: ' + str(e))
             # Reraise so callers can decide whether it's fatal or not
             raise e
 
+        if self.http_cache:
+            # Not cached, or changed since it was
+            self.http_cache.count('misses')
         content_type = response.headers['Content-Type']
         # use 'in' rather than '==' to ignore charset spec in header
         if 'application/json' in content_type:
-            return json.loads(response.text)
+            obj = response.json()
+            self.verbose(obj)
+            if self.http_cache:
+                self.http_cache.put(url, headers, response.headers.get('ETag'),
+                                    response.headers.get('Last-Modified'), obj)
+            return obj
         elif 'application/zip' in content_type:
             return response.content
         else:
             fatal(f'Unexpected Content-Type: {content_type}')
 
 
+    def download(self, url, headers={}, limit=None):
+        """
+        Stream the body of url into a temp file, which stays in memory if
+        it's small, and return the file, rewound. Raises ValueError if the
+        body is over limit bytes
+        """
+        headers = self.add_auth_header(dict(headers))
+        response = self.request('GET', url, headers=headers, stream=True)
+        with response:
+            self.verbose(f'{url} returns {response.status_code}')
+            response.raise_for_status()
+            length = int(response.headers.get('Content-Length') or 0)
+            if limit and length > limit:
+                raise ValueError(f'{url} is {length} bytes, more than {limit}')
+            f = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+            total = 0
+            for chunk in response.iter_content(chunk_size=65536):
+                total += len(chunk)
+                if limit and total > limit:
+                    f.close()
+                    raise ValueError(f'{url} is more than {limit} bytes')
+                f.write(chunk)
+        f.seek(0)
+        return f
+
+
     def make_url(self, path):
         # Combine the hostname and path, creating a requestable URL
         url = f'https://{self.host_name}/{path}'
@@ -68,8 +312,8 @@ class Server:
 
 
     def put_url(self, url, headers, data):
-        headers = self.add_auth_header(headers)
-        response = requests.put(url, data=data, headers=headers)
+        headers = self.add_auth_header(dict(headers))
+        response = self.request('PUT', url, data=data, headers=headers)
         if response.status_code != requests.codes.ok:
-            self.verbose(json.loads(response.text))
+            self.verbose(self.parse_json(response))
         return response.status_code == requests.codes.ok
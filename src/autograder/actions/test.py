@@ -1,11 +1,16 @@
+import codecs
 from datetime import datetime as dt
 import difflib
 import json
 import os
 from subprocess import CalledProcessError, TimeoutExpired
+import time
 import traceback
 
-from .cmd import cmd_exec_capture, cmd_exec_rc, TIMEOUT
+from .cmd import cmd_exec_capture, cmd_exec_rc, KILL_GRACE, RLIMITS, TIMEOUT
+from .cache import BuildCache, ResultCache, dir_digest, tree_hash
+from .digital import run_digital
+from .gotest import run_go_tests
 from .util import *
 from .github import *
 
@@ -19,9 +24,63 @@ class TestCaseConfig(SafeConfig):
         self.name = None
         self.output = 'stdout'
         self.rubric = 0
+        # Resource limits override the same settings in [project]
+        self.rlimit_as = None
+        self.rlimit_cpu = None
+        self.rlimit_fsize = None
+        self.rlimit_nproc = None
         self.safe_update(cfg)
 
 
+class StreamMatcher:
+    """
+    Compares output line by line as cmd_exec() reads it, raising
+    OutputDiverged as soon as the output provably can't match. This uses
+    the same rules as TestCase.match_expected(), which still makes the
+    final decision for output which doesn't diverge
+    """
+    def __init__(self, test_case):
+        self.test_case = test_case
+        self.exp = test_case.make_lines(test_case.tc_cfg.expected.rstrip())
+        decode_errors = test_case.project_cfg.decode_errors
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors=decode_errors)
+        self.partial = ''
+        self.line = 0
+        self.enabled = True
+
+    def __call__(self, chunk):
+        if not self.enabled:
+            return
+        try:
+            text = self.decoder.decode(chunk)
+        except UnicodeDecodeError:
+            # Let the full decode in cmd_exec() report it
+            self.enabled = False
+            return
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.check_line(line)
+
+    def check_line(self, line):
+        strip_output = self.test_case.project_cfg.strip_output
+        if strip_output:
+            line = line.replace(strip_output, '')
+        act = self.test_case.make_lines(line)[0]
+        i = self.line
+        self.line += 1
+        if i < len(self.exp):
+            # A blank line where text is expected can't match either: it's
+            # a mismatch if more text follows, or too few lines if not
+            diverged = act != self.exp[i]
+        else:
+            # Extra lines only match if they're trailing blank lines, which
+            # rstrip() will remove
+            diverged = act != '\n'
+        if diverged:
+            raise OutputDiverged(self.line)
+
+
 class TestCase:
     def __init__(self, tc_cfg, project_cfg, args):
         self.tc_cfg = TestCaseConfig(tc_cfg)
@@ -90,18 +149,63 @@ class TestCase:
         return act
 
 
-    def get_actual(self, local):
+    def can_fail_fast(self):
+        # Streaming comparison only works for plain stdout compared line by
+        # line, and strip_output must not span lines
+        strip_output = self.project_cfg.strip_output or ''
+        return (self.project_cfg.fail_fast
+                and self.tc_cfg.output == 'stdout'
+                and self.project_cfg.build != 'go'
+                and '\n' not in strip_output)
+
+
+    def get_rlimits(self):
+        # Resource limits for this test case, falling back to [project]
+        rlimits = {}
+        for name in RLIMITS:
+            value = getattr(self.tc_cfg, name)
+            if value is None:
+                value = getattr(self.project_cfg, name)
+            rlimits[name] = value
+        return rlimits
+
+
+    def get_actual(self, local, usage=None):
         timeout = self.project_cfg.timeout
         capture_stderr = self.project_cfg.capture_stderr
+        decode_errors = self.project_cfg.decode_errors
+        kill_grace = self.project_cfg.kill_grace
+        rlimits = self.get_rlimits()
+        use_cgroup = self.project_cfg.cgroup
         if self.tc_cfg.output == 'stdout':
             # get actual output from stdout
-            act = cmd_exec_capture(self.cmd_line, local, timeout=timeout, 
-                                   capture_stderr=capture_stderr)
+            on_output = StreamMatcher(self) if self.can_fail_fast() else None
+            act = None
+            if self.project_cfg.digital_server:
+                act = run_digital(self.cmd_line, local, timeout,
+                                  capture_stderr=capture_stderr,
+                                  decode_errors=decode_errors, usage=usage)
+            try:
+                if act is None:
+                    act = cmd_exec_capture(self.cmd_line, local, timeout=timeout, 
+                                           capture_stderr=capture_stderr,
+                                           decode_errors=decode_errors,
+                                           kill_grace=kill_grace, rlimits=rlimits,
+                                           usage=usage, use_cgroup=use_cgroup,
+                                           on_output=on_output)
+            except OutputDiverged as e:
+                # Strip the partial output too, for the verbose diff
+                if self.project_cfg.strip_output:
+                    e.output = e.output.replace(self.project_cfg.strip_output, '')
+                raise
         else:
             # ignore stdout and get actual output from the specified file
             path = os.path.join(local, self.tc_cfg.output)
             act = cmd_exec_capture(self.cmd_line, local, path, timeout=timeout,
-                                   capture_stderr=capture_stderr)
+                                   capture_stderr=capture_stderr,
+                                   decode_errors=decode_errors,
+                                   kill_grace=kill_grace, rlimits=rlimits,
+                                   usage=usage, use_cgroup=use_cgroup)
     
         if self.project_cfg.strip_output:
             act = act.replace(self.project_cfg.strip_output, '')
@@ -161,6 +265,19 @@ class ProjectConfig(SafeConfig):
         self.subdir = None
         self.timeout = TIMEOUT
         self.capture_stderr = True
+        self.decode_errors = 'strict'
+        self.fail_fast = False  # stop the program when its output diverges
+        self.cgroup = True  # run each test in its own cgroup, if available
+        self.digital_server = False  # run Digital tests in a long-lived JVM
+        self.kill_grace = KILL_GRACE
+        self.build_timeout = 30
+        self.parallel_tests = 1
+        # Resource limits applied to each test program: CPU seconds,
+        # bytes of address space, processes for the user, bytes per file
+        self.rlimit_as = None
+        self.rlimit_cpu = None
+        self.rlimit_fsize = None
+        self.rlimit_nproc = None
         self.safe_update(cfg)
 
 class Test:
@@ -172,7 +289,17 @@ class Test:
         self.digital_path = os.path.expanduser(self.test_cfg.digital_path)
         self.test_cases = []
         self.load_test_cases()
-        self.build_err = ''
+        self.result_cache = None
+        if args.action == 'class' and not args.github_action and not args.no_cache:
+            # The [[tests]] are hashed one by one, so leave <project>.toml
+            # out of the digest of the tests repo
+            project_tests_path = os.path.join(self.tests_path, args.project)
+            digest = dir_digest(project_tests_path, exclude=[args.project + '.toml'])
+            self.result_cache = ResultCache(self.project_cfg, digest)
+        self.build_cache = None
+        if not args.github_action and not args.no_cache:
+            outputs = [tc.tc_cfg.output for tc in self.test_cases if tc.tc_cfg.output != 'stdout']
+            self.build_cache = BuildCache(self.project_cfg, outputs)
 
     def load_test_cases(self):
         # Load <project>.toml
@@ -214,11 +341,11 @@ class Test:
                 if not os.path.isfile(mfu_path) and not os.path.isfile(mfl_path):
                     build_err = f'Makefile not found: {mfu_path}'
                 else:
-                    if cmd_exec_rc(['make', '-C', repo_path], timeout=30) != 0:
+                    if cmd_exec_rc(['make', '-C', repo_path], timeout=self.project_cfg.build_timeout) != 0:
                         build_err = 'Program did not make successfully'
         elif b == 'go':
-            if cmd_exec_rc(['go', 'build']) != 0:
-                build_error = 'go build failed'
+            if cmd_exec_rc(['go', 'build'], wd=repo_path, timeout=self.project_cfg.build_timeout) != 0:
+                build_err = 'go build failed'
         else:
             fatal(f'Unknown build plan: \"{b}\"')
 
@@ -226,7 +353,24 @@ class Test:
             print_red(build_err, '')
         return build_err
 
-    def run_one_test(self, repo_path, test_case):
+    def build_cached(self, repo_path):
+        # Skip the build if the source and build products haven't changed
+        # since the last build, reporting the same build_err as last time
+        if self.build_cache is None or self.project_cfg.build == 'none':
+            return self.build(repo_path)
+        src_hash, record = self.build_cache.lookup(repo_path)
+        if record is not None:
+            build_err = record['build_err']
+            if build_err and self.args.verbose:
+                print_red(build_err, '')
+            return build_err
+        start = time.monotonic()
+        build_err = self.build(repo_path)
+        if src_hash is not None:
+            self.build_cache.record(repo_path, src_hash, build_err, time.monotonic() - start)
+        return build_err
+
+    def run_one_test(self, repo_path, test_case, go_results=None):
         '''
         Manage exceptions here so we can
         1. print them out in a friendly way
@@ -238,16 +382,26 @@ class Test:
         friendly_str = ''
         tb_str = ''
         try:
-            actual = test_case.get_actual(repo_path)
+            if go_results and id(test_case) in go_results:
+                # Already run by a batched "go test"
+                actual, usage = go_results[id(test_case)]
+                result['usage'].update(usage)
+                if isinstance(actual, Exception):
+                    raise actual
+            else:
+                actual = test_case.get_actual(repo_path, result['usage'])
             if test_case.match_expected(actual):
                 # Test case passed, accumulate score
                 result['score'] = test_case.tc_cfg.rubric
         except CalledProcessError:
             friendly_str = 'Program crashed'
             tb_str = traceback.format_exc()
-        except TimeoutExpired:
+        except TimeoutExpired as e:
             friendly_str = 'Program timed out (infinite loop?)'
             tb_str = traceback.format_exc()
+            teardown_time = getattr(e, 'teardown_time', None)
+            if teardown_time is not None and self.args.verbose:
+                print_yellow(f'Stopping program took {teardown_time:.3f}s', '\n')
         except PermissionError:
             friendly_str = 'Program is not executable'
             tb_str = traceback.format_exc()
@@ -260,6 +414,10 @@ class Test:
         except OutputLimitExceeded:
             friendly_str = 'Program produced too much output (infinite loop?)'
             tb_str = traceback.format_exc()
+        except OutputDiverged as e:
+            friendly_str = f'Output diverged from expected at line {e.line}'
+            # Show the diff of the output we got before stopping the program
+            test_case.match_expected(e.output)
         except OSError as e:
             friendly_str = 'OSError: ' + str(e)
 
@@ -287,23 +445,98 @@ class Test:
         return result
 
 
-    def run_test_cases(self, repo_path):
-        results = []
+    def make_lanes(self, test_cases):
+        """
+        Group test cases into lanes which can run concurrently. Test cases
+        which read their actual output from the same file would clobber
+        each other, so they share a lane and run one after another
+        """
+        lanes = []
+        by_output = {}
+        for tc in test_cases:
+            if tc.tc_cfg.output == 'stdout':
+                lanes.append([tc])
+                continue
+            key = os.path.normpath(tc.tc_cfg.output)
+            if key not in by_output:
+                by_output[key] = []
+                lanes.append(by_output[key])
+            by_output[key].append(tc)
+        return lanes
+
+
+    def run_test_cases(self, repo_path, tree=None):
+        test_cases = []
         if self.args.test_name is not None:
             for tc in self.test_cases:
                 if tc.tc_cfg.name == self.args.test_name:
-                    results.append(self.run_one_test(repo_path, tc))
+                    test_cases.append(tc)
         else:
-            for tc in self.test_cases:
-                results.append(self.run_one_test(repo_path, tc))
+            test_cases = self.test_cases
+
+        # With a tree hash, look for results from an earlier run
+        cached = {}
+        if tree:
+            for tc in test_cases:
+                result = self.result_cache.get(tree, tc)
+                if result is not None:
+                    cached[id(tc)] = result
+        uncached = [tc for tc in test_cases if id(tc) not in cached]
+
+        go_results = {}
+        if self.project_cfg.build == 'go':
+            go_results = run_go_tests(uncached, repo_path, self.project_cfg,
+                                      self.args.very_verbose)
+
+        def run_test(tc):
+            if id(tc) in cached:
+                result = cached[id(tc)]
+                result_str = format_pass_fail(result)
+                if failed(result):
+                    print_red(result_str)
+                else:
+                    print_green(result_str)
+                return result
+            result = self.run_one_test(repo_path, tc, go_results)
+            # Don't remember crashes and timeouts, which may not happen
+            # next time, only whether the output matched
+            if tree and not result.get('test_err'):
+                self.result_cache.put(tree, tc, dict(result, usage={}))
+            return result
+
+        jobs = self.args.parallel_tests or self.project_cfg.parallel_tests
+        if jobs <= 1:
+            return [run_test(tc) for tc in test_cases]
+
+        # Buffer each test case's output separately, so the lanes can
+        # finish in any order but we still print in TOML order
+        def run_lane(lane):
+            lane_results = []
+            for tc in lane:
+                with buffered_output() as buf:
+                    result = run_test(tc)
+                lane_results.append((tc, result, buf.getvalue()))
+            return lane_results
+
+        by_tc = {}
+        for lane_results in run_buffered(run_lane, self.make_lanes(test_cases), jobs):
+            for tc, result, text in lane_results:
+                by_tc[id(tc)] = (result, text)
+
+        results = []
+        for tc in test_cases:
+            result, text = by_tc[id(tc)]
+            print(text, end='')
+            results.append(result)
         return results
 
 
     # Build up the submission comment to send to Canvas
     def make_comment(self, repo_result):
         comment = ''
-        if (self.build_err):
-            comment += f'{self.build_err} '
+        build_err = repo_result.get('build_err')
+        if (build_err):
+            comment += f'{build_err} '
         for result in repo_result['results']:
             comment += format_pass_fail(result)
             if result.get('test_err'):
@@ -333,23 +566,32 @@ class Test:
             print_red(err, e='\n')
             return repo_result
 
-        self.build_err = self.build(repo_path)
-        if self.build_err:
+        # Keep build_err local rather than in self, since
+        # repos may be tested concurrently with --jobs
+        build_err = self.build_cached(repo_path)
+        if build_err:
             # Only if an error occurred. That way you can search
             # the <project>.json file for 'build_err' and find only real errors
             repo_result.update({
-                'build_err': self.build_err
+                'build_err': build_err
             })
 
-        # Run the test cases
-        tc_results = self.run_test_cases(repo_path)
+        # Run the test cases, reusing earlier results for this commit
+        tree = tree_hash(repo_path) if self.result_cache else None
+        tc_results = self.run_test_cases(repo_path, tree)
         repo_result.update({
             'results'     : tc_results,
             'score'       : self.total_score(tc_results),
         })
         # Build the comment which will be visible in Canvas
         repo_result['comment'] = self.make_comment(repo_result)
-        
+
+        # Report background processes which outlived their test case
+        leaked = sum(r['usage'].get('leaked', 0) for r in tc_results)
+        if leaked:
+            repo_result['leaked'] = leaked
+            print_yellow(f'killed {leaked} leaked processes ')
+
 
         # Print net score for the repo
         print(self.make_earned_avail(repo_result))
@@ -41,3 +41,4 @@ def upload_class(cfg, args):
         login_id = mapper.lookup(result['student'])
         canvas.add_score(login_id, result['score'], result['comment'])
     canvas.upload()
+    print(canvas.format_stats())
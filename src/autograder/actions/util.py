@@ -2,12 +2,24 @@
 util.py is the "junk drawer" of code which is shared by multiple modules
 """
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
+import io
+import os
 import sys
+import threading
 import tomlkit
 
 class OutputLimitExceeded(Exception):
     pass
 
+class OutputDiverged(Exception):
+    # Raised when streamed output can no longer match the expected output
+    def __init__(self, line):
+        super().__init__(f'Output diverged at line {line}')
+        self.line = line
+        self.output = ''
+
 class SafeConfig(object):
     def safe_update(self, src):
         # Only copy values from src when the key is in dest
@@ -47,6 +59,156 @@ def print_justified(s, longest):
         print(' ', end='')
 
 
+# Per-thread output buffers so that concurrent workers don't interleave
+# their colored output on the console
+_output = threading.local()
+_output_lock = threading.Lock()
+
+
+class ThreadedStdout(object):
+    """
+    Stand-in for sys.stdout which sends each thread's writes to that
+    thread's buffer, if it has one, or else to the real stdout
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, s):
+        buf = getattr(_output, 'buffer', None)
+        if buf is not None:
+            return buf.write(s)
+        with _output_lock:
+            return self.stream.write(s)
+
+    def flush(self):
+        if getattr(_output, 'buffer', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+@contextmanager
+def threaded_stdout():
+    # Install ThreadedStdout for the duration of a parallel run
+    if isinstance(sys.stdout, ThreadedStdout):
+        yield sys.stdout
+        return
+    saved = sys.stdout
+    sys.stdout = ThreadedStdout(saved)
+    try:
+        yield sys.stdout
+    finally:
+        sys.stdout = saved
+
+
+@contextmanager
+def buffered_output():
+    # Collect everything this thread prints until the block exits
+    saved = getattr(_output, 'buffer', None)
+    _output.buffer = io.StringIO()
+    try:
+        yield _output.buffer
+    finally:
+        _output.buffer = saved
+
+
+def write_atomic(s):
+    # Write one worker's buffered output as a single block
+    buf = getattr(_output, 'buffer', None)
+    if buf is not None:
+        # Nested worker: pass the block up to the enclosing buffer
+        buf.write(s)
+        return
+    stream = sys.stdout
+    if isinstance(stream, ThreadedStdout):
+        stream = stream.stream
+    with _output_lock:
+        stream.write(s)
+        stream.flush()
+
+
+def run_buffered(fn, items, jobs, ordered=True):
+    """
+    Call fn(item) for each item on a pool of jobs threads, returning the
+    results in the same order as items. Each call's output is buffered and
+    written atomically, either in item order or as each call completes
+    """
+    def worker(item):
+        with buffered_output() as buf:
+            try:
+                return fn(item), buf.getvalue(), None
+            except Exception as e:
+                return None, buf.getvalue(), e
+
+    if jobs <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+
+    with threaded_stdout(), ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(worker, item) for item in items]
+        if not ordered:
+            for f in as_completed(futures):
+                write_atomic(f.result()[1])
+        results = []
+        for f in futures:
+            result, text, err = f.result()
+            if ordered:
+                write_atomic(text)
+            if err:
+                raise err
+            results.append(result)
+    return results
+
+
+def run_pipeline(first, second, items, first_jobs, second_jobs):
+    """
+    Call first(item) for each item on a pool of first_jobs threads, and
+    second(item, first_result) on a pool of second_jobs threads as soon as
+    that item's first call returns, so the two stages overlap. Returns the
+    results of second in the same order as items. Each item's output from
+    both stages is written atomically when its second call completes
+    """
+    def run_stage(fn, *fn_args, text=''):
+        with buffered_output() as buf:
+            buf.write(text)
+            try:
+                return fn(*fn_args), buf.getvalue(), None
+            except Exception as e:
+                return None, buf.getvalue(), e
+
+    def run_second(item, first_outcome):
+        result, text, err = first_outcome
+        if err:
+            return None, text, err
+        return run_stage(second, item, result, text=text)
+
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    with threaded_stdout(), \
+         ThreadPoolExecutor(max_workers=first_jobs) as first_pool, \
+         ThreadPoolExecutor(max_workers=second_jobs) as second_pool:
+        first_futures = {first_pool.submit(run_stage, first, item): i
+                         for i, item in enumerate(items)}
+        second_futures = {}
+        pending = set(first_futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                if f in first_futures:
+                    i = first_futures[f]
+                    sf = second_pool.submit(run_second, items[i], f.result())
+                    second_futures[sf] = i
+                    pending.add(sf)
+                else:
+                    i = second_futures[f]
+                    results[i], text, errors[i] = f.result()
+                    write_atomic(text)
+    for err in errors:
+        if err:
+            raise err
+    return results
+
+
 def failed(tc_result):
     if tc_result['score'] == 0:
         return True
@@ -90,6 +252,12 @@ def project_from_cwd(cwd):
     return cwd.name if i == -1 else cwd.name[:i]
 
 
+def cache_path(*parts):
+    # Path under the per-user cache directory, e.g. ~/.cache/grade/...
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'grade', *parts)
+
+
 def init_repo_result(student):
     # Shared between test.py and github.py
     # Write this as a plain dict rather than a class so it's JSON serializable
@@ -108,4 +276,5 @@ def init_tc_result(rubric, test_name):
         'rubric': rubric,
         'score' : 0,
         'test'  : test_name,
+        'usage' : {},  # wall time, CPU time and max RSS from cmd_exec()
     }
@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 
+import copy
 import json
 import os
+import threading
 import traceback
 
 from .actions.cmd import *
 from .actions.util import *
 
+from .actions.archive import Archive
+from .actions.cache import tree_hash
 from .actions.canvas import CanvasMapper
 from .actions.config import Args, Config
 from .actions.dates import Dates
@@ -19,8 +23,8 @@ from .actions.rollup import rollup
 class Repo:
     def __init__(self, project, **kwargs):
         self.student = kwargs.get('student')
-        date_obj = kwargs.get('date')
-        self.suffix = date_obj.suffix if date_obj else ''
+        self.date = kwargs.get('date')
+        self.suffix = self.date.suffix if self.date else ''
         if self.student:
             self.remote_path = f'{project}-{self.student}'
             if self.suffix:
@@ -31,6 +35,7 @@ class Repo:
         else:
             self.remote_path = None  # shouldn't be used
             self.local_path = kwargs.get('local')
+        self.root_path = self.local_path  # top of the git repo
         if kwargs.get('subdir'):
             self.local_path = os.path.join(self.local_path, kwargs.get('subdir'))
         self.label = self.local_path.split('/')[-1]
@@ -47,14 +52,30 @@ def make_student_list(cfg, args):
             fatal(f"Must either 'test' one repo or give a list of students in {Config.get_path()}")
     return students
 
+def write_class_results(tester, class_results, fname):
+    # Summary by score frequency
+    tester.print_histogram(class_results)
+
+    # Serialize results into json
+    class_json = json.dumps(class_results, indent=4, sort_keys=True)
+    with open(fname, 'w') as f:
+        f.write(class_json)
+
 def main():
     cfg = Config.from_path(Config.get_path())
     args = Args.from_cmdline()
     tester = Test(cfg.test_cfg, args)
     
+    if args.all_dates and args.by_date:
+        fatal('--all-dates grades every date, so it can\'t be used with --by-date')
+    if args.all_dates and (args.action not in ['archive', 'class', 'restore'] or args.github_action):
+        fatal('--all-dates only works with class, archive, and restore, without --github-action')
+    if args.pipeline and (args.action != 'class' or args.github_action or args.all_dates):
+        fatal('--pipeline only works with class, without --github-action or --all-dates')
+
     # Only load dates when needed for specific actions
     dates = None
-    if args.by_date:
+    if args.by_date or args.all_dates:
         dates = Dates.from_path(tester.tests_path, args)
 
     if args.action == 'upload':
@@ -66,14 +87,18 @@ def main():
         return 0
 
     date = None
-    if args.by_date:
+    if args.by_date and not args.all_dates:
         # The clone and class actions will use this date
         date = dates.select_date()
         if date is None:
             return 0
 
     git = Git(cfg.git_cfg, args, date)
+    if args.action == 'mirror':
+        git.maintain_mirror()
+        return 0
     github = Github(cfg.github_cfg, args, git.cfg.org)
+    archive = Archive(args)
 
     # Build list of repos to run, either from '.' or list of students
     repos = []
@@ -81,6 +106,16 @@ def main():
     if args.action == 'test':
         repo = Repo(args.project, local='.', subdir=subdir)
         repos.append(repo)
+    elif args.all_dates:
+        # One repo for each student and date, checked out as worktrees of
+        # one clone per student
+        milestones = {}
+        for s in make_student_list(cfg, args):
+            milestones[s] = []
+            for d in dates.dates:
+                repo = Repo(args.project, student=s, subdir=subdir, date=d)
+                milestones[s].append((repo, d))
+                repos.append(repo)
     else:
         # Make repo list from student list
         for s in make_student_list(cfg, args):
@@ -95,15 +130,29 @@ def main():
             longest = l
     longest += 1
 
-    # Run the specified actions for all of the repos
-    class_results = []
-    for repo in repos:
+    if args.all_dates and args.action == 'class':
+        def checkout_student(student):
+            base = Repo(args.project, student=student)
+            print_justified(base.local_path, longest)
+            try:
+                git.checkout_milestones(base, milestones[student])
+            except Exception as e:
+                print_red(traceback.format_exc(), '\n');
+
+        run_buffered(checkout_student, list(milestones), args.git_jobs)
+
+    # Run the specified action for one repo, returning its results, if any
+    def run_repo(repo):
         print_justified(repo.local_path, longest)
         try:
             if args.action == 'clone':
-                git.clone(repo)
+                return git.clone(repo)
             elif args.action == 'pull':
-                git.pull(repo)
+                return git.pull(repo)
+            elif args.action == 'archive':
+                return archive.add(repo)
+            elif args.action == 'restore':
+                return archive.restore(repo)
             elif args.action == 'exec':
                 output = cmd_exec_capture(args.exec_cmd, wd=repo.local_path, shell=True)
                 print(output)
@@ -114,26 +163,129 @@ def main():
                 else:
                     repo_results = tester.test(repo)
                 if args.action == 'class':
-                    repo_results['comment'] = git.get_url_for_hash(repo_results['comment'], repo)
-                    class_results.append(repo_results)
+                    return repo_results
         except Exception as e:
             print_red(traceback.format_exc(), '\n');
-            continue
+        return None
 
-    if args.action == 'class':
-        # Summary by score frequency
-        tester.print_histogram(class_results)
+    # Repos with the same git tree are identical (e.g. untouched starter
+    # code), so only grade the first repo with each tree
+    jobs = 1
+    if args.action == 'class' and args.github_action:
+        # Waiting on api.github.com rather than grading
+        jobs = github.github_cfg.concurrency
+    elif args.action == 'class':
+        jobs = args.jobs
+    elif args.action in ['clone', 'pull']:
+        jobs = args.git_jobs
+    dedup = args.action == 'class' and not args.github_action
+    first_with_tree = {}
+    same_as = {}
+    lock = threading.Lock()
+
+    def claim_tree(repo, tree):
+        # Returns False if another repo with this tree is being graded
+        if tree is None:
+            return True
+        with lock:
+            if tree in first_with_tree:
+                same_as[id(repo)] = first_with_tree[tree]
+                return False
+            first_with_tree[tree] = repo
+            return True
+
+    if args.pipeline:
+        # Clone (or pull) each repo and grade it as soon as it's ready, so
+        # downloading later repos overlaps with grading earlier ones
+        def fetch(repo):
+            print_justified(repo.local_path, longest)
+            try:
+                if os.path.isdir(repo.local_path) and not args.by_date:
+                    git.pull(repo)
+                    print()
+                else:
+                    git.clone(repo)
+            except Exception as e:
+                print_red(traceback.format_exc(), '\n');
+            return tree_hash(repo.local_path)
 
-        # Serialize results into json
-        class_json = json.dumps(class_results, indent=4, sort_keys=True)
+        def grade_fetched(repo, tree):
+            return run_repo(repo) if claim_tree(repo, tree) else None
 
-        # Write results to JSON file, including date suffix if specified in cmd line args
-        if date:
-            fname = args.project + '-' + date.suffix + '.json'
+        all_results = run_pipeline(fetch, grade_fetched, repos, args.git_jobs, jobs)
+        results_by_repo = dict(zip([id(r) for r in repos], all_results))
+    else:
+        if dedup:
+            trees = run_buffered(lambda r: tree_hash(r.local_path), repos, jobs)
+            for repo, tree in zip(repos, trees):
+                claim_tree(repo, tree)
+        unique_repos = [r for r in repos if id(r) not in same_as]
+
+        # Run the specified actions for all of the repos. With --jobs, repos
+        # are graded concurrently, and each repo's output is printed as one
+        # block when it finishes. Results are still collected in student order.
+        # With --git-jobs, clone and pull output is printed in student order
+        ordered = args.action != 'class'
+        unique_results = run_buffered(run_repo, unique_repos, jobs, ordered=ordered)
+        results_by_repo = dict(zip([id(r) for r in unique_repos], unique_results))
+
+    if args.action in ['clone', 'pull']:
+        print(Git.format_summary(results_by_repo.values()))
+    elif args.action == 'archive':
+        archive.add_results()
+        archive.pack()
+        print(Archive.format_summary(results_by_repo.values()))
+    elif args.action == 'restore':
+        archive.restore_results()
+        print(Archive.format_summary(results_by_repo.values()))
+
+    graded = []
+    if args.action == 'class':
+        for repo in repos:
+            if id(repo) in same_as:
+                # Copy the results, but each student gets their own comment
+                # with the URL of their own commit
+                first = same_as[id(repo)]
+                repo_results = copy.deepcopy(results_by_repo[id(first)])
+                print_justified(repo.local_path, longest)
+                if repo_results is None:
+                    print()
+                    continue
+                repo_results['student'] = repo.student
+                print(f'same as {first.local_path} {tester.make_earned_avail(repo_results)}')
+            else:
+                repo_results = results_by_repo[id(repo)]
+                if repo_results is None:
+                    continue
+                # Leave the comment without a URL for any copies
+                repo_results = dict(repo_results)
+            repo_results['comment'] = git.get_url_for_hash(repo_results['comment'], repo)
+            graded.append((repo, repo_results))
+
+    if args.action == 'class':
+        if args.all_dates:
+            # A JSON file for each date, as if graded with --by-date, and
+            # then the rollup of them all
+            for d in dates.dates:
+                print(f'{d.suffix}:')
+                class_results = [r for repo, r in graded if repo.date is d]
+                write_class_results(tester, class_results, f'{args.project}-{d.suffix}.json')
         else:
-            fname = args.project + '.json'
-        with open(fname, 'w') as f:
-            f.write(class_json)
+            # Write results to JSON file, including date suffix if specified in cmd line args
+            if date:
+                fname = args.project + '-' + date.suffix + '.json'
+            else:
+                fname = args.project + '.json'
+            write_class_results(tester, [r for repo, r in graded], fname)
+
+        if tester.result_cache:
+            print(tester.result_cache.format_stats())
+        if tester.build_cache:
+            print(tester.build_cache.format_stats())
+        if args.github_action:
+            print(github.format_stats())
+        if args.all_dates:
+            rollup(cfg, args, dates.dates)
 
 
 if __name__ == "__main__":
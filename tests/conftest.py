@@ -18,6 +18,17 @@ def no_network(monkeypatch):
     monkeypatch.setattr(requests, "get", _block, raising=True)
     monkeypatch.setattr(requests, "put", _block, raising=True)
 
+    # Sessions may only talk to servers started by the tests
+    session_request = requests.Session.request
+
+    def _local_only(self, method, url, *args, **kwargs):
+        from urllib.parse import urlsplit
+        if urlsplit(url).hostname != "127.0.0.1":
+            _block()
+        return session_request(self, method, url, *args, **kwargs)
+
+    monkeypatch.setattr(requests.Session, "request", _local_only, raising=True)
+
 
 @pytest.fixture
 def fake_cwd(tmp_path, monkeypatch):
@@ -32,3 +43,9 @@ def import_util():
     import importlib
     return importlib.import_module("actions.util")
 
+
+
+@pytest.fixture(autouse=True)
+def tmp_cache(tmp_path_factory, monkeypatch):
+    # Keep files cached by grade out of the user's ~/.cache
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path_factory.mktemp("cache")))
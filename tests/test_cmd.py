@@ -40,3 +40,272 @@ def test_cmd_exec_output_limit_exceeded():
     with pytest.raises(CMD.OutputLimitExceeded):
         CMD.cmd_exec(py_cmd(big), timeout=5, output_limit=1000)
 
+
+
+def test_cmd_exec_returns_when_child_holds_stdout():
+    # A background process keeps the pipe open after the shell exits.
+    # We should return when the shell exits, not when the pipe closes
+    import time
+    start = time.monotonic()
+    out = CMD.cmd_exec_capture(["sh", "-c", "sleep 3 & echo hi"], timeout=10)
+    assert out == "hi"
+    assert time.monotonic() - start < 1.0
+
+
+def test_cmd_exec_captures_large_output():
+    out = CMD.cmd_exec_capture(["sh", "-c", "seq 1 20000"], timeout=10)
+    lines = out.split("\n")
+    assert len(lines) == 20000
+    assert lines[-1] == "20000"
+
+
+def test_cmd_exec_multibyte_output_across_reads(monkeypatch):
+    # Force tiny reads so multibyte characters straddle read boundaries
+    monkeypatch.setattr(CMD, "READ_BUFFER_SIZE", 3)
+    text = "héllo wörld ✓" * 50
+    out = CMD.cmd_exec_capture(py_cmd(text), timeout=5)
+    assert out == text
+
+
+def test_cmd_exec_output_limit_counts_bytes():
+    # 400 characters but 800 bytes of UTF-8
+    with pytest.raises(CMD.OutputLimitExceeded):
+        CMD.cmd_exec(py_cmd("é" * 400), timeout=5, output_limit=600)
+    presults = CMD.cmd_exec(py_cmd("é" * 400), timeout=5, output_limit=801)
+    assert presults.stdout == "é" * 400 + "\n"
+
+
+def test_cmd_exec_decode_errors_policy():
+    bad = [sys.executable, "-c", "import sys; sys.stdout.buffer.write(b'ok\\xff')"]
+    with pytest.raises(UnicodeDecodeError):
+        CMD.cmd_exec_capture(bad, timeout=5)
+    assert CMD.cmd_exec_capture(bad, timeout=5, decode_errors="replace") == "ok�"
+
+
+def test_cmd_exec_capture_empty_output():
+    assert CMD.cmd_exec_capture(py_exit(0), timeout=5) == ""
+
+
+def test_cmd_exec_timeout_teardown_is_fast():
+    import subprocess, time
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired) as e:
+        CMD.cmd_exec(py_sleep(30), timeout=0.2)
+    # sleep exits on SIGTERM, so there's no grace period to wait out
+    assert time.monotonic() - start < 1.0
+    assert e.value.teardown_time < 0.5
+
+
+def test_cmd_exec_timeout_escalates_to_sigkill(tmp_path):
+    import subprocess, time
+    pidfile = tmp_path / "child.pid"
+    # The shell and its background child both ignore SIGTERM
+    script = f"trap '' TERM; sleep 30 & echo $! > {pidfile}; wait"
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired) as e:
+        CMD.cmd_exec(["sh", "-c", script], timeout=0.2, kill_grace=0.3)
+    assert e.value.teardown_time >= 0.3
+    assert time.monotonic() - start < 2.0
+    # The background child is gone, or at most a zombie waiting for init
+    child = int(pidfile.read_text())
+    try:
+        stat = open(f"/proc/{child}/stat").read()
+        assert stat[stat.rindex(")") + 2] == "Z"
+    except FileNotFoundError:
+        pass
+
+
+def test_cmd_exec_records_usage():
+    usage = {}
+    spin = [sys.executable, "-c", "import time\nt = time.process_time()\nwhile time.process_time() - t < 0.2: pass"]
+    presults = CMD.cmd_exec(spin, timeout=5, usage=usage)
+    assert presults.returncode == 0
+    assert usage['utime'] + usage['stime'] >= 0.15
+    assert usage['wall'] >= usage['utime']
+
+
+def test_cmd_exec_records_the_programs_own_rss():
+    import resource
+    # true is far smaller than pytest, whose RSS the kernel would report
+    usage = {}
+    CMD.cmd_exec(["true"], timeout=5, usage=usage)
+    assert usage['maxrss_kb'] is None
+    ours = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    grow = [sys.executable, "-c", f"x = b'x' * {(ours + 50000) * 1024}"]
+    CMD.cmd_exec(grow, timeout=10, usage=usage)
+    assert usage['maxrss_kb'] > ours + 40000
+
+
+def test_cmd_exec_rlimits_applied_in_child(tmp_path):
+    # A CPU-bound loop is stopped by RLIMIT_CPU long before the wall timeout
+    spin = [sys.executable, "-c", "while True: pass"]
+    usage = {}
+    presults = CMD.cmd_exec(spin, timeout=10, rlimits={'rlimit_cpu': 1}, usage=usage)
+    assert presults.returncode < 0
+    assert usage['wall'] < 5
+
+    # RLIMIT_FSIZE stops writes past the limit
+    out = tmp_path / "big.txt"
+    write = [sys.executable, "-c", f"open({str(out)!r}, 'w').write('x' * 100000)"]
+    presults = CMD.cmd_exec(write, timeout=5, rlimits={'rlimit_fsize': 1000, 'rlimit_as': None})
+    assert presults.returncode != 0
+    assert out.stat().st_size <= 1000
+
+
+def test_cmd_exec_rlimits_applied_before_the_program_runs():
+    # The first thing the program does is read its limits
+    limits = {'rlimit_cpu': 3, 'rlimit_fsize': 1 << 20, 'rlimit_as': 1 << 30, 'rlimit_nproc': 4000}
+    for use_cgroup in [False, True]:
+        presults = CMD.cmd_exec(["cat", "/proc/self/limits"], timeout=5, rlimits=limits,
+                                use_cgroup=use_cgroup)
+        table = {line[:26].strip(): line[26:].split()[:2] for line in presults.stdout.splitlines()}
+        assert table['Max cpu time'] == ['3', '4']
+        assert table['Max file size'] == [str(1 << 20)] * 2
+        assert table['Max address space'] == [str(1 << 30)] * 2
+        assert table['Max processes'] == ['4000', '4000']
+
+
+def test_cmd_exec_kills_leaked_background_processes(tmp_path):
+    pidfile = tmp_path / "child.pid"
+    usage = {}
+    CMD.cmd_exec(["sh", "-c", f"sleep 30 > /dev/null & echo $! > {pidfile}"],
+                 timeout=5, usage=usage)
+    assert usage['leaked'] == 1
+    child = int(pidfile.read_text())
+    assert child not in (CMD.group_members(child) or [])
+    assert not CMD.live_groups
+
+
+def test_cmd_exec_runs_without_cgroup_when_it_cannot_join(tmp_path, monkeypatch):
+    # cgroup.procs can't be written, like a threaded or domain-invalid cgroup
+    cgroup = tmp_path / "cmd-0"
+    (cgroup / "cgroup.procs").mkdir(parents=True)
+    monkeypatch.setattr(CMD, "make_cgroup", lambda: str(cgroup))
+    presults = CMD.cmd_exec(["echo", "hi"], timeout=5, use_cgroup=True)
+    assert presults.stdout == "hi\n"
+    presults = CMD.cmd_exec("echo $0", timeout=5, shell=True, use_cgroup=True)
+    assert presults.stdout == "/bin/sh\n"
+
+
+def test_cmd_exec_reports_unrunnable_programs_with_cgroup(tmp_path, monkeypatch):
+    import os
+    cgroup = tmp_path / "cmd-0"
+    monkeypatch.setattr(CMD, "make_cgroup", lambda: (cgroup.mkdir(), str(cgroup))[1])
+    with pytest.raises(FileNotFoundError):
+        CMD.cmd_exec(["./missing"], wd=str(tmp_path), timeout=5, use_cgroup=True)
+    with pytest.raises(FileNotFoundError):
+        CMD.cmd_exec(["no-such-program-anywhere"], timeout=5, use_cgroup=True)
+    prog = tmp_path / "prog"
+    prog.write_text("#!/bin/sh\necho hi\n")
+    with pytest.raises(PermissionError):
+        CMD.cmd_exec(["./prog"], wd=str(tmp_path), timeout=5, use_cgroup=True)
+    assert not cgroup.exists()
+    prog.chmod(0o755)
+    presults = CMD.cmd_exec(["./prog"], wd=str(tmp_path), timeout=5, use_cgroup=True)
+    assert presults.stdout == "hi\n"
+
+
+def test_cmd_exec_scans_proc_only_for_leftover_groups(monkeypatch):
+    scanned = []
+    group_members = CMD.group_members
+    monkeypatch.setattr(CMD, "group_members", lambda pgid: scanned.append(pgid) or group_members(pgid))
+    usage = {}
+    CMD.cmd_exec(["true"], timeout=5, usage=usage)
+    assert usage['leaked'] == 0
+    assert scanned == []
+
+
+def test_cmd_exec_cgroup_catches_daemonized_processes(tmp_path):
+    import os
+    cgroup = CMD.make_cgroup()
+    if cgroup is None:
+        pytest.skip("cgroup v2 is not available")
+    os.rmdir(cgroup)
+    pidfile = tmp_path / "child.pid"
+    usage = {}
+    # setsid moves the child out of our process group, but not the cgroup
+    script = f"setsid -f sh -c 'echo $$ > {pidfile}; exec sleep 30' > /dev/null; sleep 0.2"
+    CMD.cmd_exec(["sh", "-c", script], timeout=5, usage=usage, use_cgroup=True)
+    assert usage['leaked'] == 1
+    child = int(pidfile.read_text())
+    try:
+        stat = open(f"/proc/{child}/stat").read()
+        assert stat[stat.rindex(")") + 2] == "Z"
+    except FileNotFoundError:
+        pass
+
+
+FAKE_DIGITAL_SERVER = r'''
+import sys
+out = sys.stdout.buffer
+out.write(b"READY\n"); out.flush()
+for line in sys.stdin.buffer:
+    _, n, capture_stderr = line.split()
+    args = [sys.stdin.buffer.readline().rstrip(b"\n") for _ in range(int(n))]
+    if args[0] == b"hang":
+        while True:
+            pass
+    if args[0] == b"exit":
+        sys.exit(1)
+    data = b" ".join(args) + b"\n"
+    out.write(b"OUT %d 0\n" % len(data) + data); out.flush()
+'''
+
+
+def test_digital_server_runs_commands_in_one_process(tmp_path):
+    from autograder.actions import digital as DIG
+    fake = tmp_path / "fake.py"
+    fake.write_text(FAKE_DIGITAL_SERVER)
+    server = DIG.DigitalServer([sys.executable, str(fake)])
+    server.start()
+    try:
+        pid = server.proc.pid
+        assert server.run(["test", "a.dig"], timeout=5) == (0, b"test a.dig\n")
+        assert server.run(["test", "b.dig"], timeout=5) == (0, b"test b.dig\n")
+        assert server.proc.pid == pid
+
+        # A hung command kills the JVM, and the next command starts another
+        with pytest.raises(CMD.subprocess.TimeoutExpired):
+            server.run(["hang"], timeout=0.5)
+        assert server.proc is None
+        assert server.run(["test", "c.dig"], timeout=5) == (0, b"test c.dig\n")
+
+        with pytest.raises(DIG.DigitalServerError):
+            server.run(["exit"], timeout=5)
+        assert server.proc is None
+    finally:
+        server.stop()
+
+
+def test_run_digital_falls_back_to_separate_process(tmp_path):
+    from autograder.actions import digital as DIG
+    assert DIG.parse_cmd_line(["java", "-cp", "D.jar", "CLI", "test", "x.dig"]) == ("D.jar", ["test", "x.dig"])
+    assert DIG.parse_cmd_line(["java", "-jar", "D.jar", "test"]) is None
+    assert DIG.run_digital(["./prog", "arg"], str(tmp_path), timeout=5) is None
+    # No JVM to start: remember that, and let the caller spawn the command
+    cmd_line = [str(tmp_path / "missing" / "java"), "-cp", "D.jar", "CLI", "test"]
+    assert DIG.run_digital(cmd_line, str(tmp_path), timeout=5) is None
+    assert (cmd_line[0], "D.jar") in DIG.unsupported
+
+
+def test_run_digital_shares_servers_between_threads(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+    from autograder.actions import digital as DIG
+    fake = tmp_path / "fake.py"
+    fake.write_text(FAKE_DIGITAL_SERVER)
+    java = tmp_path / "java"
+    java.write_text(f"#!/bin/sh\nexec {sys.executable} {fake}\n")
+    java.chmod(0o755)
+    cmd_line = [str(java), "-cp", "D.jar", "CLI", "test"]
+    key = (str(java), "D.jar")
+    try:
+        # A new pool of threads for each repo, like grading a class
+        for repo in range(3):
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                outputs = list(pool.map(lambda i: DIG.run_digital(cmd_line + [str(i)], str(tmp_path), timeout=5),
+                                        range(4)))
+            assert outputs == [f"test {i}" for i in range(4)]
+        assert 1 <= len(DIG.idle[key]) <= 2
+    finally:
+        for server in DIG.idle.pop(key, []):
+            server.stop()
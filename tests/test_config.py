@@ -90,3 +90,13 @@ def test_args_parsing_flags_and_lists(monkeypatch):
     assert args.test_name == "T01"
     assert args.students == ["alice", "bob"]
 
+
+
+def test_make_commented_table_handles_toml_types():
+    import tomlkit
+    tbl = Config.make_commented_table({'s': 'x', 'b': False, 'i': 3, 'f': 0.5, 'l': []})
+    text = tomlkit.dumps(tbl)
+    for line in ['# s = "x"', '# b = false', '# i = 3', '# f = 0.5', '# l = []']:
+        assert line in text
+    with pytest.raises(TypeError):
+        Config.make_commented_table({'d': {}})
@@ -1,4 +1,5 @@
 import json
+import os
 from types import SimpleNamespace
 from zipfile import ZipFile
 from io import BytesIO
@@ -75,81 +76,558 @@ def test_git_get_commit_hash(monkeypatch, tmp_path):
         g.get_commit_hash(str(tmp_path), 'main')
 
 
-def test_server_get_url_and_put_url(monkeypatch):
-    # Simulate requests responses
-    class Resp:
-        def __init__(self, status=200, headers=None, text='{}', content=b''):
-            self.status_code = status
-            self._headers = headers or {'Content-Type': 'application/json'}
-            self.text = text
-            self.content = content
-        @property
-        def headers(self):
-            return self._headers
-        def raise_for_status(self):
-            if self.status_code >= 400:
-                raise Exception('http error')
-
-    def fake_get(url, headers=None):
-        if url.endswith('/zip'):
-            return Resp(200, {'Content-Type': 'application/zip'}, content=b'ZIP')
-        return Resp(200, {'Content-Type': 'application/json'}, text=json.dumps({'ok': True}))
-
-    def fake_put(url, data=None, headers=None):
-        return Resp(200)
-
-    import requests
-    monkeypatch.setattr(requests, 'get', fake_get)
-    monkeypatch.setattr(requests, 'put', fake_put)
+def test_git_clone_retries_network_errors_and_reports_status(monkeypatch, tmp_path, capsys):
+    from autograder.actions import git as G
+    from autograder.actions.cmd import ProcResults
+    cfg = GitConfig({'org': 'o', 'credentials': 'ssh', 'retries': 2})
+    g = Git(cfg.__dict__, DummyArgs(by_date=False), None)
+    monkeypatch.setattr(G, 'RETRY_BACKOFF', 0)
 
-    s = Server('api.example.com', 'token', verbose=False)
+    outcomes = []
+    def fake_exec(cmd, wd=None, check=True, decode_errors='strict'):
+        rc, out = outcomes.pop(0)
+        return ProcResults(rc, out, None)
+    monkeypatch.setattr(G, 'cmd_exec', fake_exec)
+
+    class R:
+        remote_path = 'p-s'
+        local_path = str(tmp_path / 'p-s')
+
+    outcomes[:] = [(128, 'ssh: connect to host github.com port 22: Connection timed out'),
+                   (128, 'fatal: early EOF'), (0, '')]
+    assert g.clone(R) == G.CLONED
+    assert outcomes == []
+
+    # git's own messages, whatever their case
+    outcomes[:] = [(128, 'fatal: the remote end hung up unexpectedly'),
+                   (128, 'error: RPC failed; curl 56 GnuTLS recv error'), (0, '')]
+    assert g.exec_retry(['git', 'fetch']) == 0
+    assert outcomes == []
+
+    # Missing repos aren't retried
+    outcomes[:] = [(128, 'ERROR: Repository not found.'), (0, '')]
+    assert g.clone(R) == G.NO_REMOTE
+    assert len(outcomes) == 1
+
+    # Give up after cfg.retries
+    outcomes[:] = [(128, 'Could not resolve host: github.com')] * 3
+    assert g.clone(R) == G.NO_REMOTE
+    assert outcomes == []
+
+    (tmp_path / 'p-s').mkdir()
+    assert g.clone(R) == G.EXISTS
+    summary = Git.format_summary([G.CLONED, G.CLONED, G.EXISTS, G.NO_REMOTE, None])
+    assert summary == 'cloned: 2, already exists: 1, no remote repo: 1, failed: 1'
+
+
+def make_dated_repo(path, dates):
+    import os
+    import subprocess
+    path.mkdir()
+    git = ['git', '-c', 'user.name=t', '-c', 'user.email=t@example.com']
+    subprocess.run(git + ['init', '-q', '-b', 'main'], cwd=path, check=True)
+    for i, date in enumerate(dates):
+        (path / 'f').write_text(str(i))
+        env = dict(os.environ, GIT_AUTHOR_DATE=date, GIT_COMMITTER_DATE=date)
+        subprocess.run(git + ['add', 'f'], cwd=path, check=True)
+        subprocess.run(git + ['commit', '-q', '-m', date], cwd=path, check=True, env=env)
+
+
+@pytest.mark.parametrize('options', [{'shallow_days': 3}, {'depth': 1, 'filter': 'blob:none'}])
+def test_git_shallow_clone_by_date(tmp_path, options, capsys):
+    import subprocess
+    dates = ['2024-09-01 12:00:00', '2024-09-20 12:00:00', '2024-09-29 12:00:00', '2024-10-05 12:00:00']
+    make_dated_repo(tmp_path / 'origin', dates)
+    cfg = GitConfig(dict({'org': 'o', 'credentials': 'ssh'}, **options))
+
+    class D: date = '2024-10-01'; suffix = 'due'
+    g = Git(cfg.__dict__, DummyArgs(by_date=True), D())
+    g.make_remote_path = lambda repo: (tmp_path / 'origin').as_uri()
+
+    class R:
+        remote_path = 'p-s'
+        local_path = str(tmp_path / 'p-s-due')
+
+    assert g.clone(R) == 'cloned'
+    def git_out(*cmd):
+        return subprocess.run(['git', *cmd], cwd=R.local_path, capture_output=True, text=True).stdout.strip()
+    assert git_out('log', '-1', '--format=%s') == dates[2]
+    count = int(git_out('rev-list', '--count', 'HEAD'))
+    if 'shallow_days' in options:
+        # Only the window before the date was fetched
+        assert git_out('rev-parse', '--is-shallow-repository') == 'true'
+        assert count == 1
+    else:
+        # depth = 1 didn't reach the date, so the full history was fetched
+        assert git_out('rev-parse', '--is-shallow-repository') == 'false'
+        assert count == 3
+
+
+def test_git_shallow_clone_with_no_commits_in_window(tmp_path, capsys):
+    import subprocess
+    # The only commit is long before the window of days before the date
+    make_dated_repo(tmp_path / 'origin', ['2024-08-01 12:00:00'])
+    cfg = GitConfig({'org': 'o', 'credentials': 'ssh', 'shallow_days': 3})
+
+    class D: date = '2024-10-01'; suffix = 'due'
+    g = Git(cfg.__dict__, DummyArgs(by_date=True), D())
+    g.make_remote_path = lambda repo: (tmp_path / 'origin').as_uri()
+
+    class R:
+        remote_path = 'p-s'
+        local_path = str(tmp_path / 'p-s-due')
+
+    assert g.clone(R) == 'cloned'
+    log = subprocess.run(['git', 'log', '-1', '--format=%s'], cwd=R.local_path,
+                         capture_output=True, text=True).stdout.strip()
+    assert log == '2024-08-01 12:00:00'
+
+
+def test_git_checkout_milestones_in_worktrees(tmp_path, capsys):
+    import subprocess
+    dates = ['2024-09-01 12:00:00', '2024-09-20 12:00:00', '2024-09-29 12:00:00', '2024-10-05 12:00:00']
+    make_dated_repo(tmp_path / 'origin', dates)
+    cfg = GitConfig({'org': 'o', 'credentials': 'ssh', 'shallow_days': 3})
+    g = Git(cfg.__dict__, DummyArgs(by_date=False), None)
+    g.make_remote_path = lambda repo: (tmp_path / 'origin').as_uri()
+
+    class R:
+        def __init__(self, suffix):
+            self.remote_path = 'p-s'
+            self.local_path = self.root_path = str(tmp_path / ('p-s' + suffix))
+
+    class D:
+        def __init__(self, suffix, date):
+            self.suffix, self.date = suffix, date
+
+    def head(path):
+        return subprocess.run(['git', 'log', '-1', '--format=%s'], cwd=path,
+                              capture_output=True, text=True).stdout.strip()
+
+    # The window before 09-25 misses its commit, so the full history is fetched
+    milestones = [(R('-due'), D('due', '2024-09-25')), (R('-late'), D('late', '2024-10-10'))]
+    g.checkout_milestones(R(''), milestones)
+    assert head(tmp_path / 'p-s-due') == dates[1]
+    assert head(tmp_path / 'p-s-late') == dates[3]
+    assert 'Fetching full history' in capsys.readouterr().out
+
+    # Again, reusing the clone and worktrees, with a date before any commits
+    milestones.insert(0, (R('-early'), D('early', '2024-08-01')))
+    milestones[1][1].date = '2024-09-30'
+    g.checkout_milestones(R(''), milestones)
+    assert not (tmp_path / 'p-s-early').exists()
+    assert head(tmp_path / 'p-s-due') == dates[2]
+    out = capsys.readouterr().out
+    assert 'early: no commits' in out and 'late: ' in out
+
+    # A checkout which fails leaves nothing to grade for that date
+    (tmp_path / 'p-s-due' / 'f').write_text('edited')
+    milestones[1][1].date = '2024-09-25'
+    g.checkout_milestones(R(''), milestones)
+    assert not (tmp_path / 'p-s-due').exists()
+    assert head(tmp_path / 'p-s-late') == dates[3]
+    assert 'due: checkout of' in capsys.readouterr().out
+
+
+def test_archive_stores_shallow_clones(tmp_path, monkeypatch, capsys):
+    import subprocess
+    from autograder.actions import archive as A
+    dates = ['2024-09-01 12:00:00', '2024-09-20 12:00:00']
+    make_dated_repo(tmp_path / 'origin', dates)
+    subprocess.run(['git', 'clone', '-q', '--depth=1', (tmp_path / 'origin').as_uri(),
+                    str(tmp_path / 'p-s')], check=True)
+    monkeypatch.chdir(tmp_path)
+
+    class R:
+        student = 's'
+        suffix = ''
+        root_path = str(tmp_path / 'p-s')
+
+    archive = A.Archive(DummyArgs(project='p'))
+    assert archive.add(R) == A.ARCHIVED
+    sha = subprocess.run(['git', 'rev-parse', 'refs/snapshots/s/current'], cwd=archive.path,
+                         capture_output=True, text=True).stdout.strip()
+    assert sha == archive.get_head(R.root_path)
+
+    # A commit which didn't make it into the archive is a failure
+    monkeypatch.setattr(archive, 'get_head', lambda path: '0' * 40)
+    assert archive.add(R) == A.FAILED
+
+
+@pytest.mark.parametrize('dissociate', [False, True])
+def test_git_clone_borrows_objects_from_starter_mirror(tmp_path, dissociate, capsys):
+    import subprocess
+    make_dated_repo(tmp_path / 'starter', ['2024-09-01 12:00:00', '2024-09-02 12:00:00'])
+    subprocess.run(['git', 'branch', 'old'], cwd=tmp_path / 'starter', check=True)
+    subprocess.run(['git', 'clone', '-q', str(tmp_path / 'starter'), str(tmp_path / 'student')], check=True)
+    (tmp_path / 'student' / 'g').write_text('student work')
+    git = ['git', '-c', 'user.name=t', '-c', 'user.email=t@example.com']
+    subprocess.run(git + ['add', 'g'], cwd=tmp_path / 'student', check=True)
+    subprocess.run(git + ['commit', '-q', '-m', 'work'], cwd=tmp_path / 'student', check=True)
+
+    cfg = GitConfig({'org': 'o', 'starter_repo': (tmp_path / 'starter').as_uri(),
+                     'mirror_path': str(tmp_path / 'mirrors'), 'dissociate': dissociate})
+    g = Git(cfg.__dict__, DummyArgs(by_date=False, project='p'), None)
+    g.make_remote_path = lambda repo: (tmp_path / 'student').as_uri()
+
+    class R:
+        remote_path = 'p-s'
+        local_path = str(tmp_path / 'p-s')
+
+    assert g.clone(R) == 'cloned'
+    mirror = tmp_path / 'mirrors' / 'p.git'
+    alternates = tmp_path / 'p-s' / '.git' / 'objects' / 'info' / 'alternates'
+    if dissociate:
+        assert not alternates.exists()
+    else:
+        assert str(mirror / 'objects') in alternates.read_text()
+
+    g.maintain_mirror()
+    packs = list((mirror / 'objects' / 'pack').glob('*.pack'))
+    assert len(packs) == 1
+    fsck = subprocess.run(['git', 'fsck', '--no-progress'], cwd=R.local_path, capture_output=True)
+    assert fsck.returncode == 0
+    assert (tmp_path / 'p-s' / 'g').read_text() == 'student work'
+
+    # Rewrite the starter history, so the mirror no longer refers to the
+    # commits the student's clone borrows, and gc the mirror
+    subprocess.run(['git', 'reset', '-q', '--hard', 'HEAD~1'], cwd=tmp_path / 'starter', check=True)
+    subprocess.run(git + ['commit', '-q', '--amend', '-m', 'rewritten'], cwd=tmp_path / 'starter', check=True)
+    subprocess.run(['git', 'branch', '-q', '-D', 'old'], cwd=tmp_path / 'starter', check=True)
+    g.mirror_ready = False
+    g.maintain_mirror()
+    def mirror_out(*cmd):
+        return subprocess.run(['git', *cmd], cwd=mirror, capture_output=True, text=True).stdout.strip()
+    # Refs aren't pruned, and git won't gc or prune the mirror on its own
+    assert mirror_out('rev-parse', '--verify', 'refs/heads/old')
+    assert mirror_out('config', 'gc.auto') == '0'
+    assert mirror_out('config', 'gc.pruneExpire') == 'never'
+    subprocess.run(['git', 'gc', '-q'], cwd=mirror, check=True)
+    fsck = subprocess.run(['git', 'fsck', '--no-progress'], cwd=R.local_path, capture_output=True)
+    assert fsck.returncode == 0
+
+
+@pytest.mark.parametrize('packed', [False, True])
+def test_git_reader_agrees_with_git(tmp_path, packed):
+    import subprocess
+    from datetime import datetime
+    from autograder.actions.gitreader import GitReader
+    dates = ['2024-09-%02d 12:00:00' % d for d in range(1, 28, 3)]
+    origin = tmp_path / 'origin'
+    origin.mkdir()
+    git = ['git', '-c', 'user.name=t', '-c', 'user.email=t@example.com']
+    subprocess.run(git + ['init', '-q', '-b', 'trunk'], cwd=origin, check=True)
+    lines = [f'line {i}\n' for i in range(2000)]
+    for i, date in enumerate(dates):
+        # Small edits to a large file, so repacking makes deltas
+        lines[i * 7] = f'edit {i}\n'
+        (origin / 'big.txt').write_text(''.join(lines))
+        env = dict(os.environ, GIT_AUTHOR_DATE=date + ' +0200', GIT_COMMITTER_DATE=date)
+        subprocess.run(git + ['add', 'big.txt'], cwd=origin, check=True)
+        subprocess.run(git + ['commit', '-q', '-m', date], cwd=origin, check=True, env=env)
+    subprocess.run(['git', 'clone', '-q', str(origin), str(tmp_path / 'clone')], check=True)
+    repo = tmp_path / 'clone'
+    if packed:
+        subprocess.run(['git', 'repack', '-q', '-a', '-d', '-f', '--depth=50', '--window=50'], cwd=repo, check=True)
+        subprocess.run(['git', 'pack-refs', '--all'], cwd=repo, check=True)
+        subprocess.run(['git', 'prune-packed'], cwd=repo, check=True)
+        assert not list((repo / '.git' / 'objects').glob('??/*'))
+
+    def git_out(*cmd, cwd=repo):
+        return subprocess.run(['git', *cmd], cwd=cwd, capture_output=True, check=True).stdout
+
+    reader = GitReader(str(repo))
+    assert reader.default_branch() == 'trunk'
+    assert reader.head() == git_out('rev-parse', 'HEAD').decode().strip()
+
+    # Every object, including deltas, reads back the same as git's
+    listing = git_out('cat-file', '--batch-all-objects', '--batch-check').decode().split('\n')
+    for line in filter(None, listing):
+        sha, type_name, _ = line.split()
+        assert reader.read_object(sha) == (type_name, git_out('cat-file', type_name, sha))
+
+    for before in ['2024-08-01', '2024-09-01 12:00:00', '2024-09-15', '2024-12-01']:
+        expected = git_out('rev-list', '-n', '1', '--first-parent', '--before', before, 'trunk').decode().strip()
+        found = reader.last_commit_before('trunk', datetime.fromisoformat(before))
+        assert (found[0] if found else '') == expected
+
+    # A worktree shares the refs and objects of the main repo, and a
+    # reference clone borrows objects through alternates
+    subprocess.run(['git', 'worktree', 'add', '-q', '--detach', str(tmp_path / 'wt'), 'HEAD~2'], cwd=repo, check=True)
+    assert GitReader(str(tmp_path / 'wt')).head() == git_out('rev-parse', 'HEAD~2').decode().strip()
+    subprocess.run(['git', 'clone', '-q', '--reference', str(repo), str(origin), str(tmp_path / 'ref')], check=True)
+    ref_reader = GitReader(str(tmp_path / 'ref' / 'subdir-that-does-not-matter'))
+    commit = ref_reader.read_commit(ref_reader.head())
+    assert commit['author'][1] == 120
+
+
+def test_git_uses_reader_without_subprocess(tmp_path, monkeypatch, capsys):
+    import subprocess
+    make_dated_repo(tmp_path / 'origin', ['2024-09-01 12:00:00', '2024-09-20 12:00:00'])
+    subprocess.run(['git', 'clone', '-q', str(tmp_path / 'origin'), str(tmp_path / 'p-s')], check=True)
+
+    def no_subprocess(*args, **kwargs):
+        raise AssertionError('git subprocess started')
+    monkeypatch.setattr('subprocess.Popen', no_subprocess)
+    monkeypatch.setattr('autograder.actions.git.cmd_exec_capture', no_subprocess)
+
+    class D: date = '2024-09-10'; suffix = 'due'
+    g = Git(GitConfig({'org': 'o'}).__dict__, DummyArgs(), D())
+    class R:
+        local_path = str(tmp_path / 'p-s')
+        remote_path = 'p-s'
+    assert g.get_default_branch(R.local_path) == 'main'
+    h = g.get_commit_hash(R.local_path, 'main')
+    assert len(h) == 7
+    assert g.get_url_for_hash('ok', R).startswith('Test results for repo as of this commit: https://github.com/o/p-s/tree/')
+    assert g.get_newest_commit_date(R).startswith('2024-09-20 12:00:00')
+    assert 'branch: main, hash: ' + h in capsys.readouterr().out
+
+
+@pytest.fixture
+def http_server():
+    # A local HTTP/1.1 server which answers from a queue of
+    # (status, headers, body) responses, recording each request
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def respond(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length)
+            server.requests.append((self.command, self.path, dict(self.headers), body,
+                                    self.client_address))
+            status, headers, content = server.responses.pop(0)
+            self.send_response(status)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        do_GET = do_PUT = respond
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.requests = []
+    server.responses = []
+    server.url = f'http://127.0.0.1:{server.server_port}'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_server_get_url_and_put_url(http_server):
+    from autograder.actions.server import ServerConfig
+    JSON = {'Content-Type': 'application/json'}
+    http_server.responses += [
+        (503, {'Retry-After': '0'}, b''),
+        (200, JSON, json.dumps({'ok': True}).encode()),
+        (200, {'Content-Type': 'application/zip'}, b'ZIP'),
+        (502, {}, b''),
+        (200, JSON, b'{}'),
+        (404, JSON, b'{"message": "Not Found"}'),
+    ]
+    s = Server('api.example.com', 'token', verbose=False, server_cfg=ServerConfig({'backoff': 0}))
     assert s.make_url('path') == 'https://api.example.com/path'
-    j = s.get_url('https://api.example.com/data', headers={})
+
+    # 5xx is retried, honoring Retry-After
+    j = s.get_url(http_server.url + '/data', headers={})
     assert j['ok'] is True
-    content = s.get_url('https://api.example.com/zip', headers={})
+    content = s.get_url(http_server.url + '/zip', headers={})
     assert content == b'ZIP'
-    assert s.put_url('https://api.example.com/put', headers={}, data=b'1') is True
+    assert s.put_url(http_server.url + '/put', headers={}, data=b'1') is True
+    with pytest.raises(Exception):
+        s.get_url(http_server.url + '/missing')
+    assert http_server.responses == []
+
+    methods = [(r[0], r[1]) for r in http_server.requests]
+    assert methods == [('GET', '/data'), ('GET', '/data'), ('GET', '/zip'),
+                       ('PUT', '/put'), ('PUT', '/put'), ('GET', '/missing')]
+    assert all(r[2]['Authorization'] == 'Bearer token' for r in http_server.requests)
+    assert http_server.requests[3][3] == b'1'
+    # One kept-alive connection for all of the requests
+    assert len(set(r[4] for r in http_server.requests)) == 1
+    # Retries are inside one request
+    host = f'127.0.0.1:{http_server.server_port}'
+    assert s.stats[host]['requests'] == 4
+    assert s.format_stats().startswith(f'{host}: 4 requests, ')
+
+
+def test_server_waits_for_rate_limits(http_server, monkeypatch):
+    import time
+    from autograder.actions import server as S
+    monkeypatch.setattr(S, 'RESET_MARGIN', 0)
+    JSON = {'Content-Type': 'application/json'}
+    # At least a second away, so it hasn't passed before we run out
+    reset = int(time.time()) + 2
+    http_server.responses += [
+        (200, dict(JSON, **{'X-RateLimit-Remaining': '1', 'X-RateLimit-Reset': str(reset)}), b'{}'),
+        (200, dict(JSON, **{'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(reset)}), b'{}'),
+        # Secondary rate limit
+        (403, dict(JSON, **{'Retry-After': '0'}), b'{"message": "You have exceeded a secondary rate limit"}'),
+        (200, JSON, b'{"n": 4}'),
+        (403, JSON, b'{"message": "Forbidden"}'),
+    ]
+    s = Server('api.example.com', 'token', verbose=False)
+    s.get_url(http_server.url + '/1')
+    s.get_url(http_server.url + '/2')
+    # The budget is spent, so wait until it resets
+    assert s.get_url(http_server.url + '/3') == {'n': 4}
+    assert time.time() >= reset
+    # Other 403s aren't retried
+    with pytest.raises(Exception):
+        s.get_url(http_server.url + '/4')
+    assert [r[1] for r in http_server.requests] == ['/1', '/2', '/3', '/3', '/4']
+    assert s.rate_limiter.waits == 1
+    assert 'rate limited 1 times' in s.format_stats()
 
 
-def test_github_artifacts_and_results(monkeypatch):
-    # Craft an artifact listing and a zip containing grade-results.json
+def test_server_waits_for_429(http_server, monkeypatch):
+    import time
+    from email.utils import formatdate
+    from autograder.actions import server as S
+    monkeypatch.setattr(S, 'SECONDARY_WAIT', 0)
+    JSON = {'Content-Type': 'application/json'}
+    http_server.responses += [
+        (429, {'Retry-After': '1'}, b''),
+        (200, JSON, b'{"n": 1}'),
+        # HTTP-dates and nonsense don't raise
+        (429, {'Retry-After': formatdate(time.time() - 10, usegmt=True)}, b''),
+        (200, JSON, b'{"n": 2}'),
+        (429, {'Retry-After': 'soon'}, b''),
+        (200, JSON, b'{"n": 3}'),
+    ]
+    s = Server('api.example.com', 'token', verbose=False)
+    start = time.time()
+    assert s.get_url(http_server.url + '/1') == {'n': 1}
+    assert time.time() - start >= 1
+    assert s.get_url(http_server.url + '/2') == {'n': 2}
+    assert s.get_url(http_server.url + '/3') == {'n': 3}
+    # Each wait is counted, and urllib3 doesn't retry behind our back
+    assert s.rate_limiter.waits == 1
+    host = f'127.0.0.1:{http_server.server_port}'
+    assert s.stats[host]['requests'] == len(http_server.requests) == 6
+    assert S.parse_retry_after('2.5') == 2.5
+    assert S.parse_retry_after(formatdate(time.time() + 100, usegmt=True)) > 90
+    assert S.parse_retry_after('') is None
+
+
+def test_server_revalidates_cached_responses(http_server):
+    from autograder.actions.server import ServerConfig
+    JSON = {'Content-Type': 'application/json'}
+    http_server.responses += [
+        (200, dict(JSON, ETag='"v1"'), b'[{"id": 1}]'),
+        (304, {'ETag': '"v1"'}, b''),
+        (304, {'ETag': '"v1"'}, b''),
+        (200, JSON, b'{"no": "etag"}'),
+        (200, JSON, b'{"no": "etag"}'),
+    ]
+    s = Server('api.example.com', 'token', verbose=False)
+    assert s.get_url(http_server.url + '/list') == [{'id': 1}]
+    assert s.get_url(http_server.url + '/list') == [{'id': 1}]
+    assert http_server.requests[1][2]['If-None-Match'] == '"v1"'
+    assert s.format_stats().endswith('HTTP cache: 0 fresh, 1 not modified, 1 misses')
+
+    # Within the ttl, the server isn't asked, unless the caller says so
+    s = Server('api.example.com', 'token', verbose=False, server_cfg=ServerConfig({'cache_ttl': 3600}))
+    assert s.get_url(http_server.url + '/list') == [{'id': 1}]
+    assert len(http_server.requests) == 2
+    assert s.get_url(http_server.url + '/list', ttl=0) == [{'id': 1}]
+    assert len(http_server.requests) == 3
+    assert s.format_stats().endswith('HTTP cache: 1 fresh, 1 not modified, 0 misses')
+
+    # Responses without ETag or Last-Modified aren't kept, and other tokens
+    # don't see cached responses
+    s = Server('api.example.com', 'token', verbose=False)
+    s.get_url(http_server.url + '/plain')
+    s.get_url(http_server.url + '/plain')
+    assert 'If-None-Match' not in http_server.requests[4][2]
+    s = Server('api.example.com', 'other', verbose=False, cache=True)
+    assert s.http_cache.get(http_server.url + '/list', {'Authorization': 'Bearer other'}) == (None, False)
+    assert http_server.responses == []
+
+
+def test_server_counts_changed_responses_as_misses(http_server):
+    import os
+    JSON = {'Content-Type': 'application/json'}
+    http_server.responses += [
+        (200, dict(JSON, ETag='"v1"'), b'[1]'),
+        (200, dict(JSON, ETag='"v2"'), b'[1, 2]'),
+        (200, dict(JSON, ETag='"v3"'), b'[1, 2, 3]'),
+    ]
+    s = Server('api.example.com', 'token', verbose=False)
+    url = http_server.url + '/list'
+    assert s.get_url(url) == [1]
+    # A full response to a conditional request is a miss too
+    assert s.get_url(url) == [1, 2]
+    assert http_server.requests[1][2]['If-None-Match'] == '"v1"'
+    # An entry from an older version is ignored rather than raising
+    path = s.http_cache.get_path(s.http_cache.make_key(url, s.add_auth_header({})))
+    with open(path, 'w') as f:
+        json.dump({'url': url, 'body': [1]}, f)
+    assert s.get_url(url) == [1, 2, 3]
+    assert 'If-None-Match' not in http_server.requests[2][2]
+    assert os.path.exists(path)
+    assert s.format_stats().endswith('HTTP cache: 0 fresh, 0 not modified, 3 misses')
+
+
+def test_github_artifacts_and_results(monkeypatch, http_server):
+    import os
+    # Craft an artifact listing and a zip containing grade-results.json,
+    # along with a build output
     artifacts = {
         'artifacts': [{
             'id': 1,
-            'archive_download_url': 'https://api.github.com/a.zip',
+            'archive_download_url': http_server.url + '/a.zip',
             'workflow_run': {'id': 99}
         }]
     }
 
     jobs = {'jobs': [{'id': 101}]}
 
-    # Zip with grade-results.json
     bio = BytesIO()
     with ZipFile(bio, 'w') as z:
+        z.writestr('build/prog', os.urandom(8192))
         z.writestr('grade-results.json', json.dumps({'grade': '7'}))
     zip_bytes = bio.getvalue()
+    http_server.responses += [(200, {'Content-Type': 'application/zip'}, zip_bytes)] * 2
 
     def fake_get_url(url, headers=None):
-        if url.endswith('/actions/artifacts'):
+        if url.endswith('/actions/artifacts?per_page=1&name=grade'):
             return artifacts
         if url.endswith('/jobs'):
             return jobs
-        if url.endswith('.zip') or url.endswith('a.zip'):
-            return zip_bytes
         raise AssertionError(f"unexpected url {url}")
 
     # Patch Server.get_url for Github methods
     monkeypatch.setattr('autograder.actions.server.Server.get_url', lambda self, url, headers={}: fake_get_url(url, headers))
 
     from autograder.actions.github import GithubConfig
-    args = DummyArgs(project='p', verbose=False)
-    gh = Github(GithubConfig({'host_name':'api.github.com','access_token':'tok'}).__dict__, args, org='orgx')
+    args = DummyArgs(project='p', verbose=False, no_cache=False)
+    cfg = GithubConfig({'host_name': 'api.github.com', 'access_token': 'tok', 'artifact_name': 'grade'})
+    gh = Github(cfg.__dict__, args, org='orgx')
     # First artifact
     art = gh.get_first_artifact_for_repo('alice')
     assert art['id'] == 1
-    # Results extraction
+    # Results extraction, streamed from the server
     res = gh.get_artifact_results(art)
     assert res['grade'] == 7.0
+    assert http_server.requests[0][1] == '/a.zip'
     # Summary URL
     url = gh.get_action_run_summary_url('alice', art)
     assert 'actions/runs/99#summary-101' in url
+
+    # One connection per student fetched at once
+    wide = Github({'concurrency': 16, 'pool_size': 4}, args, org='orgx')
+    assert wide.session.get_adapter('https://api.github.com')._pool_maxsize == 16
+
+    # Artifacts over the limit aren't downloaded
+    gh.github_cfg.artifact_limit_mb = 4096 / (1024 * 1024)
+    assert gh.get_artifact_results(art) is None
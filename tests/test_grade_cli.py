@@ -1,4 +1,5 @@
 import json
+import os
 from pathlib import Path
 
 import pytest
@@ -16,8 +17,8 @@ def test_grade_action_test_end_to_end(tmp_path, monkeypatch):
 
     # Build Args and Config
     args = Args({
-        'action': 'test', 'by_date': False, 'exec_cmd': None,
-        'github_action': False, 'test_name': None, 'project': project,
+        'action': 'test', 'all_dates': False, 'by_date': False, 'exec_cmd': None, 'git_jobs': 4, 'pipeline': False,
+        'github_action': False, 'jobs': 1, 'no_cache': False, 'parallel_tests': None, 'test_name': None, 'project': project,
         'students': None, 'verbose': False, 'very_verbose': False,
     })
 
@@ -54,8 +55,8 @@ def test_grade_action_test_end_to_end(tmp_path, monkeypatch):
 def test_grade_action_class_json_and_histogram(tmp_path, monkeypatch, capsys):
     project = 'projx'
     args = Args({
-        'action': 'class', 'by_date': False, 'exec_cmd': None,
-        'github_action': False, 'test_name': None, 'project': project,
+        'action': 'class', 'all_dates': False, 'by_date': False, 'exec_cmd': None, 'git_jobs': 4, 'pipeline': False,
+        'github_action': False, 'jobs': 1, 'no_cache': False, 'parallel_tests': None, 'test_name': None, 'project': project,
         'students': ['alice', 'bob'], 'verbose': False, 'very_verbose': False,
     })
 
@@ -64,6 +65,8 @@ def test_grade_action_class_json_and_histogram(tmp_path, monkeypatch, capsys):
         def __init__(self, *_):
             # Provide attribute used by grade.main
             self.project_cfg = type('PC', (), {'subdir': None})()
+            self.result_cache = None
+            self.build_cache = None
         def test(self, repo):
             return {'student': repo.student, 'score': 5, 'comment': 'ok', 'results': []}
         def print_histogram(self, class_results):
@@ -97,3 +100,408 @@ def test_grade_action_class_json_and_histogram(tmp_path, monkeypatch, capsys):
     assert {r['student'] for r in data} == {'alice', 'bob'}
     captured = capsys.readouterr().out
     assert 'Score frequency (n = 2)' in captured
+
+
+def test_grade_action_class_parallel_matches_serial(tmp_path, monkeypatch, capsys):
+    import time
+    project = 'projx'
+    students = ['s%02d' % i for i in range(8)]
+
+    class FakeTest:
+        def __init__(self, *_):
+            self.project_cfg = type('PC', (), {'subdir': None})()
+            self.result_cache = None
+            self.build_cache = None
+        def test(self, repo):
+            # Finish out of order so the pool has a chance to reorder results
+            n = int(repo.student[1:])
+            time.sleep(0.01 * (8 - n))
+            print(f'{repo.student} done')
+            return {'student': repo.student, 'score': n % 3, 'comment': 'ok', 'results': []}
+        def print_histogram(self, class_results):
+            class_results.sort(key=lambda r: r['score'], reverse=True)
+
+    cfg = Config({
+        'Canvas': type('X', (), {})(),
+        'CanvasMapper': type('X', (), {})(),
+        'Git': {'org': 'o', 'credentials': 'ssh'},
+        'Github': {'host_name':'api.github.com','access_token':'tok'},
+        'Test': {'tests_path': str(tmp_path)},
+        'Config': {'students': students},
+    })
+    monkeypatch.setattr('autograder.actions.config.Config.from_path', staticmethod(lambda p: cfg))
+    monkeypatch.setattr('autograder.actions.config.Config.get_path', staticmethod(lambda: Path('dummy')))
+    monkeypatch.chdir(tmp_path)
+    from autograder import grade as grade_mod
+    monkeypatch.setattr(grade_mod, 'Test', FakeTest)
+
+    outputs = []
+    for jobs in [1, 4]:
+        args = Args({
+            'action': 'class', 'all_dates': False, 'by_date': False, 'exec_cmd': None, 'git_jobs': 4, 'pipeline': False,
+            'github_action': False, 'jobs': jobs, 'no_cache': False, 'parallel_tests': None, 'test_name': None,
+            'project': project, 'students': None, 'verbose': False,
+            'very_verbose': False,
+        })
+        monkeypatch.setattr('autograder.actions.config.Args.from_cmdline', staticmethod(lambda: args))
+        grade_mod.main()
+        outputs.append((tmp_path / f'{project}.json').read_text())
+
+    assert outputs[0] == outputs[1]
+    # Each repo's output is printed as one unbroken line
+    captured = capsys.readouterr().out
+    for s in students:
+        assert f'./{project}-{s} {s} done' in captured
+
+
+def test_grade_class_grades_identical_trees_once(tmp_path, monkeypatch, capsys):
+    import subprocess
+    from tests.helpers import write_mini_repo, write_tests_repo
+    project = 'projx'
+    tests_repo = write_tests_repo(tmp_path, project=project)
+    git = ['git', '-c', 'user.name=t', '-c', 'user.email=t@example.com']
+    for student, marker in [('alice', 'a'), ('bob', 'a'), ('carol', 'c')]:
+        base = tmp_path / student
+        base.mkdir()
+        repo = write_mini_repo(base, program_name=project)
+        (repo / 'marker').write_text(marker)
+        subprocess.run(git + ['init', '-q'], cwd=repo, check=True)
+        subprocess.run(git + ['add', '.'], cwd=repo, check=True)
+        # Different commits, same tree for alice and bob
+        subprocess.run(git + ['commit', '-q', '-m', student], cwd=repo, check=True)
+        repo.rename(tmp_path / f'{project}-{student}')
+
+    cfg = Config({
+        'Canvas': type('X', (), {})(),
+        'CanvasMapper': type('X', (), {})(),
+        'Git': {'org': 'o', 'credentials': 'ssh'},
+        'Github': {'host_name': 'api.github.com', 'access_token': 'tok'},
+        'Test': {'tests_path': str(tests_repo)},
+        'Config': {'students': ['alice', 'bob', 'carol']},
+    })
+    args = Args({
+        'action': 'class', 'all_dates': False, 'by_date': False, 'exec_cmd': None, 'git_jobs': 4, 'pipeline': False,
+        'github_action': False, 'jobs': 1, 'no_cache': True, 'parallel_tests': None, 'test_name': None,
+        'project': project, 'students': None, 'verbose': False, 'very_verbose': False,
+    })
+    monkeypatch.setattr('autograder.actions.config.Config.from_path', staticmethod(lambda p: cfg))
+    monkeypatch.setattr('autograder.actions.config.Config.get_path', staticmethod(lambda: Path('dummy')))
+    monkeypatch.setattr('autograder.actions.config.Args.from_cmdline', staticmethod(lambda: args))
+    monkeypatch.chdir(tmp_path)
+
+    from autograder import grade as grade_mod
+    tested = []
+
+    class CountingTest(grade_mod.Test):
+        def test(self, repo):
+            tested.append(repo.student)
+            return super().test(repo)
+
+    monkeypatch.setattr(grade_mod, 'Test', CountingTest)
+    grade_mod.main()
+
+    assert tested == ['alice', 'carol']
+    data = {r['student']: r for r in json.loads((tmp_path / f'{project}.json').read_text())}
+    assert set(data) == {'alice', 'bob', 'carol'}
+    assert data['bob']['score'] == data['alice']['score'] == 10
+    assert data['bob']['results'] == data['alice']['results']
+    assert f'/o/{project}-bob/tree/' in data['bob']['comment']
+    assert f'/o/{project}-alice/tree/' in data['alice']['comment']
+    assert data['alice']['comment'].count('Test results for repo') == 1
+    assert f'same as ./{project}-alice 10/10' in capsys.readouterr().out
+
+
+def test_grade_class_pipeline_clones_and_grades(tmp_path, monkeypatch, capsys):
+    project = 'projx'
+    students = ['s%02d' % i for i in range(6)]
+    calls = []
+
+    class FakeGit:
+        def __init__(self, *_):
+            self.cfg = type('GC', (), {'org': 'o'})()
+        def clone(self, repo):
+            calls.append(('clone', repo.student))
+            os.mkdir(repo.local_path)
+            print()
+        def pull(self, repo):
+            calls.append(('pull', repo.student))
+        def get_url_for_hash(self, comment, repo):
+            return f'{repo.student}: {comment}'
+
+    class FakeTest:
+        def __init__(self, *_):
+            self.project_cfg = type('PC', (), {'subdir': None})()
+            self.result_cache = None
+            self.build_cache = None
+        def test(self, repo):
+            assert os.path.isdir(repo.local_path)
+            calls.append(('test', repo.student))
+            print('tested')
+            return {'student': repo.student, 'score': int(repo.student[1:]) % 2, 'comment': 'ok', 'results': []}
+        def print_histogram(self, class_results):
+            class_results.sort(key=lambda r: r['score'], reverse=True)
+
+    cfg = Config({
+        'Canvas': type('X', (), {})(),
+        'CanvasMapper': type('X', (), {})(),
+        'Git': {'org': 'o', 'credentials': 'ssh'},
+        'Github': {'host_name': 'api.github.com', 'access_token': 'tok'},
+        'Test': {'tests_path': str(tmp_path)},
+        'Config': {'students': students},
+    })
+    monkeypatch.setattr('autograder.actions.config.Config.from_path', staticmethod(lambda p: cfg))
+    monkeypatch.setattr('autograder.actions.config.Config.get_path', staticmethod(lambda: Path('dummy')))
+    monkeypatch.chdir(tmp_path)
+    from autograder import grade as grade_mod
+    monkeypatch.setattr(grade_mod, 'Test', FakeTest)
+    monkeypatch.setattr(grade_mod, 'Git', FakeGit)
+
+    outputs = []
+    for pipeline in [True, False]:
+        args = Args({
+            'action': 'class', 'all_dates': False, 'by_date': False, 'exec_cmd': None, 'git_jobs': 3, 'pipeline': pipeline,
+            'github_action': False, 'jobs': 2, 'no_cache': False, 'parallel_tests': None, 'test_name': None,
+            'project': project, 'students': None, 'verbose': False, 'very_verbose': False,
+        })
+        monkeypatch.setattr('autograder.actions.config.Args.from_cmdline', staticmethod(lambda: args))
+        grade_mod.main()
+        outputs.append((tmp_path / f'{project}.json').read_text())
+
+    assert outputs[0] == outputs[1]
+    assert sorted(c for c in calls if c[0] == 'clone') == [('clone', s) for s in students]
+    assert len([c for c in calls if c[0] == 'test']) == 2 * len(students)
+    # Each repo's clone and test output is printed together
+    captured = capsys.readouterr().out
+    for s in students:
+        assert f'./{project}-{s} \n./{project}-{s} tested' in captured
+
+
+def test_grade_class_all_dates_writes_each_date_and_rollup(tmp_path, monkeypatch, capsys):
+    project = 'projx'
+    (tmp_path / 'dates.toml').write_text(
+        f'[[{project}.dates]]\nsuffix = "due"\ndate = "2024-10-01"\npercentage = 1.0\n\n'
+        f'[[{project}.dates]]\nsuffix = "late"\ndate = "2024-10-08"\npercentage = 0.5\n')
+    scores = {('alice', 'due'): 6, ('alice', 'late'): 10, ('bob', 'due'): 10, ('bob', 'late'): 10}
+
+    class FakeGit:
+        def __init__(self, *_):
+            self.cfg = type('GC', (), {'org': 'o'})()
+        def checkout_milestones(self, base, milestones):
+            assert base.local_path == f'./{project}-{base.student}'
+            for repo, date in milestones:
+                assert repo.date is date
+                os.mkdir(repo.root_path)
+            print()
+        def get_url_for_hash(self, comment, repo):
+            return comment
+
+    class FakeTest:
+        def __init__(self, *_):
+            self.tests_path = str(tmp_path)
+            self.project_cfg = type('PC', (), {'subdir': None})()
+            self.result_cache = None
+            self.build_cache = None
+        def test(self, repo):
+            assert os.path.isdir(repo.local_path)
+            score = scores[(repo.student, repo.suffix)]
+            return {'student': repo.student, 'score': score, 'comment': repo.suffix, 'results': []}
+        def print_histogram(self, class_results):
+            pass
+
+    cfg = Config({
+        'Canvas': type('X', (), {})(),
+        'CanvasMapper': type('X', (), {})(),
+        'Git': {'org': 'o', 'credentials': 'ssh'},
+        'Github': {'host_name': 'api.github.com', 'access_token': 'tok'},
+        'Test': {'tests_path': str(tmp_path)},
+        'Config': {'students': ['alice', 'bob']},
+    })
+    args = Args({
+        'action': 'class', 'all_dates': True, 'by_date': False, 'exec_cmd': None, 'git_jobs': 2, 'pipeline': False,
+        'github_action': False, 'jobs': 2, 'no_cache': False, 'parallel_tests': None, 'test_name': None,
+        'project': project, 'students': None, 'verbose': False, 'very_verbose': False,
+    })
+    monkeypatch.setattr('autograder.actions.config.Config.from_path', staticmethod(lambda p: cfg))
+    monkeypatch.setattr('autograder.actions.config.Config.get_path', staticmethod(lambda: Path('dummy')))
+    monkeypatch.setattr('autograder.actions.config.Args.from_cmdline', staticmethod(lambda: args))
+    monkeypatch.chdir(tmp_path)
+    from autograder import grade as grade_mod
+    monkeypatch.setattr(grade_mod, 'Test', FakeTest)
+    monkeypatch.setattr(grade_mod, 'Git', FakeGit)
+    grade_mod.main()
+
+    for suffix in ['due', 'late']:
+        data = json.loads((tmp_path / f'{project}-{suffix}.json').read_text())
+        assert {r['student']: r['score'] for r in data} == {s: scores[(s, suffix)] for s in ['alice', 'bob']}
+    rolled = {r['student']: r['score'] for r in json.loads((tmp_path / f'{project}-rollup.json').read_text())}
+    assert rolled == {'alice': 8.0, 'bob': 10}
+
+
+def test_grade_archive_and_restore(tmp_path, monkeypatch, capsys):
+    import shutil
+    import subprocess
+    project = 'projx'
+    git = ['git', '-c', 'user.name=t', '-c', 'user.email=t@example.com']
+    starter = tmp_path / 'starter'
+    starter.mkdir()
+    (starter / 'f').write_text('starter')
+    subprocess.run(git + ['init', '-q'], cwd=starter, check=True)
+    subprocess.run(git + ['add', '.'], cwd=starter, check=True)
+    subprocess.run(git + ['commit', '-q', '-m', 'starter'], cwd=starter, check=True)
+    for student in ['alice', 'bob']:
+        repo = tmp_path / f'{project}-{student}'
+        subprocess.run(['git', 'clone', '-q', str(starter), str(repo)], check=True)
+        (repo / 'g').write_text(student)
+        subprocess.run(git + ['add', 'g'], cwd=repo, check=True)
+        subprocess.run(git + ['commit', '-q', '-m', student], cwd=repo, check=True)
+    (tmp_path / f'{project}.json').write_text('[{"student": "alice", "score": 10}]')
+
+    class FakeTest:
+        def __init__(self, *_):
+            self.project_cfg = type('PC', (), {'subdir': None})()
+
+    cfg = Config({
+        'Canvas': type('X', (), {})(),
+        'CanvasMapper': type('X', (), {})(),
+        'Git': {'org': 'o', 'credentials': 'ssh'},
+        'Github': {'host_name': 'api.github.com', 'access_token': 'tok'},
+        'Test': {'tests_path': str(tmp_path)},
+        'Config': {'students': ['alice', 'bob', 'carol']},
+    })
+    monkeypatch.setattr('autograder.actions.config.Config.from_path', staticmethod(lambda p: cfg))
+    monkeypatch.setattr('autograder.actions.config.Config.get_path', staticmethod(lambda: Path('dummy')))
+    monkeypatch.chdir(tmp_path)
+    from autograder import grade as grade_mod
+    monkeypatch.setattr(grade_mod, 'Test', FakeTest)
+
+    def run(action, students=None):
+        args = Args({
+            'action': action, 'all_dates': False, 'by_date': False, 'exec_cmd': None, 'git_jobs': 4, 'pipeline': False,
+            'github_action': False, 'jobs': 1, 'no_cache': False, 'parallel_tests': None, 'test_name': None,
+            'project': project, 'students': students, 'verbose': False, 'very_verbose': False,
+        })
+        monkeypatch.setattr('autograder.actions.config.Args.from_cmdline', staticmethod(lambda: args))
+        grade_mod.main()
+        return capsys.readouterr().out
+
+    out = run('archive')
+    assert 'archived: 2, not found: 1' in out
+    archive = tmp_path / f'{project}-archive.git'
+    refs = subprocess.run(['git', 'for-each-ref', '--format=%(refname)'], cwd=archive,
+                          capture_output=True, text=True).stdout.split()
+    assert refs == ['refs/results', 'refs/snapshots/alice/current', 'refs/snapshots/bob/current']
+    assert len(list((archive / 'objects' / 'pack').glob('*.pack'))) == 1
+
+    for student in ['alice', 'bob']:
+        shutil.rmtree(tmp_path / f'{project}-{student}')
+    (tmp_path / f'{project}.json').unlink()
+    out = run('restore', ['bob'])
+    assert 'restored: 1' in out
+    assert (tmp_path / f'{project}-bob' / 'g').read_text() == 'bob'
+    assert not (tmp_path / f'{project}-alice').exists()
+    assert json.loads((tmp_path / f'{project}.json').read_text())[0]['score'] == 10
+    assert 'already exists: 1' in run('restore', ['bob'])
+
+
+def test_grade_class_github_action_fetches_concurrently_in_roster_order(tmp_path, monkeypatch, capsys):
+    import threading
+    import time
+    project = 'projx'
+    students = ['s%02d' % i for i in range(8)]
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def fake_get_url(self, url, headers={}):
+        with lock:
+            active.append(url)
+            peak.append(len(active))
+        # Later students answer first
+        time.sleep(0.01 * (8 - int(url.split('-s')[1][:2])))
+        with lock:
+            active.remove(url)
+        student = url.split('-')[1].split('/')[0]
+        if '/actions/artifacts?per_page=1' in url:
+            return {'artifacts': [{'archive_download_url': f'https://x/{project}-{student}/a.zip',
+                                   'workflow_run': {'id': 1}}]}
+        if url.endswith('/jobs'):
+            return {'jobs': [{'id': 2}]}
+        return zip_for[student]
+
+    from io import BytesIO
+    from zipfile import ZipFile
+    zip_for = {}
+    for i, s in enumerate(students):
+        bio = BytesIO()
+        with ZipFile(bio, 'w') as z:
+            z.writestr('grade-results.json', json.dumps({'grade': str(i)}))
+        zip_for[s] = bio.getvalue()
+
+    class FakeTest:
+        def __init__(self, *_):
+            self.project_cfg = type('PC', (), {'subdir': None})()
+            self.result_cache = None
+            self.build_cache = None
+        def print_histogram(self, class_results):
+            pass
+
+    cfg = Config({
+        'Canvas': type('X', (), {})(),
+        'CanvasMapper': type('X', (), {})(),
+        'Git': {'org': 'o', 'credentials': 'ssh'},
+        'Github': {'host_name': 'api.github.com', 'access_token': 'tok', 'concurrency': 4},
+        'Test': {'tests_path': str(tmp_path)},
+        'Config': {'students': students},
+    })
+    args = Args({
+        'action': 'class', 'all_dates': False, 'by_date': False, 'exec_cmd': None, 'git_jobs': 4, 'pipeline': False,
+        'github_action': True, 'jobs': 1, 'no_cache': False, 'parallel_tests': None, 'test_name': None,
+        'project': project, 'students': None, 'verbose': False, 'very_verbose': False,
+    })
+    monkeypatch.setattr('autograder.actions.config.Config.from_path', staticmethod(lambda p: cfg))
+    monkeypatch.setattr('autograder.actions.config.Config.get_path', staticmethod(lambda: Path('dummy')))
+    monkeypatch.setattr('autograder.actions.config.Args.from_cmdline', staticmethod(lambda: args))
+    monkeypatch.setattr('autograder.actions.server.Server.get_url', fake_get_url)
+    monkeypatch.setattr('autograder.actions.server.Server.download',
+                        lambda self, url, headers={}, limit=None: BytesIO(fake_get_url(self, url)))
+    monkeypatch.chdir(tmp_path)
+    from autograder import grade as grade_mod
+    monkeypatch.setattr(grade_mod, 'Test', FakeTest)
+    monkeypatch.setattr(grade_mod.Git, 'get_url_for_hash', lambda self, comment, repo: comment)
+    grade_mod.main()
+
+    data = json.loads((tmp_path / f'{project}.json').read_text())
+    assert [r['student'] for r in data] == students
+    assert [r['score'] for r in data] == [float(i) for i in range(8)]
+    assert data[3]['comment'] == f'https://github.com/o/{project}-s03/actions/runs/1#summary-2'
+    assert 1 < max(peak) <= 4
+
+
+@pytest.mark.parametrize('flags, message', [
+    ({'all_dates': True, 'by_date': True}, "can't be used with --by-date"),
+    ({'all_dates': True, 'pipeline': True}, '--pipeline only works with class'),
+    ({'github_action': True, 'pipeline': True}, '--pipeline only works with class'),
+])
+def test_grade_rejects_flags_which_dont_go_together(tmp_path, monkeypatch, capsys, flags, message):
+    cfg = Config({
+        'Canvas': type('X', (), {})(),
+        'CanvasMapper': type('X', (), {})(),
+        'Git': {'org': 'o', 'credentials': 'ssh'},
+        'Github': {'host_name': 'api.github.com', 'access_token': 'tok'},
+        'Test': {'tests_path': str(tmp_path)},
+        'Config': {'students': ['alice']},
+    })
+    args = Args({
+        'action': 'class', 'all_dates': False, 'by_date': False, 'exec_cmd': None, 'git_jobs': 4, 'pipeline': False,
+        'github_action': False, 'jobs': 1, 'no_cache': False, 'parallel_tests': None, 'test_name': None,
+        'project': 'projx', 'students': None, 'verbose': False, 'very_verbose': False,
+        **flags,
+    })
+    monkeypatch.setattr('autograder.actions.config.Config.from_path', staticmethod(lambda p: cfg))
+    monkeypatch.setattr('autograder.actions.config.Config.get_path', staticmethod(lambda: Path('dummy')))
+    monkeypatch.setattr('autograder.actions.config.Args.from_cmdline', staticmethod(lambda: args))
+    monkeypatch.chdir(tmp_path)
+    from autograder import grade as grade_mod
+    with pytest.raises(SystemExit):
+        grade_mod.main()
+    assert message in capsys.readouterr().out
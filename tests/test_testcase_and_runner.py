@@ -1,5 +1,6 @@
 from pathlib import Path
 import os
+import shutil
 import pytest
 
 from autograder.actions.config import Args
@@ -10,9 +11,15 @@ from tests.helpers import write_mini_repo, write_tests_repo
 def make_args(project: str):
     return Args({
         'action': 'test',
+        'all_dates': False,
         'by_date': False,
         'exec_cmd': None,
+        'git_jobs': 4,
         'github_action': False,
+        'jobs': 1,
+        'no_cache': False,
+        'parallel_tests': None,
+        'pipeline': False,
         'test_name': None,
         'project': project,
         'students': None,
@@ -46,6 +53,8 @@ def test_test_runner_end_to_end(tmp_path, monkeypatch):
     result = tester.test(Repo(repo))
     assert result['score'] == 10
     assert len(result['results']) == 3
+    for tc_result in result['results']:
+        assert set(tc_result['usage']) == {'utime', 'stime', 'maxrss_kb', 'wall', 'leaked'}
     assert tester.total_rubric() == 10
 
 
@@ -68,3 +77,260 @@ def test_testcase_substitutions_and_match(tmp_path):
     assert '/path/to/tests/projx/in.txt' in cl
     assert '/home/user/Digital.jar' in cl
     assert '01' in cl
+
+
+def test_parallel_tests_keep_toml_order_and_serialize_shared_output(tmp_path, capsys):
+    project = "projx"
+    repo = write_mini_repo(tmp_path, program_name=project)
+    tests_repo = write_tests_repo(tmp_path, project=project)
+    toml = tests_repo / project / f"{project}.toml"
+    text = toml.read_text().replace("build = 'make'", "build = 'none'\nparallel_tests = 4")
+    # Two more cases which share 04's output file
+    for name in ["05", "06"]:
+        text += f"""
+[[tests]]
+name = "{name}"
+output = "04.txt"
+input = ["./$project", "-o", "04.txt"]
+expected = "04out"
+rubric = 1
+"""
+    toml.write_text(text)
+
+    from autograder.actions.test import TestConfig
+    tester = Test(TestConfig({'tests_path': str(tests_repo)}).__dict__, make_args(project))
+    assert tester.project_cfg.parallel_tests == 4
+
+    lanes = tester.make_lanes(tester.test_cases)
+    assert [[tc.tc_cfg.name for tc in lane] for lane in lanes] == [["01"], ["02"], ["04", "05", "06"]]
+
+    results = tester.run_test_cases(str(repo))
+    assert [r['test'] for r in results] == ["01", "02", "04", "05", "06"]
+    assert sum(r['score'] for r in results) == 12
+    out = capsys.readouterr().out
+    positions = [out.index(f"{name}(") for name in ["01", "02", "04", "05", "06"]]
+    assert positions == sorted(positions)
+
+
+def test_testcase_rlimits_fall_back_to_project():
+    from autograder.actions.test import ProjectConfig
+    project_cfg = ProjectConfig({'rlimit_cpu': 10, 'rlimit_as': 1 << 30})
+    tc = TestCase({'name': '01', 'input': [], 'expected': '', 'rlimit_cpu': 2},
+                  project_cfg, make_args('projx'))
+    assert tc.get_rlimits() == {
+        'rlimit_as': 1 << 30, 'rlimit_cpu': 2, 'rlimit_fsize': None, 'rlimit_nproc': None,
+    }
+
+
+def make_fail_fast_case(expected, **project):
+    from autograder.actions.test import ProjectConfig
+    project_cfg = ProjectConfig({'build': 'none', 'fail_fast': True, **project})
+    tc = TestCase({'name': '01', 'input': [], 'expected': expected, 'rubric': 1},
+                  project_cfg, make_args('projx'))
+    tc.cmd_line = ['./projx']
+    return tc
+
+
+@pytest.mark.parametrize("actual", [
+    "a\nb\nc\n", "A\n  b  \nc\n\n\n", "a\nb\n", "a\nb\nc\nd\n", "a\nx\nc\n",
+    "a\n\nb\nc\n", "a\nb\nc\n   \n\n", "", "\n\n",
+])
+def test_stream_matcher_agrees_with_match_expected(actual):
+    from autograder.actions.test import StreamMatcher
+    from autograder.actions.util import OutputDiverged
+    tc = make_fail_fast_case("a\nb\nc")
+    matcher = StreamMatcher(tc)
+    try:
+        # Feed one byte at a time to exercise partial lines
+        for b in actual.encode():
+            matcher(bytes([b]))
+        diverged = False
+    except OutputDiverged:
+        diverged = True
+    # Divergence must imply a mismatch; no divergence is decided at the end
+    if diverged:
+        assert not tc.match_expected(actual)
+
+
+def test_fail_fast_stops_program_at_first_divergence(tmp_path):
+    import time
+    from autograder.actions.test import ProjectConfig
+    tc = make_fail_fast_case("ok\nok\nok", timeout=10)
+    # Print one good line, then garbage forever
+    tc.cmd_line = ["sh", "-c", "echo ok; while true; do echo garbage; sleep 0.01; done"]
+
+    class T(Test):
+        def __init__(self):
+            self.args = make_args('projx')
+
+    start = time.monotonic()
+    result = T().run_one_test(str(tmp_path), tc)
+    assert time.monotonic() - start < 2
+    assert result['score'] == 0
+    assert 'diverged from expected at line 2' in result['test_err']
+
+
+def go_event(action, test=None, output=None):
+    import json
+    d = {'Action': action, 'Package': 'calc'}
+    if test:
+        d['Test'] = test
+    if output:
+        d['Output'] = output
+    return json.dumps(d)
+
+
+def test_go_events_routed_to_each_test_case():
+    from autograder.actions.gotest import NO_TESTS, demux_events
+    events = "\n".join([
+        go_event('run', 'TestAdd'),
+        go_event('output', 'TestAdd', '--- PASS: TestAdd\n'),
+        go_event('pass', 'TestAdd'),
+        go_event('run', 'TestSub'),
+        go_event('run', 'TestSub/neg'),
+        go_event('output', 'TestSub/neg', 'sub is broken\n'),
+        go_event('fail', 'TestSub/neg'),
+        go_event('fail', 'TestSub'),
+        go_event('output', None, 'FAIL\n'),
+        go_event('fail'),
+    ])
+    assert demux_events(events, ['TestAdd', 'TestSub', 'TestMul']) == ['pass', 'sub is broken\n', NO_TESTS]
+
+    # A crash stops the test binary, so later tests report the package output
+    crash = "\n".join([
+        go_event('run', 'TestAdd'),
+        go_event('output', 'TestAdd', 'panic: boom\n'),
+        go_event('fail', 'TestAdd'),
+        go_event('output', None, 'FAIL\tcalc\n'),
+        go_event('fail'),
+    ])
+    assert demux_events(crash, ['TestAdd', 'TestSub']) == ['panic: boom\n', 'FAIL\tcalc\n']
+
+    build_failure = "# calc\n./calc.go:3:1: syntax error\n" + go_event('fail')
+    assert demux_events(build_failure, ['TestAdd']) == ["# calc\n./calc.go:3:1: syntax error\n"]
+
+
+@pytest.mark.skipif(shutil.which('go') is None, reason='go is not installed')
+def test_go_test_cases_share_one_go_test(tmp_path, monkeypatch):
+    # Reuse the user's Go build cache, rather than rebuilding the standard
+    # library in our temporary XDG_CACHE_HOME
+    monkeypatch.setenv('GOCACHE', os.path.expanduser('~/.cache/go-build'))
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    (repo / "go.mod").write_text("module calc\n\ngo 1.20\n")
+    (repo / "calc.go").write_text("package calc\n\nfunc Add(a, b int) int { return a + b }\n")
+    (repo / "calc_test.go").write_text(
+        'package calc\n\nimport "testing"\n\n'
+        'func TestAdd(t *testing.T) { if Add(1, 2) != 3 { t.Fatal("bad") } }\n\n'
+        'func TestSub(t *testing.T) { t.Fatal("sub is broken") }\n'
+    )
+    tests = tmp_path / "tests_repo" / "calc"
+    tests.mkdir(parents=True)
+    (tests / "calc.toml").write_text(
+        "[project]\nbuild = 'go'\n\n"
+        + "".join(
+            f'[[tests]]\nname = "{name}"\ninput = ["go", "test", "-json", "-run", "{name}"]\n'
+            f'expected = "pass"\nrubric = {rubric}\n\n'
+            for name, rubric in [('TestAdd', 2), ('TestSub', 3), ('TestMul', 5)]
+        )
+    )
+
+    class Repo:
+        local_path = str(repo)
+        student = None
+
+    tester = Test({'tests_path': str(tmp_path / "tests_repo")}, make_args('calc'))
+    result = tester.test(Repo())
+    assert result.get('build_err') is None
+    assert [r['score'] for r in result['results']] == [2, 0, 0]
+    assert 'wall' in result['results'][0]['usage']
+    assert result['results'][1]['usage'] == {}
+
+
+def test_result_cache_reruns_only_changed_test_cases(tmp_path, capsys):
+    import subprocess
+    project = "projx"
+    repo = write_mini_repo(tmp_path, program_name=project)
+    tests_repo = write_tests_repo(tmp_path, project=project)
+    git = ['git', '-c', 'user.name=t', '-c', 'user.email=t@example.com']
+    subprocess.run(git + ['init', '-q'], cwd=repo, check=True)
+    subprocess.run(git + ['add', '.'], cwd=repo, check=True)
+    subprocess.run(git + ['commit', '-q', '-m', 'init'], cwd=repo, check=True)
+
+    class Repo:
+        local_path = str(repo)
+        student = 'alice'
+
+    def grade():
+        args = make_args(project)
+        args.action = 'class'
+        tester = Test({'tests_path': str(tests_repo)}, args)
+        result = tester.test(Repo())
+        return tester.result_cache, result
+
+    cache, first = grade()
+    assert (cache.hits, cache.misses) == (0, 3)
+    cache, second = grade()
+    assert (cache.hits, cache.misses) == (3, 0)
+    assert second['score'] == first['score'] == 10
+
+    # Editing one [[tests]] entry only re-runs that test case
+    toml_path = tests_repo / project / f"{project}.toml"
+    toml_path.write_text(toml_path.read_text().replace('expected = "hello"', 'expected = "bye"'))
+    cache, third = grade()
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert third['score'] == 7
+
+    # Settings which don't change results keep them, others don't
+    toml_path.write_text(toml_path.read_text().replace("build = 'make'", "build = 'make'\nparallel_tests = 2\nkill_grace = 0.5"))
+    cache, _ = grade()
+    assert (cache.hits, cache.misses) == (3, 0)
+    toml_path.write_text(toml_path.read_text().replace("build = 'make'", "build = 'make'\ntimeout = 30"))
+    cache, _ = grade()
+    assert (cache.hits, cache.misses) == (0, 3)
+
+    # Uncommitted changes to the repo turn the cache off
+    (repo / "Makefile").write_text("all:\n\t@echo changed\n")
+    cache, _ = grade()
+    assert (cache.hits, cache.misses) == (0, 0)
+
+
+def test_build_cache_skips_unchanged_builds(tmp_path):
+    import subprocess
+    project = "projx"
+    repo = write_mini_repo(tmp_path, program_name=project)
+    tests_repo = write_tests_repo(tmp_path, project=project)
+    (repo / "Makefile").write_text("all: out.o\n\nout.o:\n\techo built >> builds.log\n\ttouch out.o\n")
+    git = ['git', '-c', 'user.name=t', '-c', 'user.email=t@example.com']
+    subprocess.run(git + ['init', '-q'], cwd=repo, check=True)
+    subprocess.run(git + ['add', 'Makefile', project], cwd=repo, check=True)
+    subprocess.run(git + ['commit', '-q', '-m', 'init'], cwd=repo, check=True)
+
+    def build():
+        tester = Test({'tests_path': str(tests_repo)}, make_args(project))
+        return tester.build_cached(str(repo)), tester.build_cache
+
+    assert build()[0] is None
+    build_err, cache = build()
+    assert build_err is None and cache.skipped == 1
+    assert (repo / "builds.log").read_text() == "built\n"
+
+    # Deleting a build product makes us build again
+    (repo / "out.o").unlink()
+    _, cache = build()
+    assert cache.skipped == 0
+    assert (repo / "builds.log").read_text() == "built\nbuilt\n"
+
+    # So does a new untracked file, which the build might use
+    assert build()[1].skipped == 1
+    (repo / "extra.h").write_text("#define X 1\n")
+    _, cache = build()
+    assert cache.skipped == 0
+    assert build()[1].skipped == 1
+
+    # A failed build is replayed without running make
+    (repo / "Makefile").write_text("all:\n\techo failed >> builds.log\n\tfalse\n")
+    assert build()[0] == 'Program did not make successfully'
+    build_err, cache = build()
+    assert build_err == 'Program did not make successfully' and cache.skipped == 1
+    assert (repo / "builds.log").read_text() == "built\nbuilt\nfailed\n"
@@ -51,3 +51,44 @@ def test_safeconfig_unknown_key_exits(monkeypatch):
     with pytest.raises(SystemExit):
         C({"a": 2, "b": 3})
 
+
+
+def test_run_buffered_keeps_order_and_output_blocks(capsys):
+    import time
+
+    def work(n):
+        print(f'start {n}', end=' ')
+        time.sleep(0.01 * (5 - n))
+        print(f'end {n}')
+        return n * n
+
+    assert U.run_buffered(work, list(range(5)), 3) == [0, 1, 4, 9, 16]
+    out = capsys.readouterr().out
+    assert out.splitlines() == [f'start {n} end {n}' for n in range(5)]
+
+
+def test_run_pipeline_overlaps_stages_and_keeps_order(capsys):
+    import threading
+    import time
+    fetched = threading.Event()
+    events = []
+
+    def fetch(n):
+        print(f'fetch {n}', end=' ')
+        if n == 3:
+            # The last fetch is slow, and grading starts without waiting
+            # for it
+            fetched.wait(5)
+        return n * 10
+
+    def grade(n, fetched_value):
+        events.append(n)
+        if n == 0:
+            fetched.set()
+        print(f'grade {fetched_value}')
+        return fetched_value + 1
+
+    assert U.run_pipeline(fetch, grade, list(range(4)), 4, 1) == [1, 11, 21, 31]
+    assert events[-1] == 3
+    out = capsys.readouterr().out
+    assert sorted(out.splitlines()) == [f'fetch {n} grade {n * 10}' for n in range(4)]